@@ -23,6 +23,7 @@
 
 import logging
 import occo.util.factory as factory
+from occo.infraprocessor.coroutine import Blocking, Return
 from occo.infraprocessor.strategy import Strategy
 
 log = logging.getLogger('occo.infraprocessor')
@@ -33,11 +34,87 @@ class Command(object):
     pattern.
 
     Arguments should be passed through the constructor object, which should then store the
+
+    .. attribute:: cancel_event
+
+        A :class:`threading.Event` that may be set by the strategy performing
+        the command. If the command supports cooperative cancellation, it
+        should abort as soon as possible when this event is set. Strategies
+        that cannot interrupt commands otherwise (e.g. threads cannot be
+        signalled) rely on this mechanism.
+
+    .. attribute:: depends_on
+
+        Commands that must be finished before this command can be started.
+        Only strategies supporting dependencies (see :meth:`prerequisites`)
+        take it into account.
     """
+    cancel_event = None
+    depends_on = ()
+
+    def prerequisites(self, batch):
+        """
+        Determine the commands in ``batch`` that must be finished before this
+        command can be started. Besides the explicitly declared
+        :attr:`depends_on` commands, implementations may add dependencies
+        implied by the semantics of the command.
+
+        :param list batch: The list of commands performed together with this
+            one.
+        """
+        return [cmd for cmd in self.depends_on if cmd in batch]
+
     def perform(self, infraprocessor):
         """Perform the algorithm represented by this command."""
         raise NotImplementedError()
 
+    def perform_async(self, infraprocessor):
+        """
+        Coroutine version of :meth:`perform`, see
+        :mod:`occo.infraprocessor.coroutine`.
+
+        By default, :meth:`perform` is offloaded to a worker thread of the
+        event loop. Commands spending most of their time waiting should
+        override this method.
+        """
+        result = yield Blocking(self.perform, infraprocessor)
+        raise Return(result)
+
+    def perform_phased(self, infraprocessor):
+        """
+        Phased version of :meth:`perform`, used by strategies that release
+        the worker performing a command while the command is only waiting.
+
+        This generator performs the command phase by phase. Before starting a
+        phase that merely waits (e.g. for a node to become ready), it yields
+        an object describing that phase (e.g. a
+        :class:`~occo.infraprocessor.synchronization.poller.PendingNode`). The
+        strategy may then either wait on behalf of the command and send the
+        outcome to the generator, or simply continue the generator (possibly
+        in a different thread), in which case :data:`None` is sent and the
+        command waits by itself. The result is returned by raising
+        :class:`~occo.infraprocessor.coroutine.Return`.
+
+        By default, the whole command is performed in a single phase.
+        """
+        raise Return(self.perform(infraprocessor))
+        # Unreachable; makes this method a generator.
+        yield
+
+def run_phases(phases):
+    """
+    Perform all phases of a command (see :meth:`Command.perform_phased`) in
+    the current thread.
+
+    :param phases: The generator returned by :meth:`Command.perform_phased`.
+    :return: The result of the command.
+    """
+    try:
+        for phase in phases:
+            log.debug('Entering phase %r', phase)
+    except Return as r:
+        return r.value
+
 class InfraProcessor(factory.MultiBackend):
     """
     Abstract definition of the Infrastructure Processor.
@@ -68,15 +145,46 @@ class InfraProcessor(factory.MultiBackend):
             in an iterable.
         :type instructions: An iterable or a single :class:`Command`.
         """
+        instruction_list = self._instruction_list(instructions)
+        log.debug('Pushing instruction list: %r', instruction_list)
+        self.prepare_batch(instruction_list)
+        return self.strategy.perform(self, instruction_list)
+
+    def push_instructions_iter(self, instructions):
+        """
+        Performs the given list of independent instructions according to the
+        strategy, yielding the result of each instruction as soon as it has
+        finished.
+
+        :param instructions: The list of instructions. For convenience, a
+            single instruction can be specified by itself, without enclosing it
+            in an iterable.
+        :type instructions: An iterable or a single :class:`Command`.
+
+        :return: A generator yielding ``(index, result)`` pairs in the order
+            of completion. See :meth:`Strategy.perform_iter`.
+        """
+        instruction_list = self._instruction_list(instructions)
+        log.debug('Pushing instruction list (streaming): %r', instruction_list)
+        self.prepare_batch(instruction_list)
+        return self.strategy.perform_iter(self, instruction_list)
+
+    def prepare_batch(self, instruction_list):
+        """
+        Prepare the commands of a batch before it is performed; e.g. to do
+        work common to many commands at once. By default, nothing is done.
+
+        :param list instruction_list: The commands to be performed.
+        """
+        pass
+
+    def _instruction_list(self, instructions):
         # If a single Command object has been specified, convert it to an
         # iterable. This way, the client code can remain more simple if a
         # single command has to be specified; while the strategy can perform
-        # `instructions` uniformly as an iterable.
-        instruction_list = \
-            instructions if hasattr(instructions, '__iter__') \
-            else (instructions,)
-        log.debug('Pushing instruction list: %r', instruction_list)
-        return self.strategy.perform(self, instruction_list)
+        # `instructions` uniformly as a list.
+        return list(instructions) if hasattr(instructions, '__iter__') \
+            else [instructions]
 
     def cri_create_infrastructure(self, infra_id):
         """ Create a primitive that will create an infrastructure instance. """
@@ -0,0 +1,123 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+""" Transport of command results from sub-processes
+
+Strategies performing commands in sub-processes pass the results (and
+exceptions) back to the parent process through a
+:class:`multiprocessing.Queue`. A :class:`ResultCodec` defines how these are
+encoded:
+
+- Results are passed as they are (the queue pickles them with the highest
+  protocol), optionally restricted to the fields the caller needs
+  (``result_fields``). Omitting large fields (e.g. the
+  ``resolved_node_definition`` of an ``instance_data``) reduces both the
+  transport cost and the memory used by the parent process.
+- Exceptions cannot always be pickled as they are (their constructor may not
+  accept their ``args``), and tracebacks cannot be pickled at all. Therefore,
+  an exception is passed as its type, its encoded value, and the text of its
+  traceback.
+"""
+
+__all__ = ['ResultCodec', 'YAMLResultCodec', 'PickleResultCodec']
+
+import cPickle
+import logging
+import traceback
+import yaml
+import occo.util.factory as factory
+
+log = logging.getLogger('occo.infraprocessor.codec')
+
+class ResultCodec(factory.MultiBackend):
+    """
+    Abstract codec for results and exceptions passed from sub-processes.
+
+    :param list result_fields: If specified, only these keys of a dictionary
+        result (e.g. ``instance_data``) are passed back to the parent process.
+    """
+    def __init__(self, result_fields=None):
+        self.result_fields = result_fields
+
+    def encode_result(self, result):
+        if self.result_fields and isinstance(result, dict):
+            return dict((k, result[k])
+                        for k in self.result_fields if k in result)
+        return result
+
+    def decode_result(self, data):
+        return data
+
+    def encode_exception(self, exc_info):
+        """
+        Encode an exception into a structure that can be passed through a
+        :class:`multiprocessing.Queue`.
+        """
+        encoding, value = self._dump_exception(exc_info[1])
+        return {
+            'type'     : exc_info[0],
+            'value'    : value,
+            'encoding' : encoding,
+            # Raw traceback cannot be passed through Queue
+            'tbstr'    : ''.join(traceback.format_tb(exc_info[2])),
+        }
+
+    def decode_exception(self, error):
+        """
+        Reconstruct the exception encoded by :meth:`encode_exception`.
+        """
+        if error.get('encoding') == 'pickle':
+            return self._load_pickled_exception(error['value'])
+        return yaml.load(error['value'])
+
+    def _dump_exception(self, exc):
+        """
+        Overridden in derived classes, returns the name of the encoding and
+        the encoded exception.
+        """
+        raise NotImplementedError()
+
+    def _load_pickled_exception(self, data):
+        exc_type, args, state = cPickle.loads(data)
+        # The constructor is bypassed: it may not accept ``args``.
+        exc = exc_type.__new__(exc_type)
+        exc.args = args
+        exc.__dict__.update(state)
+        return exc
+
+@factory.register(ResultCodec, 'yaml')
+class YAMLResultCodec(ResultCodec):
+    """
+    Exceptions are encoded in YAML. Slow, but the encoded exception is
+    human-readable.
+    """
+    def _dump_exception(self, exc):
+        return 'yaml', yaml.dump(exc)
+
+@factory.register(ResultCodec, 'pickle')
+class PickleResultCodec(ResultCodec):
+    """
+    Exceptions are encoded with binary pickle. If this fails (e.g. an
+    attribute of the exception cannot be pickled), YAML is used as a
+    fallback.
+    """
+    def _dump_exception(self, exc):
+        try:
+            return 'pickle', cPickle.dumps(
+                (exc.__class__, exc.args, getattr(exc, '__dict__', dict())),
+                cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            log.warning('Cannot pickle exception %r; falling back to YAML',
+                        exc)
+            return 'yaml', yaml.dump(exc)
@@ -0,0 +1,288 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+""" Lightweight coroutine engine for performing commands
+
+This module provides a minimal event loop to run generator-based coroutines,
+so that a large number of commands (mostly waiting for nodes to become ready)
+can be performed in a single thread.
+
+A coroutine is a generator, which may yield the following objects:
+
+- :class:`Sleep`: the coroutine is suspended for the given time.
+- :class:`Blocking`: the given blocking call is performed in a worker thread;
+  its return value is sent back to the coroutine (or its exception is raised
+  at the point of the ``yield``).
+- Another generator: it is run as a sub-coroutine; its return value is sent
+  back to the caller coroutine.
+
+As Python 2 generators cannot return values, a coroutine returns a value by
+raising :class:`Return`.
+
+Cancelling a task raises :exc:`KeyboardInterrupt` in the coroutine at the
+point where it is suspended; i.e. coroutines can handle cancellation the same
+way as synchronous commands handle SIGINT.
+"""
+
+__all__ = ['Sleep', 'Blocking', 'Return', 'EventLoop']
+
+import collections
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+import types
+import Queue
+
+log = logging.getLogger('occo.infraprocessor.coroutine')
+
+class Sleep(object):
+    """ Yielded by a coroutine to suspend it for ``seconds`` seconds. """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+class Blocking(object):
+    """
+    Yielded by a coroutine to perform a blocking call in a worker thread of the
+    event loop.
+    """
+    def __init__(self, fun, *args, **kwargs):
+        self.fun, self.args, self.kwargs = fun, args, kwargs
+
+    def __call__(self):
+        return self.fun(*self.args, **self.kwargs)
+
+class Return(Exception):
+    """ Raised by a coroutine to return a value. """
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class Task(object):
+    """
+    A coroutine scheduled in an :class:`EventLoop`.
+
+    :param loop: The event loop running the task.
+    :param coroutine: The generator to be run.
+    :param tag: An arbitrary object identifying the task in the results of
+        :meth:`EventLoop.next_finished`.
+
+    .. attribute:: cancel_event
+
+        A :class:`threading.Event` set when the task is cancelled. Blocking
+        calls performed on behalf of the task may use it to abort early.
+    """
+    def __init__(self, loop, coroutine, tag):
+        self.loop, self.tag = loop, tag
+        self.stack = [coroutine]
+        self.cancel_event = threading.Event()
+        self.interrupt_pending = False
+        self.waiting = None
+        self.timer = None
+        self.done = False
+
+    def cancel(self):
+        """
+        Cancel the task. :exc:`KeyboardInterrupt` will be raised in the
+        coroutine when it is resumed; a sleeping task is resumed immediately.
+        """
+        if self.done or self.cancel_event.is_set():
+            return
+        self.cancel_event.set()
+        self.interrupt_pending = True
+        if self.waiting == 'sleep':
+            self.loop._wake(self)
+
+    def step(self, value=None, exc_info=None):
+        """
+        Resume the coroutine, sending ``value`` or raising ``exc_info`` in it,
+        and run it until it is suspended again or finished.
+        """
+        self.waiting = None
+        if self.interrupt_pending:
+            self.interrupt_pending = False
+            exc_info = (KeyboardInterrupt, KeyboardInterrupt(), None)
+
+        while True:
+            gen = self.stack[-1]
+            try:
+                if exc_info:
+                    yielded = gen.throw(*exc_info)
+                else:
+                    yielded = gen.send(value)
+            except Return as r:
+                value, exc_info = r.value, None
+            except StopIteration:
+                value, exc_info = None, None
+            except BaseException:
+                value, exc_info = None, sys.exc_info()
+            else:
+                value, exc_info = None, None
+                if isinstance(yielded, types.GeneratorType):
+                    self.stack.append(yielded)
+                elif isinstance(yielded, Sleep):
+                    self.waiting = 'sleep'
+                    self.loop._schedule(self, yielded.seconds)
+                    return
+                elif isinstance(yielded, Blocking):
+                    self.waiting = 'blocking'
+                    self.loop._submit(self, yielded)
+                    return
+                else:
+                    exc_info = (TypeError,
+                                TypeError('Unsupported object yielded by '
+                                          'coroutine', yielded),
+                                None)
+                continue
+
+            # The current generator has finished
+            self.stack.pop()
+            if not self.stack:
+                self.done = True
+                self.loop._finish(self, value, exc_info)
+                return
+
+class EventLoop(object):
+    """
+    Minimal event loop running :class:`Task`\ s.
+
+    :param int max_threads: The maximum number of worker threads performing
+        :class:`Blocking` calls.
+    :param float poll_interval: The maximum number of seconds to wait for an
+        event at once. Waiting in short intervals keeps the main thread
+        responsive to Ctrl+C.
+    """
+    def __init__(self, max_threads=20, poll_interval=1):
+        self.max_threads = max_threads
+        self.poll_interval = poll_interval
+        self.tasks = set()
+        self.ready = collections.deque()
+        self.finished = collections.deque()
+        self.timers = list()
+        self.timer_counter = itertools.count()
+        self.jobs = Queue.Queue()
+        self.completions = Queue.Queue()
+        self.threads = list()
+        self.idle_threads = 0
+        self.queued_jobs = 0
+        self.lock = threading.Lock()
+
+    def spawn(self, coroutine, tag=None):
+        """ Schedule a coroutine to be run. """
+        task = Task(self, coroutine, tag)
+        self.tasks.add(task)
+        self.ready.append((task, None, None))
+        return task
+
+    def cancel_all(self):
+        """ Cancel all unfinished tasks. """
+        for task in list(self.tasks):
+            task.cancel()
+
+    def _schedule(self, task, seconds):
+        task.timer = next(self.timer_counter)
+        heapq.heappush(self.timers, (time.time() + seconds, task.timer, task))
+
+    def _wake(self, task):
+        # The heap entry of the task becomes stale; it will be skipped.
+        task.timer = None
+        self.ready.append((task, None, None))
+
+    def _finish(self, task, value, exc_info):
+        self.tasks.discard(task)
+        self.finished.append((task.tag, value, exc_info))
+
+    def _submit(self, task, call):
+        with self.lock:
+            self.queued_jobs += 1
+            start_thread = \
+                self.queued_jobs > self.idle_threads \
+                and len(self.threads) < self.max_threads
+        if start_thread:
+            thread = threading.Thread(
+                target=self._executor,
+                name='Blocking-{0}'.format(len(self.threads)))
+            thread.daemon = True
+            self.threads.append(thread)
+            thread.start()
+        self.jobs.put((task, call))
+
+    def _executor(self):
+        while True:
+            with self.lock:
+                self.idle_threads += 1
+            item = self.jobs.get()
+            with self.lock:
+                self.idle_threads -= 1
+                if item is not None:
+                    self.queued_jobs -= 1
+            if item is None:
+                return
+            task, call = item
+            try:
+                self.completions.put((task, call(), None))
+            except BaseException:
+                self.completions.put((task, None, sys.exc_info()))
+
+    def _fire_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, token, task = heapq.heappop(self.timers)
+            if task.timer == token:
+                task.timer = None
+                self.ready.append((task, None, None))
+
+    def _run_once(self):
+        """
+        Run ready tasks, then wait for the next timer or blocking call to
+        finish.
+        """
+        while self.ready:
+            task, value, exc_info = self.ready.popleft()
+            task.step(value, exc_info)
+        if self.finished:
+            return
+
+        delay = self.poll_interval
+        if self.timers:
+            delay = max(0, min(delay, self.timers[0][0] - time.time()))
+        try:
+            self.ready.append(self.completions.get(timeout=delay))
+            while True:
+                self.ready.append(self.completions.get_nowait())
+        except Queue.Empty:
+            pass
+        self._fire_timers()
+
+    def next_finished(self):
+        """
+        Run the event loop until a task finishes.
+
+        :return: A tuple ``(tag, value, exc_info)``; ``exc_info`` is
+            :data:`None` if the task has finished normally.
+        :raises IndexError: if there are no tasks left.
+        """
+        while not self.finished:
+            if not self.tasks:
+                raise IndexError('There are no tasks left')
+            self._run_once()
+        return self.finished.popleft()
+
+    def close(self):
+        """ Stop the worker threads. """
+        for _ in self.threads:
+            self.jobs.put(None)
+        self.threads = list()
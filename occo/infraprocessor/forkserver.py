@@ -0,0 +1,154 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+""" Template process for starting sub-processes cheaply
+
+A :class:`ForkServer` is a small process forked from the parent process early,
+which imports the modules needed to perform commands (plugins, template
+engine, etc.) once. Sub-processes are then forked from this template process
+instead of the parent process, so they start with the modules already loaded,
+and they do not inherit the (possibly large) heap the parent process has
+accumulated since.
+
+The sub-processes are plain forks of the template process, and they call the
+``target`` callable specified upon creating the :class:`ForkServer`. The
+arguments of the call are sent to the template process through a pipe, so
+they must be picklable.
+"""
+
+__all__ = ['ForkServer']
+
+import logging
+import multiprocessing
+import os, signal
+import sys
+
+log = logging.getLogger('occo.infraprocessor.forkserver')
+
+DEFAULT_PRELOAD = [
+    'yaml',
+    'jinja2',
+    'occo.infraprocessor.node_resolution',
+    'occo.plugins.infraprocessor.node_resolution.chef_cloudinit',
+    'occo.plugins.infraprocessor.node_resolution.cloudbroker',
+    'occo.plugins.infraprocessor.node_resolution.dockerp',
+]
+
+class ForkServer(object):
+    """
+    Template process from which sub-processes are forked.
+
+    :param target: The callable performed by the forked sub-processes. It is
+        inherited by the template process, so it need not be picklable.
+    :param list preload: Names of the modules to be imported by the template
+        process. Defaults to :data:`DEFAULT_PRELOAD`.
+    :param str name: The name of the template process.
+
+    The template process ignores SIGINT; the forked sub-processes restore the
+    default handler, so they can be cancelled as usual. The template process
+    ignores SIGCHLD too, so the sub-processes are reaped automatically.
+    """
+    def __init__(self, target, preload=None, name='ForkServer'):
+        self.target = target
+        self.preload = DEFAULT_PRELOAD if preload is None else preload
+        self.name = name
+        self.process = None
+        self.conn = None
+
+    def start(self):
+        """
+        Start the template process. The template process is a fork of the
+        current process; it should be started as early as possible.
+        """
+        self.conn, server_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            name=self.name, target=self._serve, args=(server_conn,))
+        self.process.daemon = True
+        self.process.start()
+        server_conn.close()
+        log.debug('Started template process %r (pid: %d)',
+                  self.name, self.process.pid)
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def spawn(self, *args):
+        """
+        Fork a sub-process from the template process, which calls
+        ``target(*args)``.
+
+        :return: The process id of the new sub-process.
+        """
+        self.conn.send(args)
+        return self.conn.recv()
+
+    def shutdown(self):
+        """
+        Stop the template process. Sub-processes already forked are not
+        affected.
+        """
+        if not self.process:
+            return
+        log.debug('Shutting down template process %r', self.name)
+        try:
+            self.conn.send(None)
+        except (EOFError, IOError, OSError):
+            pass
+        self.conn.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            log.warning('Terminating template process %r', self.name)
+            self.process.terminate()
+        self.process, self.conn = None, None
+
+    def _preload(self):
+        for modname in self.preload:
+            try:
+                __import__(modname)
+            except Exception as ex:
+                log.warning('Cannot preload module %r: %r', modname, ex)
+
+    def _serve(self, conn):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        self._preload()
+        while True:
+            try:
+                args = conn.recv()
+            except EOFError:
+                log.debug('Parent process has exited; exiting.')
+                break
+            if args is None:
+                break
+            pid = os.fork()
+            if pid == 0:
+                conn.close()
+                self._run_child(args)
+            conn.send(pid)
+
+    def _run_child(self, args):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        exitcode = 0
+        try:
+            self.target(*args)
+        except BaseException:
+            log.exception('Unhandled exception in forked sub-process:')
+            exitcode = 1
+        finally:
+            # Interpreter shutdown (atexit handlers, finalizers of objects
+            # inherited from the template) must be bypassed in a plain fork.
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exitcode)
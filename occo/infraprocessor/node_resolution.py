@@ -29,15 +29,204 @@ select the correct :class:`Resolver`.
 """
 
 
-__all__ = ['resolve_node', 'Resolver']
+__all__ = ['resolve_node', 'resolve_nodes', 'ResolutionBatch',
+           'ResolutionGroup', 'Resolver', 'TemplateCache', 'template_cache',
+           'compile_template', 'configure_templates', 'template_environment',
+           'DEFAULT_BYTECODE_CACHE_DIR', 'NodeDefinitionCache',
+           'definition_cache']
 
+import collections
+import copy
+import hashlib
 import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+import jinja2
+import jinja2.bccache
 import occo.util as util
 import occo.util.factory as factory
 
 log = logging.getLogger('occo.infraprocessor.node_resolution')
 
-def resolve_node(ib, node_id, node_description, default_timeout=None):
+#: A suggested location of the on-disk bytecode cache (see
+#: :func:`configure_templates`).
+DEFAULT_BYTECODE_CACHE_DIR = '~/.occo/template_cache'
+
+class SourceRegistryLoader(jinja2.BaseLoader):
+    """
+    Jinja2 loader of templates specified by their source (e.g. attributes of
+    node definitions) instead of files.
+
+    The name of a template is the hash of its source; so identical templates
+    share their compiled code in the bytecode cache, across processes too.
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    @staticmethod
+    def template_name(source):
+        data = source.encode('utf-8') if isinstance(source, unicode) \
+            else source
+        return hashlib.sha1(data).hexdigest()
+
+    def load_source(self, environment, source):
+        """
+        Load the template of the given source.
+
+        :rtype: :class:`jinja2.Template`
+        """
+        name = self.template_name(source)
+        self.local.sources = {name: source}
+        try:
+            return environment.get_template(name)
+        finally:
+            self.local.sources = None
+
+    def get_source(self, environment, name):
+        sources = getattr(self.local, 'sources', None) or dict()
+        if name not in sources:
+            raise jinja2.TemplateNotFound(name)
+        return sources[name], None, lambda: True
+
+class SafeBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    On-disk bytecode cache, which may be shared by multiple processes. Files
+    are replaced atomically; unreadable or unwritable files only cause the
+    template to be compiled again.
+    """
+    def load_bytecode(self, bucket):
+        try:
+            jinja2.FileSystemBytecodeCache.load_bytecode(self, bucket)
+        except Exception as ex:
+            log.debug('IGNORING unusable bytecode cache entry: %s', ex)
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.rename(tmpname, self._get_cache_filename(bucket))
+        except (IOError, OSError) as ex:
+            log.warning('IGNORING error while caching template bytecode: %s',
+                        ex)
+
+_environment = None
+_environment_lock = threading.Lock()
+
+def configure_templates(bytecode_cache_dir=None, **options):
+    """
+    (Re)configure the Jinja2 environment used to compile the templates of
+    node resolution.
+
+    :param str bytecode_cache_dir: The directory of the on-disk bytecode
+        cache, so compiled templates survive restarts of the process.
+        :data:`None` (the default) disables the bytecode cache. Compiled
+        templates contain their literal text (possibly credentials), so the
+        directory is created accessible only by the owner.
+    :param options: Further options of the :class:`jinja2.Environment`.
+    """
+    global _environment
+    bytecode_cache = None
+    if bytecode_cache_dir:
+        path = os.path.expanduser(bytecode_cache_dir)
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path, 0o700)
+            bytecode_cache = SafeBytecodeCache(path)
+        except OSError as ex:
+            log.warning('Template bytecode cache is disabled: %s', ex)
+
+    # Compiled templates are kept by the template_cache
+    environment = jinja2.Environment(loader=SourceRegistryLoader(),
+                                     bytecode_cache=bytecode_cache,
+                                     cache_size=0, **options)
+    with _environment_lock:
+        _environment = environment
+    template_cache.clear()
+    return environment
+
+def template_environment():
+    """
+    Get the Jinja2 environment used to compile the templates of node
+    resolution; configured with the defaults of :func:`configure_templates`
+    unless configured explicitly.
+    """
+    with _environment_lock:
+        environment = _environment
+    return environment or configure_templates()
+
+class TemplateCache(object):
+    """
+    Bounded cache of compiled Jinja2 templates, keyed by their source.
+
+    Resolving many nodes of the same type renders the same templates over and
+    over again; compiling a template is much more expensive than rendering
+    it. The least recently used templates are evicted when the cache is full.
+
+    Templates are compiled by the environment of :func:`template_environment`
+    (using its bytecode cache).
+
+    :param int max_size: The maximum number of templates kept.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.templates = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, source):
+        """
+        Get the compiled template of the given source.
+
+        :rtype: :class:`jinja2.Template`
+        """
+        with self.lock:
+            template = self.templates.pop(source, None)
+            if template is not None:
+                self.templates[source] = template
+                self.hits += 1
+                return template
+            self.misses += 1
+
+        environment = template_environment()
+        template = environment.loader.load_source(environment, source)
+        with self.lock:
+            self.templates[source] = template
+            while len(self.templates) > self.max_size:
+                self.templates.popitem(last=False)
+                self.evictions += 1
+        return template
+
+    def stats(self):
+        """
+        :return: The number of ``hits``, ``misses``, ``evictions``, and the
+            current ``size`` of the cache.
+        """
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, size=len(self.templates))
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+
+#: The template cache shared by all resolvers.
+template_cache = TemplateCache()
+
+def compile_template(source):
+    """
+    Get the compiled Jinja2 template of the given source from the shared
+    :data:`template_cache`.
+    """
+    return template_cache.get(source)
+
+def resolve_node(ib, node_id, node_description, default_timeout=None,
+                 batch=None):
     """
     Resolve node description
 
@@ -47,9 +236,13 @@ def resolve_node(ib, node_id, node_description, default_timeout=None):
         be resolved, filled in with information, to get a
         :ref:`Resolved Node Definition <resolvednode>`.
     :type node_description: :ref:`Node Description <nodedescription>`
+    :param batch: The batch of nodes the node is resolved together with.
+    :type batch: :class:`ResolutionBatch`
+
+    The node definition is looked up through the :data:`definition_cache`.
     """
-    node_definition = ib.get(
-        'node.definition',
+    node_definition = definition_cache.get(
+        ib,
         node_description['type'],
         preselected_backend_ids=(
             node_description.get('backend_id')
@@ -61,13 +254,261 @@ def resolve_node(ib, node_id, node_description, default_timeout=None):
         info_broker=ib,
         node_id=node_id,
         node_description=node_description,
-        default_timeout=default_timeout
+        default_timeout=default_timeout,
+        group=(batch.group(node_description, node_definition)
+               if batch else None),
     )
     log.debug('Resolving node using %r', resolver.__class__)
 
     resolver.resolve_node(node_definition)
     return node_definition
 
+def resolve_nodes(ib, nodes, default_timeout=None):
+    """
+    Resolve the descriptions of many nodes at once (see
+    :class:`ResolutionBatch`).
+
+    :param list nodes: ``(node_id, node_description)`` pairs.
+
+    :return: The list of the resolved node definitions, in the order of
+        ``nodes``.
+    """
+    batch = ResolutionBatch()
+    resolved = [resolve_node(ib, node_id, node_description, default_timeout,
+                             batch)
+                for node_id, node_description in nodes]
+    log.debug('Resolved %d nodes in %d groups',
+              len(resolved), len(batch.groups))
+    return resolved
+
+class ResolutionGroup(object):
+    """
+    Information shared by the resolvers of a group of nodes (see
+    :meth:`Resolver.shared`). Thread-safe: a piece of information is
+    gathered only once, even if it is needed by many threads at the same
+    time; different pieces of information are gathered concurrently.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = dict()
+
+    def shared(self, fun, *args):
+        key = (fun, args)
+        while True:
+            with self.lock:
+                entry = self.results.get(key)
+                owner = entry is None
+                if owner:
+                    entry = self.results[key] = dict(done=threading.Event())
+            if not owner:
+                entry['done'].wait()
+                if 'result' in entry:
+                    return entry['result']
+                # Gathering the information has failed; try again
+                continue
+
+            try:
+                entry['result'] = fun(*args)
+                return entry['result']
+            except BaseException:
+                with self.lock:
+                    del self.results[key]
+                raise
+            finally:
+                entry['done'].set()
+
+_process_batches = collections.OrderedDict()
+_process_batches_lock = threading.Lock()
+
+def _process_batch(batch_id, max_batches=16):
+    """
+    Get the copy of a batch in the current process (see
+    :class:`ResolutionBatch`); the last ``max_batches`` batches are kept.
+    """
+    with _process_batches_lock:
+        batch = _process_batches.pop(batch_id, None)
+        if batch is None:
+            batch = ResolutionBatch(batch_id)
+        _process_batches[batch_id] = batch
+        while len(_process_batches) > max_batches:
+            _process_batches.popitem(last=False)
+        return batch
+
+class ResolutionBatch(object):
+    """
+    A batch of nodes resolved together (see :func:`resolve_node`), possibly
+    by different threads.
+
+    Nodes of the same type, started on the same backend by the same user,
+    form a :class:`ResolutionGroup`: the information they share (e.g. the
+    authentication data of the backend) is gathered only once per group, and
+    only the node-specific parts are resolved for each node.
+
+    A batch passed to another process (i.e. pickled) starts empty there; but
+    the nodes of the batch passed to the same process (e.g. to the same
+    worker of a process pool) share a single copy of it.
+    """
+    def __init__(self, batch_id=None):
+        self.batch_id = batch_id or uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.groups = dict()
+
+    def group(self, node_description, node_definition):
+        key = (node_description['type'],
+               node_definition.get('backend_id'),
+               node_description.get('user_id'))
+        with self.lock:
+            if key not in self.groups:
+                self.groups[key] = ResolutionGroup()
+            return self.groups[key]
+
+    def __reduce__(self):
+        # Neither locks nor the gathered information (e.g. bound methods of
+        # info providers) can be pickled
+        return _process_batch, (self.batch_id,)
+
+class NodeDefinitionCache(object):
+    """
+    Cache of node definitions, keyed by the node type, the preselected
+    backends, and the backend selection strategy.
+
+    Resolvers update node definitions in place, so each caller gets its own
+    (deep) copy of the cached definition; the cached one is never modified.
+
+    Definitions selected by a strategy in :attr:`uncached_strategies` are not
+    cached (unless a single backend is preselected): each node must be
+    subject to the selection. For strategies in :attr:`selectors`, all the
+    definitions of the node type (``node.definition.all``) are cached
+    instead, and the selection is performed among them (see :meth:`select`)
+    for each node. Otherwise, or if the info broker cannot list the
+    definitions, each node is looked up separately.
+
+    :param float ttl: Definitions are queried again after this many seconds.
+        0 disables caching.
+    :param int max_size: The maximum number of definitions kept.
+    """
+    uncached_strategies = ('random',)
+    #: The strategies that can be performed here, over the cached
+    #: definitions: ``selector(candidates)`` selects one of them.
+    selectors = dict(random=random.choice)
+
+    def __init__(self, ttl=30, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def _backend_ids(preselected_backend_ids):
+        backend_ids = preselected_backend_ids
+        if isinstance(backend_ids, basestring):
+            backend_ids = [backend_ids]
+        return tuple(backend_ids) if backend_ids else None
+
+    def _key(self, info_broker, node_type, preselected_backend_ids, strategy):
+        if not self.ttl:
+            return None
+        backend_ids = self._backend_ids(preselected_backend_ids)
+        if strategy in self.uncached_strategies \
+                and not (backend_ids and len(backend_ids) == 1):
+            return None
+        return info_broker, node_type, backend_ids, strategy
+
+    def _cached(self, key, query):
+        """
+        Get the cached result of ``query()``; performing and caching it if
+        missing or expired. The cached result itself is returned, which must
+        not be modified.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry[1] < self.ttl:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        result = copy.deepcopy(query())
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (result, time.time())
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return result
+
+    def candidates(self, info_broker, node_type, preselected_backend_ids=None):
+        """
+        Get the (cached) definitions of a node type, on the preselected
+        backends if any.
+
+        :return: The list of the cached definitions, which must not be
+            modified; or :data:`None` if they cannot be listed.
+        """
+        def query():
+            try:
+                return info_broker.get('node.definition.all', node_type)
+            except Exception as ex:
+                log.debug('Cannot list the definitions of %r: %s',
+                          node_type, ex)
+                return None
+        definitions = self._cached((info_broker, node_type, None, None), query)
+        backend_ids = self._backend_ids(preselected_backend_ids)
+        if definitions and backend_ids:
+            definitions = [d for d in definitions
+                           if d.get('backend_id') in backend_ids]
+        return definitions
+
+    def select(self, candidates, strategy):
+        """
+        Select one of the candidate definitions for a node using the given
+        strategy (one of :attr:`selectors`).
+        """
+        try:
+            selector = self.selectors[strategy]
+        except KeyError:
+            raise ValueError('Unknown backend selection strategy', strategy)
+        return selector(candidates)
+
+    def get(self, info_broker, node_type, preselected_backend_ids=None,
+            strategy='random'):
+        """
+        Get the definition of a node type as ``node.definition`` does.
+
+        :return: A copy of the definition, which may be modified freely.
+        """
+        query = lambda: info_broker.get(
+            'node.definition', node_type,
+            preselected_backend_ids=preselected_backend_ids,
+            strategy=strategy)
+
+        if not self.ttl:
+            return query()
+        key = self._key(info_broker, node_type, preselected_backend_ids,
+                        strategy)
+        if key is not None:
+            return copy.deepcopy(self._cached(key, query))
+        if strategy not in self.selectors:
+            return query()
+
+        candidates = self.candidates(info_broker, node_type,
+                                     preselected_backend_ids)
+        if not candidates:
+            # Also to have the info broker report missing definitions
+            return query()
+        return copy.deepcopy(self.select(candidates, strategy))
+
+    def invalidate(self, node_type=None):
+        """
+        Drop the cached definitions of a node type; or all of them.
+        """
+        with self.lock:
+            for key in list(self.entries):
+                if node_type is None or key[1] == node_type:
+                    del self.entries[key]
+
+#: The node definition cache used by :func:`resolve_node`.
+definition_cache = NodeDefinitionCache()
+
 class Resolver(factory.MultiBackend):
     """
     Abstract interface for node resolution.
@@ -83,13 +524,28 @@ class Resolver(factory.MultiBackend):
 
     :param node_description: The original node description.
     :type node_description: :ref:`Node Description <nodedescription>`
+
+    :param group: The group of nodes resolved together with this one (see
+        :class:`ResolutionBatch` and :meth:`shared`).
+    :type group: :class:`ResolutionGroup`
     """
     def __init__(self, info_broker, node_id, node_description,
-                 default_timeout=None):
+                 default_timeout=None, group=None):
         self.info_broker = info_broker
         self.node_id = node_id
         self.node_description = node_description
         self.default_timeout = default_timeout
+        self.group = group or ResolutionGroup()
+
+    def shared(self, fun, *args):
+        """
+        Get ``fun(*args)``, computing it only once for the whole group of
+        nodes being resolved together. Resolvers use this for information
+        that is the same for all nodes of the same type, backend, and user.
+
+        Each caller gets its own (deep) copy of the result.
+        """
+        return copy.deepcopy(self.group.shared(fun, *args))
 
     def determine_timeout(self, node_definition):
         def possible_timeouts():
@@ -18,21 +18,41 @@
 
 """
 
-__all__ = ['Strategy', 'SequentialStrategy', 'ParallelProcessesStrategy']
+__all__ = ['Strategy', 'SequentialStrategy', 'ParallelProcessesStrategy',
+           'ProcessPoolStrategy', 'ThreadPoolStrategy', 'PipelinedStrategy',
+           'CoroutineStrategy', 'DependencyStrategy']
 
-import yaml
 import logging
 import os, signal
-import sys, traceback
+import sys
+import functools
+import Queue
+import threading
 import occo.util as util
 import occo.util.factory as factory
 import multiprocessing
+from occo.infraprocessor.coroutine import EventLoop, Return
+from occo.infraprocessor.codec import ResultCodec
+from occo.infraprocessor.forkserver import ForkServer
 from occo.exceptions.orchestration import *
 
 log = logging.getLogger('occo.infraprocessor.strategy')
 datalog = logging.getLogger('occo.data.infraprocessor.strategy')
 clean = util.Cleaner(['resolved_node_definition', 'node_description']).deep_copy
 
+def raise_packed_exception(error, codec):
+    """
+    Re-raise an exception, encoded by a sub-process, in the parent process.
+
+    :param error: The exception encoded by
+        :meth:`~occo.infraprocessor.codec.ResultCodec.encode_exception`.
+    :param codec: The codec used to encode the exception.
+    """
+    exc = codec.decode_exception(error)
+    log.debug('Exception occured in sub-process:\n%s\n%r',
+              error['tbstr'], clean(exc))
+    raise error['type'], exc
+
 class Strategy(factory.MultiBackend):
     """
     Abstract strategy for processing a batch of *independent* commands.
@@ -67,9 +87,48 @@ class Strategy(factory.MultiBackend):
             they need a reference to it.
         :param instruction_list: An iterable containing the commands to be
             performed.
+        :return: The list of results, in the order of ``instruction_list``.
+            The result of a command that has failed with a
+            :exc:`~occo.exceptions.orchestration.MinorInfraProcessorError` is
+            :data:`None`.
+        """
+        instruction_list = list(instruction_list)
+        results = [None] * len(instruction_list)
+        for index, result in self.perform_iter(infraprocessor,
+                                               instruction_list):
+            # Auxiliary commands (e.g. undoing) may yield results beyond the
+            # original list.
+            if index < len(results) \
+                    and not isinstance(result, MinorInfraProcessorError):
+                results[index] = result
+        return results
+
+    def perform_iter(self, infraprocessor, instruction_list):
+        """
+        Perform the instruction list, yielding the results as soon as each
+        command has finished.
+
+        :param infraprocessor: The infraprocessor that calls this method.
+        :param instruction_list: An iterable containing the commands to be
+            performed.
+        :return: A generator yielding ``(index, result)`` pairs, where
+            ``index`` is the index of the command in ``instruction_list``. If
+            the command has failed with a
+            :exc:`~occo.exceptions.orchestration.MinorInfraProcessorError`,
+            ``result`` is the exception itself. Other errors are raised by the
+            generator, after the pending commands have been cancelled.
+
+        If the generator is closed before all results have been consumed, the
+        pending commands are cancelled.
         """
         try:
-            return self._perform(infraprocessor, instruction_list)
+            for item in self._perform_iter(infraprocessor, instruction_list):
+                yield item
+        except GeneratorExit:
+            log.debug('Results are not needed anymore; '
+                      'cancelling pending tasks')
+            self.cancel_pending()
+            raise
         except KeyboardInterrupt:
             log.debug('Received KeyboardInterrupt; cancelling pending tasks')
             self.cancel_pending()
@@ -92,21 +151,33 @@ class Strategy(factory.MultiBackend):
                   ex.__class__.__name__, ex.infra_id)
         self.cancel_pending(ex)
 
-    def _perform(self, infraprocessor, instruction_list):
+    def _perform_iter(self, infraprocessor, instruction_list):
         """
-        Core function of :meth:`perform`. This method must be overridden in
-        the implementations of the strategy.
+        Core function of :meth:`perform_iter`. This method must be overridden
+        in the implementations of the strategy, unless :meth:`_perform` is
+        implemented instead.
 
         The actual implementation is expected to handle
         :class:`~occo.exceptions.orchestration.MinorInfraProcessorError`\ s by
-        itself, but propagate other exceptions upward so :meth:`perform` can
-        handle the uniformly.
+        itself (yielding them as the result of the command), but propagate
+        other exceptions upward so :meth:`perform_iter` can handle the
+        uniformly.
 
         :param infraprocessor: The infraprocessor that calls this method.
             Commands are perfomed *on* an infrastructure processor, therefore
             they need a reference to it.
-        :param instruction_list: An iterable containing the commands to be
-            performed.
+        :param instruction_list: The list of commands to be performed.
+        """
+        return enumerate(self._perform(infraprocessor, instruction_list))
+
+    def _perform(self, infraprocessor, instruction_list):
+        """
+        Legacy core function, used by the default implementation of
+        :meth:`_perform_iter`. Results can only be returned all at once.
+
+        :param infraprocessor: The infraprocessor that calls this method.
+        :param instruction_list: The list of commands to be performed.
+        :return: The list of results.
         """
         raise NotImplementedError()
 
@@ -130,14 +201,13 @@ class SequentialStrategy(Strategy):
 
         self.cancelled = True
 
-    def _perform(self, infraprocessor, instruction_list):
+    def _perform_iter(self, infraprocessor, instruction_list):
         self.infraprocessor = infraprocessor
         self.cancelled = False
         log.debug('Peforming instructions SEQUENTIALLY: %r',
                   instruction_list)
 
-        results = list()
-        for i in instruction_list:
+        for index, i in enumerate(instruction_list):
             if self.cancelled:
                 break
 
@@ -145,10 +215,9 @@ class SequentialStrategy(Strategy):
                 result = i.perform(infraprocessor)
             except MinorInfraProcessorError as ex:
                 log.error('IGNORING non-critical error: %s', ex)
-                results.append(None)
+                yield index, ex
             else:
-                results.append(result)
-        return results
+                yield index, result
 
 class PerformProcess(multiprocessing.Process):
     """
@@ -156,11 +225,12 @@ class PerformProcess(multiprocessing.Process):
     single command.
     """
     def __init__(self, procid, procname, infraprocessor, instruction,
-                 result_queue):
+                 result_queue, codec):
         super(PerformProcess, self).__init__(name=procname,target=self.run)
         self.infraprocessor = infraprocessor
         self.instruction = instruction
         self.result_queue = result_queue
+        self.codec = codec
         self.procid = procid
         self.log = logging.getLogger('occo.infraprocessor.strategy.subprocess')
         self.datalog = logging.getLogger('occo.data.infraprocessor.strategy.subprocess')
@@ -168,18 +238,13 @@ class PerformProcess(multiprocessing.Process):
     def return_result(self, result):
         self.log.debug('Sub-process finished normally; exiting.')
         self.datalog.debug('Returning result: %r', clean(result))
-        self.result_queue.put((self.procid, result, None))
+        self.result_queue.put(
+            (self.procid, self.codec.encode_result(result), None))
 
     def return_exception(self, exc_info):
-        exc = exc_info[1]
-        error = {
-            'type'  : exc_info[0],
-            'value' : yaml.dump(exc),
-            # Raw traceback cannot be passed through Queue
-            'tbstr' : ''.join(traceback.format_tb(exc_info[2])),
-        }
-        self.log.debug('Sub-process execution failed: %r', exc)
-        self.result_queue.put((self.procid, None, error))
+        self.log.debug('Sub-process execution failed: %r', exc_info[1])
+        self.result_queue.put(
+            (self.procid, None, self.codec.encode_exception(exc_info)))
 
     def run(self):
         try:
@@ -191,11 +256,61 @@ class PerformProcess(multiprocessing.Process):
             exc = sys.exc_info()
             self.return_exception(exc)
 
+def _perform_forked(infraprocessor, result_queue, codec,
+                    procid, procname, instruction):
+    """
+    Target of the sub-processes forked by the :class:`ForkServer` of
+    :class:`ParallelProcessesStrategy`.
+    """
+    PerformProcess(procid, procname, infraprocessor,
+                   instruction, result_queue, codec).run()
+    # The sub-process exits with os._exit, so the result must be flushed
+    # explicitly.
+    result_queue.close()
+    result_queue.join_thread()
+
+class ForkedPerformProcess(object):
+    """
+    Handle of a single command performed by a sub-process forked by a
+    :class:`ForkServer`. Used instead of :class:`PerformProcess` by
+    :class:`ParallelProcessesStrategy`.
+    """
+    def __init__(self, forkserver, procid, procname, instruction):
+        self.forkserver = forkserver
+        self.procid = procid
+        self.name = procname
+        self.instruction = instruction
+        self.pid = None
+
+    def start(self):
+        self.pid = self.forkserver.spawn(
+            self.procid, self.name, self.instruction)
+
 @factory.register(Strategy, 'parallel')
 class ParallelProcessesStrategy(Strategy):
     """
     Implements :class:`Strategy`, performing the commands in a parallel manner.
+
+    :param str result_codec: The protocol of the
+        :class:`~occo.infraprocessor.codec.ResultCodec` used to pass results
+        from the sub-processes.
+    :param list result_fields: If specified, only these fields of the results
+        (``instance_data``) are passed back from the sub-processes.
+    :param bool forkserver: If :data:`True`, the sub-processes are forked from
+        a template process (:class:`~occo.infraprocessor.forkserver.ForkServer`)
+        instead of the current process. The template process is started upon
+        the first use of the strategy, and it is kept alive between batches.
+    :param list preload: The modules to be imported by the template process.
+        See :class:`~occo.infraprocessor.forkserver.ForkServer`.
     """
+    def __init__(self, result_codec='yaml', result_fields=None,
+                 forkserver=False, preload=None):
+        self.codec = ResultCodec.instantiate(
+            result_codec, result_fields=result_fields)
+        self.use_forkserver = forkserver
+        self.preload = preload
+        self.forkserver = None
+        self.infraprocessor = None
 
     def _possible_process_names(self, instr):
         """
@@ -222,13 +337,36 @@ class ParallelProcessesStrategy(Strategy):
         """
         index = len(self.results)
         self.results.append(None)
-        process = \
-            PerformProcess(
-                index, self._mk_process_name(instruction),
-                self.infraprocessor, instruction, self.result_queue)
+        if self.forkserver:
+            process = ForkedPerformProcess(
+                self.forkserver, index,
+                self._mk_process_name(instruction), instruction)
+        else:
+            process = \
+                PerformProcess(
+                    index, self._mk_process_name(instruction),
+                    self.infraprocessor, instruction, self.result_queue,
+                    self.codec)
         self.processes[index] = process
         return process
 
+    def _ensure_forkserver(self, infraprocessor):
+        """
+        Start the template process if necessary. Sub-processes inherit the
+        infraprocessor and the result queue from the template process; it
+        must be restarted if it is used with a different infraprocessor.
+        """
+        if self.forkserver and self.forkserver.is_alive() \
+                and self.infraprocessor is infraprocessor:
+            return
+        self.shutdown()
+        self.result_queue = multiprocessing.Queue()
+        self.forkserver = ForkServer(
+            functools.partial(_perform_forked, infraprocessor,
+                              self.result_queue, self.codec),
+            preload=self.preload)
+        self.forkserver.start()
+
     def _generate_processes(self, instruction_list):
         """
         Generate the list of :class:`multiprocessing.Process` objects to be
@@ -243,6 +381,9 @@ class ParallelProcessesStrategy(Strategy):
     def _process_one_result(self):
         """
         Wait and then process a sub-process result.
+
+        :return: ``(procid, result)``; ``result`` is the exception itself in
+            case of a :exc:`~occo.exceptions.orchestration.MinorInfraProcessorError`.
         """
         log.debug('Waiting for a sub-process to finish...')
         procid, result, error = self.result_queue.get()
@@ -252,16 +393,22 @@ class ParallelProcessesStrategy(Strategy):
         del self.processes[procid]
 
         if error:
-            error['value'] = yaml.load(error['value'])
-            log.debug('Exception occured in sub-process:\n%s\n%r',
-                      error['tbstr'], clean(error['value']))
-            raise error['type'], error['value']
+            try:
+                raise_packed_exception(error, self.codec)
+            except MinorInfraProcessorError as ex:
+                log.debug('IGNORING Minor IP error: %r', ex)
+                return procid, ex
         else:
+            result = self.codec.decode_result(result)
             self.results[procid] = result
+            return procid, result
 
-    def _perform(self, infraprocessor, instruction_list):
+    def _perform_iter(self, infraprocessor, instruction_list):
+        if self.use_forkserver:
+            self._ensure_forkserver(infraprocessor)
+        else:
+            self.result_queue = multiprocessing.Queue()
         self.infraprocessor = infraprocessor
-        self.result_queue = multiprocessing.Queue()
         self._generate_processes(instruction_list)
 
         # Start all processes
@@ -273,14 +420,10 @@ class ParallelProcessesStrategy(Strategy):
         # Wait for results
         log.debug('Waiting for sub-processes to finish')
         while self.processes:
-            try:
-                self._process_one_result()
-            except MinorInfraProcessorError as ex:
-                log.debug('IGNORING Minor IP error: %r', ex)
+            yield self._process_one_result()
 
         log.debug('All sub-processes finished; exiting.')
         datalog.debug('Sub-process results: %r', self.results)
-        return self.results
 
     def cancel_pending(self, reason=None):
         log.debug('Cancelling pending sub-processes')
@@ -309,3 +452,816 @@ class ParallelProcessesStrategy(Strategy):
             except BaseException:
                 log.exception(
                     'IGNORING exception while waiting for sub-processes:')
+
+    def shutdown(self):
+        """
+        Stop the template process, if any.
+        """
+        if self.forkserver:
+            self.forkserver.shutdown()
+            self.forkserver = None
+
+class PoolWorkerProcess(multiprocessing.Process):
+    """
+    Long-lived process object used by :class:`ProcessPoolStrategy`.
+
+    The worker performs commands taken from a shared work queue until it
+    receives a :data:`None` sentinel or, if ``max_commands`` is specified, until
+    it has performed that many commands. In the latter case the worker exits
+    and the strategy replaces it with a fresh one (recycling).
+
+    The worker reports its progress through the result queue using the
+    following messages:
+
+    - ``('started', worker_id, procid)``
+    - ``('done', worker_id, procid, result, error)``
+    - ``('exited', worker_id)``
+
+    SIGINT is ignored while the worker is idle, so a cancellation signal
+    arriving late cannot kill the worker itself; it only interrupts the
+    command being performed. A signal arriving after a command has been
+    taken from the work queue, but before SIGINT is enabled, would be lost:
+    so commands whose ``procid`` is below the shared ``cancelled`` value
+    are not performed at all.
+
+    The ``procid`` of the command taken from the work queue is also recorded
+    in the shared ``current`` value (-1 while idle), so the commands of
+    workers dying before their messages get through are not lost either.
+    """
+    def __init__(self, worker_id, infraprocessor,
+                 work_queue, result_queue, codec, max_commands=None,
+                 cancelled=None):
+        super(PoolWorkerProcess, self).__init__(
+            name='PoolWorker-{0}'.format(worker_id))
+        self.daemon = True
+        self.worker_id = worker_id
+        self.infraprocessor = infraprocessor
+        self.work_queue = work_queue
+        self.result_queue = result_queue
+        self.codec = codec
+        self.max_commands = max_commands
+        self.cancelled = cancelled
+        self.current = multiprocessing.Value('i', -1, lock=False)
+        self.log = logging.getLogger('occo.infraprocessor.strategy.subprocess')
+        self.datalog = logging.getLogger('occo.data.infraprocessor.strategy.subprocess')
+
+    def perform_one(self, procid, instruction):
+        result, error = None, None
+        try:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            self.result_queue.put(('started', self.worker_id, procid))
+            if self.cancelled is not None and procid < self.cancelled.value:
+                raise KeyboardInterrupt()
+            result = instruction.perform(self.infraprocessor)
+        except KeyboardInterrupt:
+            self.log.debug('Operation cancelled.')
+        except Exception:
+            exc_info = sys.exc_info()
+            self.log.debug('Command execution failed: %r', exc_info[1])
+            error = self.codec.encode_exception(exc_info)
+        finally:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        self.datalog.debug('Returning result: %r', clean(result))
+        self.result_queue.put(('done', self.worker_id, procid,
+                               self.codec.encode_result(result), error))
+
+    def run(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        performed = 0
+        while not self.max_commands or performed < self.max_commands:
+            item = self.work_queue.get()
+            if item is None:
+                self.log.debug('Received sentinel; exiting.')
+                break
+            self.current.value = item[0]
+            self.perform_one(*item)
+            # Only after the result has been queued
+            self.current.value = -1
+            performed += 1
+        else:
+            self.log.debug('Performed %d commands; exiting for recycling.',
+                           performed)
+        self.result_queue.put(('exited', self.worker_id))
+
+@factory.register(Strategy, 'pool')
+class ProcessPoolStrategy(Strategy):
+    """
+    Implements :class:`Strategy`, performing the commands in parallel using a
+    bounded set of long-lived worker processes.
+
+    Unlike :class:`ParallelProcessesStrategy`, which forks a process for each
+    command, this strategy starts at most ``max_workers`` processes, which
+    pull commands from a shared work queue. The workers are kept alive between
+    batches.
+
+    :param int max_workers: The maximum number of worker processes. Defaults
+        to the number of CPUs.
+    :param int max_commands_per_worker: If specified, a worker process exits
+        after performing this many commands, and it is replaced with a fresh
+        one. :data:`None` means workers are never recycled.
+    :param float liveness_check_interval: Number of seconds after which
+        worker processes are checked for unexpected termination while waiting
+        for results.
+    :param str result_codec: The protocol of the
+        :class:`~occo.infraprocessor.codec.ResultCodec` used to pass results
+        from the worker processes.
+    :param list result_fields: If specified, only these fields of the results
+        (``instance_data``) are passed back from the worker processes.
+    """
+    def __init__(self, max_workers=None, max_commands_per_worker=None,
+                 liveness_check_interval=5,
+                 result_codec='yaml', result_fields=None):
+        self.codec = ResultCodec.instantiate(
+            result_codec, result_fields=result_fields)
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.max_commands_per_worker = max_commands_per_worker
+        self.liveness_check_interval = liveness_check_interval
+        self.infraprocessor = None
+        self.workers = dict()
+        self.worker_counter = 0
+        self.results = list()
+        self.pending = dict()
+        self.running = dict()
+        self.lost = list()
+
+    def _start_pool(self, infraprocessor):
+        """
+        Prepare the queues of the pool. Worker processes are started lazily,
+        when there is work to be done.
+        """
+        self.infraprocessor = infraprocessor
+        self.work_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        # Commands submitted before cancellation (see PoolWorkerProcess)
+        self.cancelled = multiprocessing.Value('i', 0)
+
+    def _ensure_pool(self, infraprocessor):
+        """
+        Workers inherit the infraprocessor they perform commands on; the pool
+        must be restarted if it is used with a different one.
+        """
+        if self.infraprocessor is not infraprocessor:
+            self.shutdown()
+            self._start_pool(infraprocessor)
+
+    def _start_worker(self):
+        self.worker_counter += 1
+        worker = PoolWorkerProcess(
+            self.worker_counter, self.infraprocessor,
+            self.work_queue, self.result_queue, self.codec,
+            self.max_commands_per_worker, self.cancelled)
+        self.workers[worker.worker_id] = worker
+        log.debug('Starting worker process %r', worker.name)
+        worker.start()
+
+    def _grow_pool(self):
+        """
+        Start worker processes as needed; but not more than ``max_workers``.
+        """
+        needed = min(self.max_workers, len(self.pending))
+        while len(self.workers) < needed:
+            self._start_worker()
+
+    def _retire_worker(self, worker_id):
+        # The worker may have been reaped by _check_workers already
+        worker = self.workers.pop(worker_id, None)
+        if worker:
+            log.debug('Worker process %r has exited', worker.name)
+            worker.join()
+        self._grow_pool()
+
+    def _check_workers(self):
+        """
+        Remove workers that have exited; commands they were performing (also
+        those not reported as started) are considered to be finished without a
+        result.
+        """
+        for worker_id, worker in self.workers.items():
+            if worker.is_alive():
+                continue
+            if worker.exitcode:
+                log.error('Worker process %r has died unexpectedly '
+                          '(exit code %r)', worker.name, worker.exitcode)
+            del self.workers[worker_id]
+            lost = set(procid for procid, wid in self.running.iteritems()
+                       if wid == worker_id)
+            lost.add(worker.current.value)
+            for procid in lost:
+                self.running.pop(procid, None)
+                if procid in self.pending and procid not in self.lost:
+                    log.error('Command #%d has been lost', procid)
+                    self.lost.append(procid)
+        self._grow_pool()
+
+    def _submit(self, instruction):
+        index = len(self.results)
+        self.results.append(None)
+        self.pending[index] = instruction
+        self.work_queue.put((index, instruction))
+        return index
+
+    def _process_one_result(self):
+        """
+        Wait and then process a command result. Progress messages of the
+        workers are processed meanwhile.
+
+        :return: ``(procid, result)``; ``result`` is the exception itself in
+            case of a :exc:`~occo.exceptions.orchestration.MinorInfraProcessorError`.
+        """
+        log.debug('Waiting for a command to finish...')
+        while not self.lost:
+            try:
+                message = self.result_queue.get(
+                    timeout=self.liveness_check_interval)
+            except Queue.Empty:
+                self._check_workers()
+                continue
+
+            kind, worker_id = message[0], message[1]
+            if kind == 'started':
+                self.running[message[2]] = worker_id
+            elif kind == 'exited':
+                self._retire_worker(worker_id)
+            elif kind == 'done':
+                procid, result, error = message[2:]
+                self.running.pop(procid, None)
+                if procid not in self.pending:
+                    # Already reported as lost
+                    log.debug('Ignoring late result for command #%d', procid)
+                    continue
+                log.debug('Result for command #%d has arrived', procid)
+                self.pending.pop(procid, None)
+                if error:
+                    try:
+                        raise_packed_exception(error, self.codec)
+                    except MinorInfraProcessorError as ex:
+                        log.debug('IGNORING Minor IP error: %r', ex)
+                        return procid, ex
+                result = self.codec.decode_result(result)
+                self.results[procid] = result
+                return procid, result
+
+        procid = self.lost.pop()
+        self.pending.pop(procid, None)
+        return procid, None
+
+    def _perform_iter(self, infraprocessor, instruction_list):
+        self._ensure_pool(infraprocessor)
+        self.results = list()
+        self.pending = dict()
+        self.running = dict()
+        self.lost = list()
+        self.cancelled.value = 0
+
+        for instruction in instruction_list:
+            self._submit(instruction)
+        self._grow_pool()
+        log.debug('Submitted %d commands to a pool of %d worker processes',
+                  len(self.pending), len(self.workers))
+
+        while self.pending:
+            yield self._process_one_result()
+
+        log.debug('All commands have finished.')
+        datalog.debug('Pool results: %r', self.results)
+
+    def _drain_work_queue(self):
+        """
+        Remove commands from the work queue that have not been started yet.
+        """
+        while True:
+            try:
+                procid, instruction = self.work_queue.get(timeout=0.1)
+            except Queue.Empty:
+                break
+            log.debug('Dropping unstarted command #%d', procid)
+            self.pending.pop(procid, None)
+
+    def cancel_pending(self, reason=None):
+        if not self.infraprocessor:
+            return
+        log.debug('Cancelling pending commands')
+
+        self.cancelled.value = len(self.results)
+        self._drain_work_queue()
+        # Workers that have taken a command may not have reported it yet,
+        # so all of them are signalled; idle workers ignore SIGINT.
+        for worker in self.workers.values():
+            if not worker.is_alive():
+                continue
+            try:
+                log.debug('Sending SIGINT to %r', worker.name)
+                os.kill(worker.pid, signal.SIGINT)
+            except:
+                log.exception('IGNORING exception while sending signal:')
+
+        if isinstance(reason, NodeCreationError):
+            inst_data = reason.instance_data
+            log.debug('Undoing create node for %r', inst_data['node_id'])
+            self._submit(self.infraprocessor.cri_drop_node(inst_data))
+            self._grow_pool()
+
+        log.debug('Waiting for running commands to finish')
+        while self.pending:
+            try:
+                self._process_one_result()
+            except KeyboardInterrupt:
+                log.info('Received Ctrl+C while waiting for worker processes '
+                         'to finish. Aborting.')
+                raise
+            except BaseException:
+                log.exception(
+                    'IGNORING exception while waiting for worker processes:')
+
+    def shutdown(self):
+        """
+        Stop all worker processes of the pool.
+        """
+        if not self.workers:
+            return
+        log.debug('Shutting down worker pool')
+        for _ in self.workers:
+            self.work_queue.put(None)
+        for worker in self.workers.itervalues():
+            worker.join(self.liveness_check_interval)
+            if worker.is_alive():
+                log.warning('Terminating worker process %r', worker.name)
+                worker.terminate()
+        self.workers = dict()
+
+@factory.register(Strategy, 'threaded')
+class ThreadPoolStrategy(Strategy):
+    """
+    Implements :class:`Strategy`, performing the commands in parallel using a
+    pool of threads.
+
+    As threads cannot be interrupted with signals, cancellation is
+    cooperative: a shared :class:`threading.Event` is set, which is passed to
+    the commands through their :attr:`~occo.infraprocessor.Command.cancel_event`
+    attribute (e.g. :class:`CreateNode` passes it to
+    :func:`~occo.infraprocessor.synchronization.wait_for_node`).
+
+    :param int max_threads: The maximum number of threads performing commands
+        simultaneously. :data:`None` means one thread per command.
+    :param float poll_interval: Number of seconds to wait for a result at once.
+        Waiting for results in short intervals keeps the main thread
+        responsive to Ctrl+C.
+    """
+    def __init__(self, max_threads=None, poll_interval=1):
+        self.max_threads = max_threads
+        self.poll_interval = poll_interval
+        self.cancel_event = threading.Event()
+        self.infraprocessor = None
+        self.threads = list()
+        self.results = list()
+        self.pending = dict()
+        # The number of worker threads that have not decided to exit yet.
+        # Whether a thread is alive cannot be used instead: a thread that has
+        # found the work queue empty is still alive while exiting, but it will
+        # not take commands submitted meanwhile.
+        self.workers = 0
+        self.workers_lock = threading.Lock()
+
+    def _worker(self):
+        """
+        Core of the worker threads: perform commands until the work queue
+        becomes empty.
+        """
+        while True:
+            with self.workers_lock:
+                try:
+                    procid, instruction = self.work_queue.get_nowait()
+                except Queue.Empty:
+                    self.workers -= 1
+                    return
+            self._perform_one(procid, instruction)
+
+    def _perform_one(self, procid, instruction):
+        result, error = None, None
+        try:
+            result = instruction.perform(self.infraprocessor)
+        except KeyboardInterrupt:
+            log.debug('Operation cancelled.')
+        except Exception:
+            error = sys.exc_info()
+            log.debug('Command execution failed: %r', error[1])
+        self.result_queue.put((procid, result, error))
+
+    def _start_thread(self):
+        """
+        Start a worker thread. Must be called holding :attr:`workers_lock`.
+        """
+        self.workers += 1
+        thread = threading.Thread(
+            target=self._worker,
+            name='Worker-{0}'.format(len(self.threads)))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _start_threads(self):
+        """
+        Start worker threads as needed; but not more than ``max_threads``.
+        """
+        self.threads = [t for t in self.threads if t.is_alive()]
+        needed = len(self.pending)
+        if self.max_threads:
+            needed = min(self.max_threads, needed)
+        with self.workers_lock:
+            while self.workers < needed:
+                self._start_thread()
+
+    def _submit(self, instruction, index=None):
+        if index is None:
+            index = len(self.results)
+            self.results.append(None)
+        self.pending[index] = instruction
+        instruction.cancel_event = self.cancel_event
+        self.work_queue.put((index, instruction))
+        return index
+
+    def _command_finished(self, procid, error):
+        """
+        Called when a command has finished, before its result is processed.
+        Overridden in derived classes.
+        """
+        pass
+
+    def _process_one_result(self):
+        """
+        Wait and then process a command result.
+
+        :return: ``(procid, result)``; ``result`` is the exception itself in
+            case of a :exc:`~occo.exceptions.orchestration.MinorInfraProcessorError`.
+        """
+        log.debug('Waiting for a command to finish...')
+        while True:
+            try:
+                procid, result, error = \
+                    self.result_queue.get(timeout=self.poll_interval)
+            except Queue.Empty:
+                continue
+            break
+
+        log.debug('Result for command #%d has arrived', procid)
+        del self.pending[procid]
+        self._command_finished(procid, error)
+        if error:
+            if issubclass(error[0], MinorInfraProcessorError):
+                log.debug('IGNORING Minor IP error: %r', error[1])
+                return procid, error[1]
+            raise error[0], error[1], error[2]
+        self.results[procid] = result
+        return procid, result
+
+    def _perform_iter(self, infraprocessor, instruction_list):
+        self.infraprocessor = infraprocessor
+        self.cancel_event.clear()
+        self.work_queue = Queue.Queue()
+        self.result_queue = Queue.Queue()
+        self.results = list()
+        self.pending = dict()
+
+        for instruction in instruction_list:
+            self._submit(instruction)
+        self._start_threads()
+        log.debug('Performing %d commands using %d threads',
+                  len(self.pending), len(self.threads))
+
+        while self.pending:
+            yield self._process_one_result()
+
+        log.debug('All commands have finished.')
+        datalog.debug('Thread results: %r', self.results)
+
+    def _drain_work_queue(self):
+        """
+        Remove commands from the work queue that have not been started yet.
+        """
+        while True:
+            try:
+                procid, instruction = self.work_queue.get_nowait()
+            except Queue.Empty:
+                break
+            log.debug('Dropping unstarted command #%d', procid)
+            del self.pending[procid]
+
+    def cancel_pending(self, reason=None):
+        if not self.infraprocessor:
+            return
+        log.debug('Cancelling pending commands')
+
+        self._drain_work_queue()
+        self.cancel_event.set()
+
+        if isinstance(reason, NodeCreationError):
+            inst_data = reason.instance_data
+            log.debug('Undoing create node for %r', inst_data['node_id'])
+            self._submit(self.infraprocessor.cri_drop_node(inst_data))
+            # The existing threads may all be busy with cancelled commands;
+            # a dedicated thread starts undoing immediately.
+            with self.workers_lock:
+                self._start_thread()
+
+        log.debug('Waiting for running commands to finish')
+        while self.pending:
+            try:
+                self._process_one_result()
+            except KeyboardInterrupt:
+                log.info('Received Ctrl+C while waiting for threads '
+                         'to finish. Aborting.')
+                raise
+            except BaseException:
+                log.exception('IGNORING exception while waiting for threads:')
+
+@factory.register(Strategy, 'pipelined')
+class PipelinedStrategy(ThreadPoolStrategy):
+    """
+    Implements :class:`Strategy`, performing the commands phase by phase (see
+    :meth:`~occo.infraprocessor.Command.perform_phased`) using a pool of
+    threads.
+
+    When a command enters a phase that merely waits, the worker thread hands
+    it off and proceeds with the next command. Nodes waiting to become ready
+    are handed off to the
+    :class:`~occo.infraprocessor.synchronization.poller.ReadinessPoller` of
+    the infraprocessor, if it has one, or to a poller of the strategy
+    otherwise; so a single scheduling thread waits for all of them. Other
+    waiting phases are continued by a waiter thread. This way, the number of worker threads (``max_threads``)
+    limits only the commands actually working (e.g. provisioning nodes), and
+    waiting for the nodes overlaps.
+
+    Cancellation is cooperative, see :class:`ThreadPoolStrategy`; it applies
+    to both worker and waiter threads.
+    """
+    def __init__(self, max_threads=None, poll_interval=1):
+        super(PipelinedStrategy, self).__init__(max_threads, poll_interval)
+        self.waiters = list()
+        self.waiters_lock = threading.Lock()
+        self.default_poller = None
+
+    def _poller(self):
+        """
+        The poller of the infraprocessor; or the default poller of the
+        strategy, if the infraprocessor has none.
+        """
+        poller = getattr(self.infraprocessor, 'poller', None)
+        if poller:
+            return poller
+        from occo.infraprocessor.synchronization.poller import \
+            ReadinessPoller
+        with self.waiters_lock:
+            if not self.default_poller:
+                self.default_poller = ReadinessPoller(
+                    getattr(self.infraprocessor, 'poll_delay', 10))
+            return self.default_poller
+
+    def _perform_one(self, procid, instruction):
+        self._advance(procid, instruction.perform_phased(self.infraprocessor))
+
+    def _advance(self, procid, phases, step=None):
+        """
+        Perform the next phase of a command. If the command enters a waiting
+        phase, it is handed off; otherwise, the result is reported.
+
+        :param step: Resumes the command; by default ``phases.next``.
+        """
+        result, error = None, None
+        try:
+            phase = (step or phases.next)()
+        except Return as r:
+            result = r.value
+        except StopIteration:
+            pass
+        except KeyboardInterrupt:
+            log.debug('Operation cancelled.')
+        except Exception:
+            error = sys.exc_info()
+            log.debug('Command execution failed: %r', error[1])
+        else:
+            self._hand_off(procid, phase, phases)
+            return
+        self.result_queue.put((procid, result, error))
+
+    def _hand_off(self, procid, phase, phases):
+        from occo.infraprocessor.synchronization.poller import PendingNode
+
+        if isinstance(phase, PendingNode):
+            log.debug('Command #%d is waiting for node %r; handing off to '
+                      'the poller', procid, phase.node_id)
+            self._poller().watch(
+                phase, functools.partial(self._resume, procid, phases))
+        else:
+            log.debug('Command #%d entering phase %r; handing off to a waiter',
+                      procid, phase)
+            self._start_waiter(procid, phases)
+
+    def _resume(self, procid, phases, pending, exc_info):
+        """
+        Poller callback: continue the command with the outcome of waiting.
+        """
+        if exc_info:
+            step = functools.partial(phases.throw, *exc_info)
+        else:
+            step = functools.partial(phases.send, pending.ready)
+        self._start_waiter(procid, phases, step)
+
+    def _start_waiter(self, procid, phases, step=None):
+        # Called by both worker threads and poller callbacks
+        thread = threading.Thread(
+            target=self._advance, args=(procid, phases, step),
+            name='Waiter-{0}'.format(procid))
+        thread.daemon = True
+        with self.waiters_lock:
+            self.waiters = [t for t in self.waiters if t.is_alive()]
+            self.waiters.append(thread)
+        thread.start()
+
+    def cancel_pending(self, reason=None):
+        if not self.infraprocessor:
+            return
+        self.cancel_event.set()
+        self._poller().check_cancelled()
+        super(PipelinedStrategy, self).cancel_pending(reason)
+
+@factory.register(Strategy, 'coroutine')
+class CoroutineStrategy(Strategy):
+    """
+    Implements :class:`Strategy`, performing the commands as coroutines in a
+    single event loop (see :mod:`occo.infraprocessor.coroutine`).
+
+    Commands are performed through their
+    :meth:`~occo.infraprocessor.Command.perform_async` method. Blocking calls
+    are offloaded to a bounded set of threads; waiting for nodes to become
+    ready does not occupy any thread.
+
+    :param int max_threads: The maximum number of threads performing blocking
+        calls.
+    """
+    def __init__(self, max_threads=20):
+        self.max_threads = max_threads
+        self.infraprocessor = None
+        self.loop = None
+        self.results = list()
+
+    def _spawn(self, instruction):
+        index = len(self.results)
+        self.results.append(None)
+        task = self.loop.spawn(
+            instruction.perform_async(self.infraprocessor), index)
+        # Blocking calls performed on behalf of the command (e.g. the default
+        # perform_async) can only be cancelled cooperatively.
+        instruction.cancel_event = task.cancel_event
+        return index
+
+    def _process_one_result(self):
+        """
+        Run the event loop until a command finishes, and process its result.
+
+        :return: ``(index, result)``; ``result`` is the exception itself in
+            case of a :exc:`~occo.exceptions.orchestration.MinorInfraProcessorError`.
+        """
+        index, result, exc_info = self.loop.next_finished()
+        log.debug('Result for command #%d has arrived', index)
+        if exc_info:
+            if issubclass(exc_info[0], MinorInfraProcessorError):
+                log.debug('IGNORING Minor IP error: %r', exc_info[1])
+                return index, exc_info[1]
+            elif not issubclass(exc_info[0], KeyboardInterrupt):
+                raise exc_info[0], exc_info[1], exc_info[2]
+        self.results[index] = result
+        return index, result
+
+    def _has_pending(self):
+        return self.loop.tasks or self.loop.finished
+
+    def _perform_iter(self, infraprocessor, instruction_list):
+        self.infraprocessor = infraprocessor
+        self.loop = EventLoop(self.max_threads)
+        self.results = list()
+
+        for instruction in instruction_list:
+            self._spawn(instruction)
+        log.debug('Performing %d commands as coroutines', len(self.results))
+
+        while self._has_pending():
+            yield self._process_one_result()
+
+        self.loop.close()
+        log.debug('All commands have finished.')
+        datalog.debug('Coroutine results: %r', self.results)
+
+    def cancel_pending(self, reason=None):
+        if not self.loop:
+            return
+        log.debug('Cancelling pending coroutines')
+
+        self.loop.cancel_all()
+
+        if isinstance(reason, NodeCreationError):
+            inst_data = reason.instance_data
+            log.debug('Undoing create node for %r', inst_data['node_id'])
+            self._spawn(self.infraprocessor.cri_drop_node(inst_data))
+
+        log.debug('Waiting for coroutines to finish')
+        while self._has_pending():
+            try:
+                self._process_one_result()
+            except KeyboardInterrupt:
+                log.info('Received Ctrl+C while waiting for coroutines '
+                         'to finish. Aborting.')
+                raise
+            except BaseException:
+                log.exception(
+                    'IGNORING exception while waiting for coroutines:')
+        self.loop.close()
+
+@factory.register(Strategy, 'dag')
+class DependencyStrategy(ThreadPoolStrategy):
+    """
+    Implements :class:`Strategy`, performing a batch of commands that *may
+    depend on each other*.
+
+    The dependencies of each command are determined with
+    :meth:`~occo.infraprocessor.Command.prerequisites`. Commands are performed
+    in parallel by a pool of threads (see :class:`ThreadPoolStrategy`), each
+    command being started as soon as all of its prerequisites have finished.
+    This way, a whole deployment (infrastructure and nodes) can be pushed as a
+    single batch, without barriers between dependency levels.
+
+    A command is started even if one of its prerequisites has failed with a
+    :exc:`~occo.exceptions.orchestration.MinorInfraProcessorError`; any other
+    error aborts the batch.
+
+    :param int max_threads: The maximum number of threads performing commands
+        simultaneously. :data:`None` means no limit.
+    """
+
+    def _build_graph(self, instruction_list):
+        """
+        Determine the number of unfinished prerequisites of each command, and
+        the dependents of each command (by index).
+
+        :raises ValueError: if the dependencies are cyclic.
+        """
+        index_of = dict((id(cmd), i) for i, cmd in enumerate(instruction_list))
+        self.waiting_for = dict()
+        self.dependents = dict((i, list()) for i in index_of.itervalues())
+        for i, cmd in enumerate(instruction_list):
+            prereqs = set(index_of[id(p)]
+                          for p in cmd.prerequisites(instruction_list))
+            self.waiting_for[i] = len(prereqs)
+            for p in prereqs:
+                self.dependents[p].append(i)
+
+        # Kahn's algorithm, only to detect cycles
+        counts = dict(self.waiting_for)
+        ready = [i for i, c in counts.iteritems() if not c]
+        visited = 0
+        while ready:
+            i = ready.pop()
+            visited += 1
+            for d in self.dependents[i]:
+                counts[d] -= 1
+                if not counts[d]:
+                    ready.append(d)
+        if visited != len(instruction_list):
+            raise ValueError('Cyclic dependencies between commands')
+
+    def _command_finished(self, procid, error):
+        if self.cancel_event.is_set():
+            return
+        if error and not issubclass(error[0], MinorInfraProcessorError):
+            # The batch will be aborted; dependents must not be started.
+            return
+        for d in self.dependents.get(procid, list()):
+            self.waiting_for[d] -= 1
+            if not self.waiting_for[d]:
+                log.debug('Prerequisites of command #%d have finished', d)
+                self._submit(self.instructions[d], d)
+        self._start_threads()
+
+    def _perform_iter(self, infraprocessor, instruction_list):
+        self.instructions = list(instruction_list)
+        self._build_graph(self.instructions)
+
+        self.infraprocessor = infraprocessor
+        self.cancel_event.clear()
+        self.work_queue = Queue.Queue()
+        self.result_queue = Queue.Queue()
+        self.results = [None] * len(self.instructions)
+        self.pending = dict()
+
+        for i, instruction in enumerate(self.instructions):
+            if not self.waiting_for[i]:
+                self._submit(instruction, i)
+        self._start_threads()
+        log.debug('Performing %d commands, %d of them without prerequisites',
+                  len(self.instructions), len(self.pending))
+
+        while self.pending:
+            yield self._process_one_result()
+
+        log.debug('All commands have finished.')
+        datalog.debug('Thread results: %r', self.results)
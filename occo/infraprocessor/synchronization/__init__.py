@@ -23,28 +23,54 @@ definition can choose.
 
 """
 
-__all__ = ['wait_for_node', 'NodeSynchStrategy',
-           'node_synch_type', 'get_synch_strategy']
+__all__ = ['wait_for_node', 'wait_for_node_async', 'NodeSynchStrategy',
+           'node_synch_type', 'get_synch_strategy', 'forget_synch_strategy',
+           'PollingPolicy', 'get_polling_policy']
 
+import collections
 import logging
+import threading
 import occo.util as util
 from occo.exceptions.orchestration import *
 import occo.util.factory as factory
 import occo.constants.status as node_status
 import occo.infobroker
+from occo.infraprocessor.coroutine import Sleep, Blocking, Return
+from occo.infraprocessor.node_resolution import compile_template
+from occo.infraprocessor.synchronization.polling import \
+    PollingPolicy, get_polling_policy
+from occo.infraprocessor.synchronization.concurrency import \
+    default_pool, TaskTimeout
+from occo.infraprocessor.synchronization.callback import \
+    default_notifier, active_listener
 
 log = logging.getLogger('occo.infraprocessor.synchronization')
 ib = occo.infobroker.main_info_broker
 
 import time, datetime
-def sleep(timeout, cancel_event):
+def sleep(timeout, cancel_event, wakeup=None, cancel_check_interval=0.5):
     """
     Sleeps  until the timeout is reached, or until cancelled through
     :param:`cancel_event`.
+
+    If a ``wakeup`` event is specified, sleeping is also interrupted when it
+    is set (and it is cleared). The ``cancel_event`` is checked every
+    ``cancel_check_interval`` seconds in this case.
     """
-    if cancel_event:
+    if wakeup:
+        deadline = time.time() + timeout
+        while not wakeup.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            wakeup.wait(min(remaining, cancel_check_interval)
+                        if cancel_event else remaining)
+            if cancel_event and cancel_event.is_set():
+                return False
+        wakeup.clear()
+    elif cancel_event:
         cancel_event.wait(timeout=timeout)
-        if cancel_event.isset():
+        if cancel_event.is_set():
             return False
     else:
         time.sleep(timeout)
@@ -77,19 +103,73 @@ def node_synch_type(resolved_node_definition):
     log.debug('SynchStrategy protocol is %r (from %s)', key, src)
     return key
 
+#: The maximum number of strategy instances kept by
+#: :func:`get_synch_strategy`.
+STRATEGY_CACHE_SIZE = 1000
+
+_strategies = collections.OrderedDict()
+_strategies_lock = threading.Lock()
+
 def get_synch_strategy(instance_data):
+    """
+    Get the synchronization strategy of a node.
+
+    The strategy instance is reused for the same node, as long as its node
+    description and resolved node definition are unchanged; so state (e.g.
+    cached results of status components) is kept across polls. Strategy
+    instances dropped are released (:meth:`NodeSynchStrategy.release`).
+    """
+    node_id = instance_data['node_id']
     node_description = instance_data['node_description']
     resolved_node_definition = instance_data['resolved_node_definition']
+
+    with _strategies_lock:
+        strategy = _strategies.pop(node_id, None)
+        if strategy is not None \
+                and strategy.node_description == node_description \
+                and strategy.resolved_node_definition == \
+                    resolved_node_definition:
+            strategy.instance_data = instance_data
+            _strategies[node_id] = strategy
+            return strategy
+    if strategy is not None:
+        _release(strategy)
+
     synch_type = node_synch_type(resolved_node_definition)
     log.info('Synchronization strategy for node %r is %r.',
-             instance_data['node_id'], synch_type)
+             node_id, synch_type)
 
-    return NodeSynchStrategy.instantiate(
+    strategy = NodeSynchStrategy.instantiate(
         synch_type, node_description,
         resolved_node_definition, instance_data)
+    evicted = list()
+    with _strategies_lock:
+        _strategies[node_id] = strategy
+        while len(_strategies) > STRATEGY_CACHE_SIZE:
+            evicted.append(_strategies.popitem(last=False)[1])
+    for old in evicted:
+        _release(old)
+    return strategy
+
+def forget_synch_strategy(node_id):
+    """
+    Drop the strategy instance of a node kept by :func:`get_synch_strategy`.
+    """
+    with _strategies_lock:
+        strategy = _strategies.pop(node_id, None)
+    if strategy is not None:
+        _release(strategy)
+
+def _release(strategy):
+    try:
+        strategy.release()
+    except Exception:
+        log.exception('IGNORING exception while releasing the synch '
+                      'strategy of node %r:', strategy.node_id)
 
 def wait_for_node(instance_data,
-                  poll_delay=10, timeout=None, cancel_event=None):
+                  poll_delay=10, timeout=None, cancel_event=None,
+                  policy=None):
     """
     Wait for the creation of the node using the appropriate
     :class:`NodeSynchStrategy`.
@@ -97,48 +177,135 @@ def wait_for_node(instance_data,
     May raise an exception, if node creation fails (depending on synch type).
 
     :param instance_data: Instance information.
-    :param int poll_delay: Time (seconds) to wait between polls.
+    :param int poll_delay: Time (seconds) to wait between polls, unless a
+        polling policy is specified for the node (see
+        :func:`get_polling_policy`).
     :param int timeout: Timeout in seconds. If :data:`None` or 0, there will
-        be no timeout. This is approximate timeout, the actual timeout will
-        happen somwhere between ``(start+timeout)`` and
-        ``(start+timeout+poll_delay)``.
+        be no timeout. The last poll is performed at ``(start+timeout)``.
     :param cancel_event: The polling will be cancelled when this event is set.
     :type cancel_event: :class:`threading.Event`
+    :param policy: The polling policy to be used instead of the one
+        specified for the node.
+    :type policy: :class:`PollingPolicy`
+
+    :return: :data:`True` if the node has become ready; :data:`False` if
+        waiting has been cancelled through ``cancel_event``.
+
+    The node is polled immediately when it reports its readiness (see
+    :mod:`~occo.infraprocessor.synchronization.callback`).
+    """
+
+    node_id = instance_data['node_id']
+    finish_time = _start_waiting(node_id, timeout)
+    policy = policy or _get_policy(instance_data, poll_delay)
+    policy.start()
+
+    wakeup = threading.Event()
+    wake = lambda node_id: wakeup.set()
+    notifier = default_notifier()
+    notifier.subscribe(node_id, wake)
+    try:
+        attempt = 0
+        status = ib.get('node.state', instance_data)
+        while status != node_status.READY:
+            _check_pending(instance_data, status, timeout, finish_time)
+
+            delay = _next_delay(node_id, policy, attempt, finish_time)
+            if not sleep(delay, cancel_event, wakeup):
+                log.debug('Waiting for node %r has been cancelled.', node_id)
+                policy.abandoned()
+                return False
+            attempt += 1
+            status = ib.get('node.state', instance_data)
+    except:
+        policy.abandoned()
+        raise
+    finally:
+        notifier.unsubscribe(node_id, wake)
+
+    log.info('Node %r is ready.', node_id)
+    policy.ready()
+    return True
+
+def wait_for_node_async(instance_data, poll_delay=10, timeout=None,
+                        policy=None):
+    """
+    Coroutine version of :func:`wait_for_node`, see
+    :mod:`occo.infraprocessor.coroutine`.
+
+    Querying the state of the node is offloaded to a worker thread; the
+    coroutine is suspended between polls. Waiting is cancelled by cancelling
+    the task running the coroutine (:exc:`KeyboardInterrupt` is raised).
+
+    Returns :data:`True` (through :class:`~occo.infraprocessor.coroutine.Return`)
+    when the node has become ready.
     """
 
     node_id = instance_data['node_id']
+    finish_time = _start_waiting(node_id, timeout)
+    policy = policy or _get_policy(instance_data, poll_delay)
+    policy.start()
+
+    try:
+        attempt = 0
+        status = yield Blocking(ib.get, 'node.state', instance_data)
+        while status != node_status.READY:
+            _check_pending(instance_data, status, timeout, finish_time)
+
+            yield Sleep(_next_delay(node_id, policy, attempt, finish_time))
+            attempt += 1
+            status = yield Blocking(ib.get, 'node.state', instance_data)
+    except:
+        # Also on cancellation; the coroutine cannot be suspended anymore
+        policy.abandoned()
+        raise
+
+    log.info('Node %r is ready.', node_id)
+    yield Blocking(policy.ready)
+    raise Return(True)
 
+def _start_waiting(node_id, timeout):
+    """
+    Log the start of waiting for a node, and calculate the deadline.
+    """
     if timeout:
-        start_time = time.time()
-        finish_time = start_time + timeout
+        finish_time = time.time() + timeout
         log.info(('Waiting for node %r to become ready with '
                   '%d seconds timeout. Deadline: %s'),
                  node_id,
                  timeout,
                  datetime.datetime.fromtimestamp(finish_time).isoformat())
+        return finish_time
     else:
         log.info('Waiting for node %r to become ready. No timeout.', node_id)
+        return None
 
-    status = ib.get('node.state', instance_data)
-    while status != node_status.READY:
-        if timeout and time.time() > finish_time:
-            raise NodeCreationTimeOutError(
-                    instance_data=instance_data,
-                    reason=None,
-                    msg=('Timeout ({0}s) in node creation!'
-                         .format(timeout)))
-
-        if status in [node_status.SHUTDOWN, node_status.FAIL]:
-            raise NodeFailedError(instance_data, status)
-
-        log.debug('Node %r is not ready, waiting %r seconds.',
-                  node_id, poll_delay)
-        if not sleep(poll_delay, cancel_event):
-            log.debug('Waiting for node %r has been cancelled.', node_id)
-            return
-        status = ib.get('node.state', instance_data)
+def _get_policy(instance_data, poll_delay):
+    return get_polling_policy(
+        instance_data.get('resolved_node_definition', dict()), poll_delay,
+        instance_data.get('node_description', dict()).get('type'))
 
-    log.info('Node %r is ready.', node_id)
+def _next_delay(node_id, policy, attempt, finish_time):
+    """
+    Determine the time to wait before polling a pending node again.
+    """
+    delay = max(0, policy.next_poll(attempt, finish_time) - time.time())
+    log.debug('Node %r is not ready, waiting %.1f seconds.', node_id, delay)
+    return delay
+
+def _check_pending(instance_data, status, timeout, finish_time):
+    """
+    Check whether waiting for a node that is not ready yet must be aborted.
+    """
+    if timeout and time.time() > finish_time:
+        raise NodeCreationTimeOutError(
+                instance_data=instance_data,
+                reason=None,
+                msg=('Timeout ({0}s) in node creation!'
+                     .format(timeout)))
+
+    if status in [node_status.SHUTDOWN, node_status.FAIL]:
+        raise NodeFailedError(instance_data, status)
 
 class NodeSynchStrategy(factory.MultiBackend):
     """
@@ -184,6 +351,14 @@ class NodeSynchStrategy(factory.MultiBackend):
         """
         raise NotImplementedError()
 
+    def release(self):
+        """
+        Release the resources held by the strategy (e.g. connections to the
+        node). Called when the strategy instance is dropped by
+        :func:`get_synch_strategy`. By default, nothing is done.
+        """
+        pass
+
 from occo.infraprocessor.synchronization.primitives import *
 basic_status = StatusTag('Generic status information')
 
@@ -193,12 +368,27 @@ class BasicNodeSynchStrategy(CompositeStatus, NodeSynchStrategy):
     Default synchronization strategy. This strategy ensures the following
     properties of the node:
       - Network reachability (using ping)
-      - URLs available (using a HEAD request)
+      - URLs available (using HEAD requests, concurrently; each limited to
+        ``url_timeout`` seconds)
       - Availability of attributes
 
     Of these, only the node status is checked unconditionally. All others are
     parameterizable.
 
+    The checks are performed one after the other, unless ``concurrent: true``
+    is specified among the parameters; in which case they are performed
+    concurrently, each of them limited to ``component_timeout`` seconds (see
+    :class:`~occo.infraprocessor.synchronization.primitives.CompositeStatus`).
+
+    Checks that have passed are not repeated if ``sticky: true`` is
+    specified; or only after ``status_ttl`` seconds, if that is specified too.
+    Without ``sticky``, all results are reused for ``status_ttl`` seconds.
+    Available attributes are not queried again until the node has become
+    ready even without ``sticky`` (see :meth:`attributes_ready`). As strategy
+    instances are reused for the same node (see
+    :func:`get_synch_strategy`), this spares the checks that have already
+    passed while the node is being polled.
+
     .. todo:: synch_attrs is now a part of the node definition - it should be
         moved to be a parameter of this NodeSynchStrategy.
 
@@ -207,8 +397,15 @@ class BasicNodeSynchStrategy(CompositeStatus, NodeSynchStrategy):
 
     .. todo:: URLs available: the method should be parameterizable.
     """
+    #: Whether the node has been found ready (i.e. its creation has
+    #: finished).
+    created = False
+
     def is_ready(self):
-        return self.get_composite_status(basic_status)
+        ready = self.get_composite_status(basic_status)
+        if ready:
+            self.created = True
+        return ready
 
     def get_kwargs(self):
         """
@@ -224,26 +421,58 @@ class BasicNodeSynchStrategy(CompositeStatus, NodeSynchStrategy):
                 self.kwargs = dict()
         return self.kwargs
 
+    @property
+    def concurrent_status(self):
+        return self.get_kwargs().get('concurrent', False)
+
+    @property
+    def status_component_timeout(self):
+        return self.get_kwargs().get('component_timeout')
+
+    @property
+    def sticky_status(self):
+        return self.get_kwargs().get('sticky', False)
+
+    @property
+    def status_ttl(self):
+        return self.get_kwargs().get('status_ttl')
+
     def make_node_spec(self):
         return dict(infra_id=self.infra_id, node_id=self.node_id)
 
     def get_node_address(self):
         return ib.get('node.address', **self.make_node_spec())
 
-    def resolve_url(self, fmt):
+    def resolve_url(self, fmt, addr=None):
         """
         .. todo:: Document the data that can be used in the URL template.
+
+        :param str addr: The address of the node, if already known.
         """
         data = dict(
             node_id=self.instance_data['node_id'],
             ibget=ib.get,
             instance_data=self.instance_data,
             variables=self.node_description['variables'],
-            addr=self.get_node_address(),
+            addr=addr if addr is not None else self.get_node_address(),
         )
-        import jinja2
-        tmp = jinja2.Template(fmt)
-        return tmp.render(data)
+        return compile_template(fmt).render(data)
+
+    def resolve_urls(self):
+        """
+        Resolve the URLs to be checked. The resolved URLs are reused by
+        subsequent polls, until the address of the node changes.
+        """
+        fmts = self.get_kwargs().get('urls', list())
+        if not fmts:
+            return list()
+        addr = self.get_node_address()
+        cached = getattr(self, '_resolved_urls', None)
+        if cached and cached[0] == addr:
+            return cached[1]
+        urls = [self.resolve_url(fmt, addr) for fmt in fmts]
+        self._resolved_urls = (addr, urls)
+        return urls
 
     @status_component('Network reachability', basic_status)
     def reachable(self):
@@ -254,24 +483,56 @@ class BasicNodeSynchStrategy(CompositeStatus, NodeSynchStrategy):
             log.debug('Skipping.')
             return True
 
+    @property
+    def url_timeout(self):
+        return self.get_kwargs().get('url_timeout', 10)
+
+    def check_url(self, url):
+        log.debug('Checking URL availability: %r', url)
+        available = ib.get('synch.site_available', url,
+                           timeout=self.url_timeout)
+        if not available:
+            log.info('Site %r is still not available.', url)
+        else:
+            log.info('Site %r has become available.', url)
+        return available
+
     @status_component('URL Availability', basic_status)
     def urls_ready(self):
-        urls = self.get_kwargs().get('urls', list())
-        for fmt in urls:
-            url = self.resolve_url(fmt)
-            log.debug('Checking URL availability: %r', url)
-            available = ib.get('synch.site_available', url)
-            if not available:
-                log.info('Site %r is still not available.', url)
-                return False
-            else:
-                log.info('Site %r has become available.', url)
-
-        return True
+        """
+        Checks all URLs concurrently, each request limited to ``url_timeout``
+        seconds (default: 10). The URLs are checked in a pool separate from
+        the one used for the status components.
+        """
+        urls = self.resolve_urls()
+        if len(urls) < 2:
+            return all(self.check_url(url) for url in urls)
+
+        futures = default_pool('URLPool').map(self.check_url, urls)
+        # The requests themselves are limited; this is only a safety net
+        deadline = time.time() + 2 * self.url_timeout
+        ready = True
+        for url, future in zip(urls, futures):
+            try:
+                ready &= bool(
+                    future.result(max(0, deadline - time.time())))
+            except TaskTimeout:
+                log.info('Checking site %r has timed out.', url)
+                ready = False
+        return ready
 
     @status_component('Attribute Availability', basic_status)
     def attributes_ready(self):
         """
+        Attributes are queried in bulk (see
+        :meth:`~occo.infraprocessor.synchronization.primitives.SynchronizationProvider.node_attributes`).
+        While waiting for the creation of the node, or if ``sticky`` is
+        specified, attributes that have become available are not queried
+        again; or only after ``status_ttl`` seconds, if that is specified
+        too. Otherwise (e.g. health checks of a node already created), all
+        attributes are queried each time, so attributes that have
+        disappeared are noticed.
+
         .. todo:: Make this more flexible (check for specific values, match
             regex, etc.)
         """
@@ -281,19 +542,74 @@ class BasicNodeSynchStrategy(CompositeStatus, NodeSynchStrategy):
             return True
 
         node_id = self.node_id
+        remember = self.sticky_status or not self.created
+        known = self._available_attributes() if remember else dict()
+        missing = [attribute for attribute in synch_attrs
+                   if attribute not in known]
+        if missing:
+            log.debug('Checking attribute availability: %r.', missing)
+            available = ib.get('synch.node_attributes', node_id, missing)
+            if remember:
+                now = time.time()
+                known.update((attribute, now) for attribute in available)
+        else:
+            available = dict()
 
-        for attribute in synch_attrs:
-            log.debug('Checking attribute availability: %r.', attribute)
-            try:
-                value = ib.get('node.attribute', node_id, attribute)
-            except KeyError:
-                log.info(
-                    'Attribute %r is still unavailable (not found).', attribute)
-                return False
-            if value is None:
-                log.info(
-                    'Attribute %r is still unavailable (no value).', attribute)
-                return False
+        unavailable = [attribute for attribute in missing
+                       if attribute not in available]
+        if unavailable:
+            log.info('Attributes %r are still unavailable.', unavailable)
+            return False
 
         log.info('All attributes of node %r are available.', node_id)
         return True
+
+    def _available_attributes(self):
+        """
+        The attributes known to be available, mapped to the time they have
+        been seen; expired ones (see ``status_ttl``) are dropped.
+        """
+        if not hasattr(self, 'available_attrs'):
+            self.available_attrs = dict()
+        ttl = self.status_ttl
+        if ttl is not None:
+            now = time.time()
+            for attribute, seen in self.available_attrs.items():
+                if now - seen >= ttl:
+                    del self.available_attrs[attribute]
+        return self.available_attrs
+
+@factory.register(NodeSynchStrategy, 'callback')
+class CallbackSynchStrategy(BasicNodeSynchStrategy):
+    """
+    The node is ready when it has reported its readiness by calling back the
+    InfraProcessor (see
+    :mod:`~occo.infraprocessor.synchronization.callback`). The contextualization
+    of the node has to ``POST`` to
+    ``http://<host>:<port>/ready/<node_id>?token={{ readiness_token }}``.
+
+    The listener is configured and started by the InfraProcessor (see
+    :class:`~occo.plugins.infraprocessor.basic_infraprocessor.BasicInfraProcessor`).
+    If this process has no listener, the checks of
+    :class:`BasicNodeSynchStrategy` are performed instead.
+
+    Parameters (besides those of :class:`BasicNodeSynchStrategy`):
+
+      - ``fallback``: If :data:`True` (default), the checks of
+        :class:`BasicNodeSynchStrategy` are also performed, so a node
+        failing to call back is still detected as ready. The node is polled
+        every ``fallback_poll_delay`` seconds (default: 60), unless a
+        ``polling_policy`` is specified.
+    """
+    def is_ready(self):
+        if not active_listener():
+            log.debug('No readiness listener in this process; polling '
+                      'node %r instead.', self.node_id)
+            return super(CallbackSynchStrategy, self).is_ready()
+        kwargs = self.get_kwargs()
+        if default_notifier().is_notified(self.node_id):
+            log.debug('Node %r has called back.', self.node_id)
+            return True
+        if not kwargs.get('fallback', True):
+            return False
+        return super(CallbackSynchStrategy, self).is_ready()
@@ -0,0 +1,279 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+""" Push-based readiness notifications
+
+Instead of being polled until they become ready, nodes can report their
+readiness themselves: the contextualization of a node calls back a
+:class:`ReadinessListener` (a small HTTP server in the process of the
+InfraProcessor) when the node is ready:
+
+.. code-block:: bash
+
+    curl -X POST 'http://<infraprocessor-host>:<port>/ready/<node_id>?token=<token>'
+
+The token is a secret specific to the node (see
+:meth:`ReadinessNotifier.token`); it is available to the templates of node
+resolution as ``readiness_token``, so it can be passed to the node in its
+context. Notifications without a valid token are rejected.
+
+The listener passes the notification to a :class:`ReadinessNotifier`, which
+records it, and wakes up the parties waiting for the node (e.g.
+:func:`~occo.infraprocessor.synchronization.wait_for_node` or the
+:class:`~occo.infraprocessor.synchronization.poller.ReadinessPoller`)
+immediately, so readiness is noticed without waiting for the next poll.
+Notifications received before anyone waits for the node are kept.
+
+The listener is started explicitly (:func:`start_listener`), once, by the
+process owning the notifier. Other processes (e.g. forked workers of a
+process-based strategy) do not receive notifications; nodes waited for by
+them, as well as nodes waited for while no listener could be started, are
+synchronized by polling.
+"""
+
+__all__ = ['ReadinessNotifier', 'ReadinessListener', 'default_notifier',
+           'start_listener', 'stop_listener', 'active_listener',
+           'readiness_token', 'NOTIFICATION_PATH', 'DEFAULT_PORT']
+
+import BaseHTTPServer
+import collections
+import hashlib
+import hmac
+import logging
+import os
+import socket
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+log = logging.getLogger('occo.infraprocessor.synchronization.callback')
+
+#: The path prefix of readiness notifications; followed by the node id.
+NOTIFICATION_PATH = '/ready/'
+
+#: The default port of the listener.
+DEFAULT_PORT = 8089
+
+class ReadinessNotifier(object):
+    """
+    Records readiness notifications of nodes, and dispatches them to the
+    parties waiting for them.
+
+    :param int max_notifications: The number of notifications kept.
+    :param str secret: The secret the tokens of the nodes are derived from.
+        By default, a random one, generated for this notifier.
+    """
+    def __init__(self, max_notifications=10000, secret=None):
+        self.max_notifications = max_notifications
+        self.secret = secret or os.urandom(32)
+        self.lock = threading.Lock()
+        self.subscribers = dict()
+        self.notifications = collections.OrderedDict()
+
+    def token(self, node_id):
+        """
+        The token authenticating the notifications of a node.
+        """
+        return hmac.new(self.secret, unicode(node_id).encode('utf-8'),
+                        hashlib.sha256).hexdigest()
+
+    def verify(self, node_id, token):
+        return token is not None \
+            and hmac.compare_digest(self.token(node_id), str(token))
+
+    def subscribe(self, node_id, callback):
+        """
+        Call ``callback(node_id)`` when a notification arrives for the node.
+        The callback is called in the thread receiving the notification; it
+        must not block.
+        """
+        with self.lock:
+            self.subscribers.setdefault(node_id, list()).append(callback)
+
+    def unsubscribe(self, node_id, callback):
+        with self.lock:
+            callbacks = self.subscribers.get(node_id, list())
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.subscribers.pop(node_id, None)
+
+    def notify(self, node_id):
+        """
+        Record the readiness of a node, and wake up the parties waiting for
+        it.
+        """
+        log.info('Node %r has reported to be ready.', node_id)
+        with self.lock:
+            self.notifications.pop(node_id, None)
+            self.notifications[node_id] = time.time()
+            while len(self.notifications) > self.max_notifications:
+                self.notifications.popitem(last=False)
+            callbacks = list(self.subscribers.get(node_id, list()))
+        for callback in callbacks:
+            try:
+                callback(node_id)
+            except Exception:
+                log.exception('IGNORING exception in readiness callback:')
+
+    def is_notified(self, node_id):
+        with self.lock:
+            return node_id in self.notifications
+
+    def forget(self, node_id):
+        with self.lock:
+            self.notifications.pop(node_id, None)
+
+# Created on import, so processes forked later share its secret
+_default_notifier = ReadinessNotifier()
+
+def default_notifier():
+    """
+    Get the :class:`ReadinessNotifier` shared by the whole process.
+    """
+    return _default_notifier
+
+def readiness_token(node_id):
+    """
+    The token the node has to present when reporting its readiness.
+    """
+    return default_notifier().token(node_id)
+
+class NotificationHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        path, _, query = self.path.partition('?')
+        if not path.startswith(NOTIFICATION_PATH):
+            self.send_error(404)
+            return
+        node_id = urllib.unquote(path[len(NOTIFICATION_PATH):]).strip('/')
+        if not node_id:
+            self.send_error(400, 'Node id is missing')
+            return
+        token = urlparse.parse_qs(query).get('token', [None])[0]
+        if not self.server.notifier.verify(node_id, token):
+            log.warning('Rejecting readiness notification of node %r from '
+                        '%s: invalid token', node_id, self.client_address[0])
+            self.send_error(403)
+            return
+        self.server.notifier.notify(node_id)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, fmt, *args):
+        log.debug('%s - %s', self.client_address[0], fmt % args)
+
+class NotificationServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class ReadinessListener(object):
+    """
+    HTTP server receiving readiness notifications of nodes.
+
+    :param str host: The address to listen on.
+    :param int port: The port to listen on; 0 means any free port.
+    :param notifier: The notifier to pass the notifications to; by default,
+        the one shared by the process (:func:`default_notifier`).
+    :type notifier: :class:`ReadinessNotifier`
+
+    :raises socket.error: if the address cannot be bound.
+    """
+    def __init__(self, host, port=0, notifier=None):
+        self.notifier = notifier or default_notifier()
+        self.pid = os.getpid()
+        self.server = NotificationServer((host, port), NotificationHandler)
+        self.server.notifier = self.notifier
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='ReadinessListener')
+        self.thread.daemon = True
+        self.thread.start()
+        log.info('Listening for readiness notifications on port %d',
+                 self.port)
+        return self
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url_for(self, node_id, host):
+        """
+        The URL the node has to call back, including its token.
+
+        :param str host: The address of this host, as seen by the node.
+        """
+        return 'http://{0}:{1}{2}{3}?token={4}'.format(
+            host, self.port, NOTIFICATION_PATH, urllib.quote(node_id),
+            self.notifier.token(node_id))
+
+_listener = None
+_listener_lock = threading.Lock()
+
+def start_listener(host, port=DEFAULT_PORT, secret=None):
+    """
+    Start the :class:`ReadinessListener` of the process, unless it has
+    already been started.
+
+    :param str host: The address to listen on.
+    :param int port: The port to listen on.
+    :param str secret: The secret the tokens of the nodes are derived from
+        (see :class:`ReadinessNotifier`). Must be set before any token is
+        handed out.
+
+    :return: The listener; :data:`None` if it cannot be started (e.g. the
+        port is in use), in which case nodes are synchronized by polling.
+    """
+    global _listener
+    with _listener_lock:
+        if _listener and _listener.pid == os.getpid():
+            return _listener
+        if secret:
+            default_notifier().secret = secret
+        try:
+            _listener = ReadinessListener(host, port).start()
+        except socket.error:
+            log.exception('Cannot listen for readiness notifications on '
+                          '%s:%s; nodes will be polled instead:', host, port)
+            _listener = None
+        return _listener
+
+def stop_listener():
+    """
+    Shut down the :class:`ReadinessListener` of the process.
+    """
+    global _listener
+    with _listener_lock:
+        if _listener and _listener.pid == os.getpid():
+            _listener.shutdown()
+        _listener = None
+
+def active_listener():
+    """
+    Get the :class:`ReadinessListener` started by this process; :data:`None`
+    if there is none (e.g. in a forked process).
+    """
+    listener = _listener
+    if listener and listener.pid == os.getpid():
+        return listener
+    return None
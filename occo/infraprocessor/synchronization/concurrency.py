@@ -0,0 +1,262 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+""" Concurrent evaluation of synchronization checks
+
+Checks performed while synchronizing on nodes (pinging, HTTP requests,
+InfoBroker queries) mostly wait for I/O. This module provides a small thread
+pool (:class:`TaskPool`) to perform such checks concurrently, shared by the
+whole process (:func:`default_pool`).
+
+Threads cannot be interrupted: a check exceeding its timeout keeps running in
+the background, but its result is discarded.
+"""
+
+__all__ = ['TaskPool', 'Future', 'TaskTimeout', 'as_completed',
+           'default_pool']
+
+import logging
+import os
+import sys
+import threading
+import time
+import Queue
+
+log = logging.getLogger('occo.infraprocessor.synchronization.concurrency')
+
+class TaskTimeout(Exception):
+    """ Raised when the result of a task is not available in time. """
+    pass
+
+class Future(object):
+    """
+    The result of a task submitted to a :class:`TaskPool`.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._started = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = list()
+        self._start_callbacks = list()
+        self._result, self._exc_info = None, None
+        #: The time the task has started running at; :data:`None` while it
+        #: is waiting for a thread of the pool.
+        self.start_time = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def _start(self):
+        with self._lock:
+            self.start_time = time.time()
+            self._started.set()
+            callbacks, self._start_callbacks = self._start_callbacks, list()
+        for callback in callbacks:
+            callback(self)
+
+    def add_start_callback(self, callback):
+        """
+        Call ``callback(future)`` when the task has started running;
+        immediately, if it has already started.
+        """
+        with self._lock:
+            if not self._started.is_set():
+                self._start_callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, result, exc_info):
+        with self._lock:
+            self._result, self._exc_info = result, exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, list()
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Call ``callback(future)`` when the task has finished; immediately, if
+        it has already finished.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=None):
+        """
+        Wait for the result of the task. If the task has raised an exception,
+        it is re-raised.
+
+        :raises TaskTimeout: if the task has not finished in ``timeout``
+            seconds.
+        """
+        if not self._done.wait(timeout):
+            raise TaskTimeout('Task has not finished in {0}s'.format(timeout))
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def run_result(self, timeout, queue_timeout=None):
+        """
+        Wait for the result of the task, as :meth:`result` does; but
+        ``timeout`` is counted from the start of the task, not including the
+        time it has been waiting for a thread of the pool.
+
+        :raises TaskTimeout: also if the task has not started in
+            ``queue_timeout`` seconds (e.g. because the pool is exhausted).
+        """
+        if not self._started.wait(queue_timeout):
+            raise TaskTimeout(
+                'Task has not started in {0}s'.format(queue_timeout))
+        return self.result(max(0, self.start_time + timeout - time.time()))
+
+def as_completed(futures, timeout=None, task_timeout=None,
+                 queue_timeout=None):
+    """
+    Yield the futures as they finish.
+
+    :raises TaskTimeout: if not all futures have finished in ``timeout``
+        seconds; if any of them has been running for more than
+        ``task_timeout`` seconds (not including the time it has been waiting
+        for a thread of the pool); or if any of them has not started in
+        ``queue_timeout`` seconds.
+    """
+    events = Queue.Queue()
+    for future in futures:
+        future.add_done_callback(lambda f: events.put((True, f)))
+        if task_timeout is not None:
+            future.add_start_callback(lambda f: events.put((False, f)))
+    now = time.time()
+    deadline = now + timeout if timeout is not None else None
+    queue_deadline = now + queue_timeout if queue_timeout is not None \
+        else None
+    remaining = len(futures)
+    while remaining:
+        deadlines = [f.start_time + task_timeout for f in futures
+                     if task_timeout is not None
+                     and f.start_time is not None and not f.done()]
+        if deadline is not None:
+            deadlines.append(deadline)
+        if queue_deadline is not None \
+                and any(f.start_time is None for f in futures):
+            deadlines.append(queue_deadline)
+        wait = max(0, min(deadlines) - time.time()) if deadlines else None
+        try:
+            finished, future = events.get(timeout=wait) if wait is not None \
+                else events.get()
+        except Queue.Empty:
+            now = time.time()
+            if deadline is not None and deadline <= now:
+                raise TaskTimeout(
+                    '{0} tasks have not finished in {1}s'.format(
+                        remaining, timeout))
+            if queue_deadline is not None and queue_deadline <= now \
+                    and any(f.start_time is None for f in futures):
+                raise TaskTimeout(
+                    'Task has not started in {0}s'.format(queue_timeout))
+            raise TaskTimeout(
+                'Task has not finished in {0}s'.format(task_timeout))
+        if finished:
+            remaining -= 1
+            yield future
+
+class TaskPool(object):
+    """
+    A bounded pool of daemon threads performing tasks.
+
+    Threads are started on demand, when there is no idle thread to perform a
+    task; but not more than ``max_workers``.
+
+    :param int max_workers: The maximum number of threads.
+    """
+    def __init__(self, max_workers=20, name='TaskPool'):
+        self.max_workers = max_workers
+        self.name = name
+        self._reset()
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.threads = 0
+        self.idle = 0
+        self.queued = 0
+        self.pid = os.getpid()
+
+    def submit(self, fun, *args, **kwargs):
+        """
+        Perform ``fun(*args, **kwargs)`` in the pool.
+
+        :rtype: :class:`Future`
+        """
+        future = Future()
+        with self.lock:
+            if self.pid != os.getpid():
+                # Threads of the parent do not exist in a forked process
+                self._reset()
+            self.queue.put((future, fun, args, kwargs))
+            self.queued += 1
+            if self.queued > self.idle and self.threads < self.max_workers:
+                self.threads += 1
+                thread = threading.Thread(
+                    target=self._worker,
+                    name='{0}-{1}'.format(self.name, self.threads))
+                thread.daemon = True
+                thread.start()
+        return future
+
+    def map(self, fun, items):
+        """
+        Submit ``fun(item)`` for each item.
+
+        :return: The list of :class:`Future` objects.
+        """
+        return [self.submit(fun, item) for item in items]
+
+    def _worker(self):
+        # Blocking get() without timeout: an idle daemon thread must not wake
+        # up during interpreter shutdown, when module globals are cleared.
+        exc_info = sys.exc_info
+        while True:
+            with self.lock:
+                self.idle += 1
+            future, fun, args, kwargs = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+                self.queued -= 1
+
+            future._start()
+            try:
+                result = fun(*args, **kwargs)
+            except BaseException:
+                future._finish(None, exc_info())
+            else:
+                future._finish(result, None)
+
+_default_pools = dict()
+_default_pool_lock = threading.Lock()
+
+def default_pool(name='SynchPool'):
+    """
+    Get the :class:`TaskPool` shared by the whole process.
+
+    Tasks performed in a pool must not wait for other tasks of the same pool
+    (the pool may be exhausted by the waiting tasks); such tasks must use a
+    pool with a different ``name``.
+    """
+    with _default_pool_lock:
+        if name not in _default_pools:
+            _default_pools[name] = TaskPool(name=name)
+        return _default_pools[name]
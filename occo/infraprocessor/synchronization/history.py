@@ -0,0 +1,181 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+""" Persistent statistics of node time-to-ready
+
+Nodes of the same type, started on the same backend, take similar times to
+become ready. A :class:`ReadinessHistory` stores the number, the mean and the
+variance of these times (using Welford's online algorithm) per node type and
+backend in a small local YAML file. Waits that have ended without the node
+becoming ready (timeouts, failures and cancellations) are censored
+observations: they do not tell the time-to-ready, so they are only counted
+separately, and do not affect the mean and the variance. The
+:class:`~occo.infraprocessor.synchronization.polling.HistoryPollingPolicy`
+uses these statistics to poll a node around the time it is expected to
+become ready.
+
+The file may be shared by multiple processes: it is locked while being
+updated, and it is replaced atomically.
+"""
+
+__all__ = ['ReadinessHistory', 'get_history', 'history_key',
+           'DEFAULT_HISTORY_FILE']
+
+import errno
+import fcntl
+import logging
+import math
+import os
+import tempfile
+import threading
+import yaml
+
+log = logging.getLogger('occo.infraprocessor.synchronization.history')
+
+DEFAULT_HISTORY_FILE = '~/.occo/readiness_history.yaml'
+
+def history_key(resolved_node_definition, node_type=None):
+    """
+    Determine the key of the statistics a node belongs to.
+    """
+    return '{0}/{1}'.format(
+        node_type or resolved_node_definition.get('implementation_type'),
+        resolved_node_definition.get('backend_id'))
+
+class ReadinessHistory(object):
+    """
+    Time-to-ready statistics stored in a local file.
+
+    :param str path: The path of the file.
+    """
+    def __init__(self, path=DEFAULT_HISTORY_FILE):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        self.stats = dict()
+        self.mtime = None
+
+    def _load(self, force=False):
+        """
+        (Re)load the statistics if the file has changed since last read.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return
+        if mtime == self.mtime and not force:
+            return
+        with open(self.path) as f:
+            self.stats = yaml.safe_load(f) or dict()
+        self.mtime = mtime
+
+    def _save(self):
+        dirname = os.path.dirname(self.path)
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.history')
+        with os.fdopen(fd, 'w') as f:
+            yaml.safe_dump(self.stats, f, default_flow_style=False)
+        os.rename(tmpname, self.path)
+        self.mtime = os.stat(self.path).st_mtime
+
+    def _file_lock(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        return open(self.path + '.lock', 'a')
+
+    def estimate(self, key):
+        """
+        Get the statistics of a key.
+
+        :return: ``(count, mean, stddev)``, or :data:`None` if there are no
+            observations.
+        """
+        with self.lock:
+            try:
+                self._load()
+            except Exception:
+                log.exception('IGNORING error while reading %r:', self.path)
+            stats = self.stats.get(key)
+        if not stats or not stats['count']:
+            return None
+        count, mean, m2 = stats['count'], stats['mean'], stats['m2']
+        stddev = math.sqrt(m2 / (count - 1)) if count > 1 else 0.0
+        return count, mean, stddev
+
+    def _update(self, key, update):
+        """
+        Update the statistics of a key while holding the file lock.
+        """
+        with self.lock:
+            lockfile = self._file_lock()
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                self._load(force=True)
+                stats = self.stats.setdefault(
+                    key, dict(count=0, mean=0.0, m2=0.0))
+                update(stats)
+                self._save()
+            finally:
+                lockfile.close()
+            return dict(stats)
+
+    def record(self, key, seconds):
+        """
+        Add an observation to the statistics of a key.
+        """
+        def update(stats):
+            stats['count'] += 1
+            delta = seconds - stats['mean']
+            stats['mean'] += delta / stats['count']
+            stats['m2'] += delta * (seconds - stats['mean'])
+        stats = self._update(key, update)
+        log.debug('Time-to-ready of %r: %.1f seconds (mean: %.1f, n=%d)',
+                  key, seconds, stats['mean'], stats['count'])
+
+    def record_censored(self, key, seconds):
+        """
+        Count a wait that has ended after ``seconds`` without the node
+        becoming ready. The mean and the variance are not affected.
+        """
+        def update(stats):
+            stats['censored'] = stats.get('censored', 0) + 1
+        stats = self._update(key, update)
+        log.debug('Node %r has not become ready in %.1f seconds (censored: %d)',
+                  key, seconds, stats['censored'])
+
+    def censored(self, key):
+        """
+        Get the number of censored observations of a key.
+        """
+        with self.lock:
+            try:
+                self._load()
+            except Exception:
+                log.exception('IGNORING error while reading %r:', self.path)
+            return self.stats.get(key, dict()).get('censored', 0)
+
+_histories = dict()
+_histories_lock = threading.Lock()
+
+def get_history(path=DEFAULT_HISTORY_FILE):
+    """
+    Get the :class:`ReadinessHistory` shared by the whole process for the
+    given file.
+    """
+    path = os.path.expanduser(path)
+    with _histories_lock:
+        if path not in _histories:
+            _histories[path] = ReadinessHistory(path)
+        return _histories[path]
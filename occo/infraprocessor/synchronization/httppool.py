@@ -0,0 +1,95 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+""" Shared keep-alive HTTP connections for availability checks
+
+Checking the availability of a site with a fresh connection each time costs
+a TCP (and possibly a TLS) handshake per check. The session returned by
+:func:`http_session` keeps connections alive and reuses them across checks
+and threads. Each process has its own session, as connections cannot be
+shared with forked processes.
+
+The session is provided by ``requests`` (a dependency of ``OCCO-Util``). If
+it is not available, :func:`head` falls back to
+:func:`occo.util.do_request`.
+"""
+
+__all__ = ['http_session', 'head', 'POOL_SIZE']
+
+import logging
+import os
+import sys
+import threading
+from occo.exceptions import ConnectionError, HTTPTimeout
+
+log = logging.getLogger('occo.infraprocessor.synchronization.httppool')
+
+#: Number of connections kept alive per host.
+POOL_SIZE = 20
+
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+def http_session():
+    """
+    Get the HTTP session shared by the current process.
+
+    :return: A :class:`requests.Session`; :data:`None` if ``requests`` is not
+        available.
+    """
+    try:
+        import requests
+        import requests.adapters
+    except ImportError:
+        return None
+
+    pid = os.getpid()
+    with _sessions_lock:
+        session = _sessions.get(pid)
+        if session is None:
+            # Sessions of the parent process must not be used
+            _sessions.clear()
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[pid] = session
+        return session
+
+def head(url, timeout=None, **kwargs):
+    """
+    Check whether a URL is available, using a HEAD request.
+
+    :param float timeout: The timeout of the request in seconds.
+    :return: :data:`True` iff the request has succeeded.
+    :raises occo.exceptions.HTTPTimeout: if the request has timed out.
+    :raises occo.exceptions.ConnectionError: if the site cannot be accessed.
+    """
+    session = http_session()
+    if session is None:
+        import occo.util as util
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        return util.do_request(url, 'head', **kwargs).success
+
+    import requests
+    try:
+        response = session.head(url, timeout=timeout, **kwargs)
+    except requests.Timeout as ex:
+        raise HTTPTimeout, HTTPTimeout(str(ex)), sys.exc_info()[2]
+    except requests.RequestException as ex:
+        raise ConnectionError, ConnectionError(str(ex)), sys.exc_info()[2]
+    log.debug('HEAD %r: %d', url, response.status_code)
+    return response.ok
@@ -21,12 +21,45 @@ import occo.util as util
 import occo.infobroker as ib
 import occo.util.factory as factory
 import logging
+import socket
+import threading
 from occo.infraprocessor.synchronization import NodeSynchStrategy
+from occo.infraprocessor.synchronization.concurrency import \
+    default_pool, TaskTimeout
 
 log=logging.getLogger('occo.infraprocessor.synchronization')
 
 @factory.register(NodeSynchStrategy, 'mysql_server')
 class MysqlServerSynchStragegy(NodeSynchStrategy):
+    """
+    Checks whether the listed databases of a MySQL server are accessible.
+
+    Parameters (in ``synch_strategy``):
+
+      - ``databases``: List of databases (``name``, ``user``, ``pass``).
+      - ``port``: The port of the server (default: 3306).
+      - ``connect_timeout``: Timeout of each connection attempt in seconds
+        (default: 5).
+
+    Connecting to the databases is attempted only when the port of the server
+    is already open. The databases are probed concurrently. While the node is
+    not ready, connections are kept and reused (verified with a ping) by
+    subsequent polls, until the address of the node changes; the port is not
+    checked then, as MySQL counts each bare TCP connection as a connection
+    error, and blocks the host after ``max_connect_errors`` of them. The
+    connections are closed as soon as the node is ready, and when the
+    strategy is released.
+    """
+    def __init__(self, *args, **kwargs):
+        super(MysqlServerSynchStragegy, self).__init__(*args, **kwargs)
+        self.connections = dict()
+        self.connected_host = None
+        # Connections established after the kept ones have been closed (i.e.
+        # by probes timed out earlier) belong to an earlier generation, and
+        # are dropped.
+        self.generation = 0
+        self.connections_lock = threading.Lock()
+
     def get_node_address(self, infra_id, node_id):
         return ib.main_info_broker.get('node.address',
                                        infra_id=infra_id, node_id=node_id)
@@ -37,30 +70,128 @@ class MysqlServerSynchStragegy(NodeSynchStrategy):
             if isinstance(self.kwargs, basestring):
                 self.kwargs = dict()
         return self.kwargs
-    
-    def is_ready(self):
-    """
-    Method for checking mysql database availability.
-    """
+
+    @property
+    def port(self):
+        return self.get_kwargs().get('port', 3306)
+
+    @property
+    def connect_timeout(self):
+        return self.get_kwargs().get('connect_timeout', 5)
+
+    def connection_errors(self):
+        """
+        The exception(s) signalling that a database is not accessible.
+        """
         import MySQLdb
-        host = self.get_node_address(self.infra_id, self.node_id)
-        if not ib.main_info_broker.get('synch.node_reachable',
-                                       infra_id = self.infra_id,
-                                       node_id = self.node_id):
+        return MySQLdb.Error
+
+    def connect(self, host, db):
+        import MySQLdb
+        return MySQLdb.connect(
+            host=host, port=self.port, user=db.get('user'),
+            passwd=db.get('pass'), db=db.get('name'),
+            connect_timeout=self.connect_timeout)
+
+    def port_open(self, host):
+        """
+        Check whether the server accepts TCP connections.
+        """
+        try:
+            sock = socket.create_connection((host, self.port),
+                                            self.connect_timeout)
+        except (socket.error, socket.timeout) as ex:
+            log.debug('MySQL port %s:%s is not open: %s', host, self.port, ex)
             return False
+        sock.close()
+        return True
+
+    def close_connections(self):
+        with self.connections_lock:
+            connections, self.connections = self.connections, dict()
+            self.generation += 1
+        for conn in connections.itervalues():
+            self.close_connection(conn)
+
+    def close_connection(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def release(self):
+        self.close_connections()
+
+    def probe_database(self, host, db, generation):
+        """
+        Check whether a database is accessible, reusing the connection of
+        the previous poll if it is still alive.
+        """
+        key = (db.get('user'), db.get('name'))
+        errors = self.connection_errors()
+        with self.connections_lock:
+            conn = self.connections.get(key)
+        if conn is not None:
+            try:
+                conn.ping()
+                return True
+            except errors as e:
+                log.debug('Connection to %r lost: %s', db.get('name'), e)
+                with self.connections_lock:
+                    if self.connections.get(key) is conn:
+                        del self.connections[key]
         try:
-            dblist = self.get_kwargs().get('databases', list())
-            log.debug('Checking mysql database availability:')
-            for db in dblist:
-                conn = MySQLdb.connect(
-                    host, db.get('user'), db.get('pass'),
-                    db.get('name'))
-                conn.close()
-            log.debug('Connection successful')
-        except MySQLdb.Error as e:
-            log.debug('Connecton failed: %s',e)
+            conn = self.connect(host, db)
+        except errors as e:
+            log.debug('Connecton to %r failed: %s', db.get('name'), e)
             return False
+        with self.connections_lock:
+            current = self.generation == generation
+            if current:
+                self.connections[key] = conn
+        if not current:
+            log.debug('Dropping late connection to %r', db.get('name'))
+            self.close_connection(conn)
+            return False
+        log.debug('Connection to %r successful', db.get('name'))
         return True
 
+    def is_ready(self):
+        """
+        Method for checking mysql database availability.
+        """
+        host = self.get_node_address(self.infra_id, self.node_id)
+        if host != self.connected_host:
+            self.close_connections()
+            self.connected_host = host
+        if not host:
+            log.debug('Node %r has no address yet', self.node_id)
+            return False
+
+        # Live connections are verified by pinging them
+        if not self.connections and not self.port_open(host):
+            return False
+
+        ready = self.probe_databases(host)
+        if ready:
+            self.close_connections()
+        return ready
 
+    def probe_databases(self, host):
+        dblist = self.get_kwargs().get('databases', list())
+        log.debug('Checking mysql database availability:')
+        generation = self.generation
+        if len(dblist) < 2:
+            return all(self.probe_database(host, db, generation)
+                       for db in dblist)
 
+        futures = default_pool('MySQLPool').map(
+            lambda db: self.probe_database(host, db, generation), dblist)
+        ready = True
+        for db, future in zip(dblist, futures):
+            try:
+                ready &= future.result(2 * self.connect_timeout)
+            except TaskTimeout:
+                log.debug('Connection to %r timed out', db.get('name'))
+                ready = False
+        return ready
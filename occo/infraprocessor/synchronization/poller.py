@@ -0,0 +1,318 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+""" Centralized polling of pending nodes
+
+Instead of each node being polled by its own loop (see
+:func:`~occo.infraprocessor.synchronization.wait_for_node`), a
+:class:`ReadinessPoller` tracks all pending nodes of an InfraProcessor with
+their deadlines. A single thread selects the nodes due in each poll tick, and
+their states are queried concurrently by a bounded pool of threads
+(``max_parallel_queries``): a single query may take long, as it performs the
+synchronization checks of the node. The waiting parties are notified when a
+node becomes ready, fails, times out, or waiting for it is cancelled.
+
+The load on the InfoBroker can be kept flat by limiting the number of queries
+in a single tick (``max_queries_per_tick``); nodes exceeding this limit are
+polled in the next tick, ``tick_interval`` seconds later.
+
+Nodes reporting their readiness (see
+:mod:`~occo.infraprocessor.synchronization.callback`) are polled immediately.
+"""
+
+__all__ = ['PendingNode', 'ReadinessPoller']
+
+import logging
+import os
+import sys
+import threading
+import time
+import occo.infobroker
+import occo.constants.status as node_status
+from occo.infraprocessor.synchronization import _start_waiting, _check_pending
+from occo.infraprocessor.synchronization.polling import FixedPollingPolicy
+from occo.infraprocessor.synchronization.concurrency import TaskPool
+from occo.infraprocessor.synchronization.callback import default_notifier
+
+log = logging.getLogger('occo.infraprocessor.synchronization.poller')
+ib = occo.infobroker.main_info_broker
+
+class PendingNode(object):
+    """
+    A node waiting to become ready.
+
+    :param instance_data: Instance information.
+    :param int timeout: Timeout in seconds. If :data:`None` or 0, there will
+        be no timeout.
+    :param cancel_event: Waiting will be cancelled when this event is set.
+    :type cancel_event: :class:`threading.Event`
+    :param policy: The polling policy of the node. If unspecified, the node
+        is polled with the ``poll_delay`` of the poller.
+    :type policy: :class:`~occo.infraprocessor.synchronization.polling.PollingPolicy`
+
+    .. attribute:: ready
+
+        :data:`True` if the node has become ready; :data:`False` if waiting
+        has been cancelled. :data:`None` while the node is pending, or if
+        waiting has failed.
+    """
+    def __init__(self, instance_data, timeout=None, cancel_event=None,
+                 policy=None):
+        self.instance_data = instance_data
+        self.node_id = instance_data['node_id']
+        self.timeout = timeout
+        self.cancel_event = cancel_event
+        self.policy = policy
+        self.finish_time = None
+        self.next_poll = None
+        self.attempts = 0
+        self.callback = None
+        self.ready = None
+        self.polling = False
+        self.outcome_lock = threading.Lock()
+        self.outcome_recorded = False
+
+    def is_cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def record_outcome(self, ready):
+        """
+        Report the outcome of waiting to the polling policy of the node (if
+        any); only the first report counts.
+        """
+        with self.outcome_lock:
+            if self.outcome_recorded:
+                return
+            self.outcome_recorded = True
+        if self.policy:
+            if ready:
+                self.policy.ready()
+            else:
+                self.policy.abandoned()
+
+class ReadinessPoller(object):
+    """
+    Polls the state of all pending nodes.
+
+    The scheduling thread is started when the first node is watched, and it
+    exits when there are no more pending nodes. A node is polled by at most
+    one query at a time.
+
+    :param float poll_delay: Time (seconds) to wait between polling the same
+        node, unless the node has its own polling policy.
+    :param int max_queries_per_tick: The maximum number of nodes queried in
+        a single tick. :data:`None` means no limit.
+    :param float tick_interval: The minimum time (seconds) between two ticks
+        if ``max_queries_per_tick`` is specified.
+    :param float cancel_check_interval: Time (seconds) after which blocking
+        waiters (:meth:`wait`) check their ``cancel_event``.
+    :param int max_parallel_queries: The maximum number of nodes queried
+        simultaneously.
+    """
+    def __init__(self, poll_delay=10, max_queries_per_tick=None,
+                 tick_interval=1, cancel_check_interval=0.5,
+                 max_parallel_queries=20):
+        self.poll_delay = poll_delay
+        self.default_policy = FixedPollingPolicy(poll_delay)
+        self.max_queries_per_tick = max_queries_per_tick
+        self.tick_interval = tick_interval
+        self.cancel_check_interval = cancel_check_interval
+        self.pool = TaskPool(max_parallel_queries, name='ReadinessPoller')
+        self._reset()
+
+    def _reset(self):
+        self.lock = threading.Condition()
+        self.pending = dict()
+        self.thread = None
+        self.pid = os.getpid()
+
+    def _check_pid(self):
+        """
+        A forked process (e.g. a worker of a process-based strategy) must not
+        share the state of the poller of its parent.
+        """
+        if self.pid != os.getpid():
+            self._reset()
+
+    def watch(self, pending, callback):
+        """
+        Start watching a pending node.
+
+        :param pending: The node to be watched.
+        :type pending: :class:`PendingNode`
+        :param callback: Called as ``callback(pending, exc_info)`` in a
+            thread of the poller when waiting for the node has finished.
+            ``exc_info`` is :data:`None`, unless the node has failed or timed
+            out; see :attr:`PendingNode.ready` otherwise. The callback must
+            not block.
+        """
+        self._check_pid()
+        pending.callback = callback
+        pending.finish_time = _start_waiting(pending.node_id, pending.timeout)
+        pending.next_poll = time.time()
+        if pending.policy:
+            pending.policy.start(pending.next_poll)
+        default_notifier().subscribe(pending.node_id, self.wake)
+        with self.lock:
+            self.pending[pending.node_id] = pending
+            if not self.thread:
+                self.thread = threading.Thread(
+                    target=self._run, name='ReadinessPoller')
+                self.thread.daemon = True
+                self.thread.start()
+            self.lock.notify()
+
+    def unwatch(self, pending):
+        """
+        Stop watching a pending node. The callback will not be called.
+        """
+        default_notifier().unsubscribe(pending.node_id, self.wake)
+        with self.lock:
+            self.pending.pop(pending.node_id, None)
+
+    def wake(self, node_id):
+        """
+        Poll a node immediately, instead of in its next poll tick (e.g. when
+        the node has reported its readiness).
+        """
+        with self.lock:
+            pending = self.pending.get(node_id)
+            if pending:
+                pending.next_poll = 0
+                self.lock.notify()
+
+    def check_cancelled(self):
+        """
+        Make the poller notice cancelled nodes immediately, instead of in
+        their next poll tick.
+        """
+        with self.lock:
+            for pending in self.pending.itervalues():
+                if pending.is_cancelled():
+                    pending.next_poll = 0
+            self.lock.notify()
+
+    def wait(self, pending):
+        """
+        Wait for a node in the current thread, as
+        :func:`~occo.infraprocessor.synchronization.wait_for_node` does.
+
+        :return: :data:`True` if the node has become ready; :data:`False` if
+            waiting has been cancelled through the ``cancel_event`` of the
+            pending node.
+        """
+        done = threading.Event()
+        outcome = list()
+        def notify(pending, exc_info):
+            outcome.append(exc_info)
+            done.set()
+        self.watch(pending, notify)
+
+        while not done.wait(self.cancel_check_interval):
+            if pending.is_cancelled():
+                self.unwatch(pending)
+                pending.record_outcome(False)
+                log.debug('Waiting for node %r has been cancelled.',
+                          pending.node_id)
+                return False
+
+        exc_info = outcome[0]
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return pending.ready
+
+    def _due_nodes(self):
+        """
+        Wait until there are nodes to be polled. Must be called holding the
+        lock.
+
+        :return: The list of nodes to be polled; :data:`None` if there are no
+            pending nodes.
+        """
+        while self.pending:
+            now = time.time()
+            idle = [p for p in self.pending.itervalues() if not p.polling]
+            due = [p for p in idle if p.next_poll <= now]
+            if due:
+                due.sort(key=lambda p: p.next_poll)
+                if self.max_queries_per_tick:
+                    due = due[:self.max_queries_per_tick]
+                for pending in due:
+                    # Until the query sets the next poll; unless the node is
+                    # woken up meanwhile
+                    pending.polling = True
+                    pending.next_poll = float('inf')
+                return due
+            # If all nodes are being polled, the end of a query notifies
+            self.lock.wait(min(p.next_poll for p in idle) - now
+                           if idle else None)
+        return None
+
+    def _run(self):
+        while True:
+            with self.lock:
+                due = self._due_nodes()
+                if due is None:
+                    log.debug('No more pending nodes; poller exiting.')
+                    self.thread = None
+                    return
+            log.debug('Polling %d pending nodes', len(due))
+            tick_start = time.time()
+            for pending in due:
+                self.pool.submit(self._poll, pending)
+            if self.max_queries_per_tick:
+                # Spreading queries evenly in time
+                time.sleep(max(0, tick_start + self.tick_interval - time.time()))
+
+    def _poll(self, pending):
+        if pending.is_cancelled():
+            pending.ready = False
+            pending.record_outcome(False)
+            return self._finish(pending, None)
+
+        try:
+            status = ib.get('node.state', pending.instance_data)
+            if status == node_status.READY:
+                log.info('Node %r is ready.', pending.node_id)
+                pending.ready = True
+                pending.record_outcome(True)
+                return self._finish(pending, None)
+            _check_pending(pending.instance_data, status,
+                           pending.timeout, pending.finish_time)
+        except Exception:
+            exc_info = sys.exc_info()
+            pending.record_outcome(False)
+            return self._finish(pending, exc_info)
+
+        policy = pending.policy or self.default_policy
+        next_poll = policy.next_poll(pending.attempts, pending.finish_time)
+        pending.attempts += 1
+        log.debug('Node %r is not ready, polling again in %.1f seconds.',
+                  pending.node_id, next_poll - time.time())
+        with self.lock:
+            # The node may have been woken up while being polled
+            pending.next_poll = min(pending.next_poll, next_poll)
+            pending.polling = False
+            self.lock.notify()
+
+    def _finish(self, pending, exc_info):
+        default_notifier().unsubscribe(pending.node_id, self.wake)
+        with self.lock:
+            if self.pending.pop(pending.node_id, None) is None:
+                # Unwatched meanwhile
+                return
+        try:
+            pending.callback(pending, exc_info)
+        except Exception:
+            log.exception('IGNORING exception in poller callback:')
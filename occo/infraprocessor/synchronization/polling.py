@@ -0,0 +1,266 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+""" Policies determining when to poll a pending node
+
+A :class:`PollingPolicy` determines the delay between two polls of a node
+waiting to become ready. The policy can be specified in the node definition
+(``polling_policy``) or as a parameter of its ``synch_strategy``:
+
+.. code-block:: yaml
+
+    polling_policy:
+        protocol: backoff
+        initial_delay: 1
+        multiplier: 2
+        max_delay: 30
+        jitter: 0.1
+
+Regardless of the policy, the last poll is aligned to the deadline of the
+node (its ``create_timeout``), so a timeout is detected as soon as it happens.
+
+A policy instance belongs to a single node: waiting for the node is reported
+to the policy through :meth:`PollingPolicy.start`, :meth:`PollingPolicy.ready`
+and :meth:`PollingPolicy.abandoned`, so policies may learn from the history of
+similar nodes (see :class:`HistoryPollingPolicy`).
+"""
+
+__all__ = ['PollingPolicy', 'FixedPollingPolicy', 'BackoffPollingPolicy',
+           'HistoryPollingPolicy', 'get_polling_policy']
+
+import logging
+import random
+import time
+import occo.util.factory as factory
+from occo.infraprocessor.synchronization.history import \
+    get_history, history_key, DEFAULT_HISTORY_FILE
+from occo.infraprocessor.synchronization.callback import active_listener
+
+log = logging.getLogger('occo.infraprocessor.synchronization.polling')
+
+#: The default delay between polls of nodes reporting their readiness (see
+#: :mod:`~occo.infraprocessor.synchronization.callback`).
+CALLBACK_FALLBACK_DELAY = 60
+
+class PollingPolicy(factory.MultiBackend):
+    """
+    Abstract policy determining the delays between polling a pending node.
+    """
+    start_time = None
+
+    def for_node(self, resolved_node_definition, node_type=None):
+        """
+        Bind the policy to a node. Overridden in derived classes if
+        necessary.
+
+        :return: The policy itself, for convenience.
+        """
+        return self
+
+    def start(self, now=None):
+        """
+        Called when waiting for the node starts.
+        """
+        self.start_time = time.time() if now is None else now
+
+    def ready(self, now=None):
+        """
+        Called when the node has become ready. Overridden in derived classes
+        if necessary.
+        """
+        pass
+
+    def abandoned(self, now=None):
+        """
+        Called when waiting for the node has ended without the node becoming
+        ready (timeout, failure or cancellation). Overridden in derived
+        classes if necessary.
+        """
+        pass
+
+    def delay(self, attempt):
+        """
+        Overridden in derived classes, determines the number of seconds to
+        wait after the ``attempt``-th (starting from 0) unsuccessful poll.
+        """
+        raise NotImplementedError()
+
+    def poll_time(self, attempt, now):
+        """
+        Determine the time of the next poll regardless of the deadline. By
+        default, the next poll is performed after :meth:`delay`.
+        """
+        return now + max(0, self.delay(attempt))
+
+    def next_poll(self, attempt, finish_time=None, now=None):
+        """
+        Determine the time of the next poll after the ``attempt``-th
+        unsuccessful poll. The next poll never happens after the deadline:
+        the final poll is performed exactly at ``finish_time``.
+        """
+        if now is None:
+            now = time.time()
+        next_poll = self.poll_time(attempt, now)
+        if finish_time and next_poll > finish_time:
+            next_poll = max(now, finish_time)
+        return next_poll
+
+@factory.register(PollingPolicy, 'fixed')
+class FixedPollingPolicy(PollingPolicy):
+    """
+    Polls the node with a fixed delay. This is the default policy.
+
+    :param float poll_delay: Time (seconds) to wait between polls.
+    """
+    def __init__(self, poll_delay=10):
+        self.poll_delay = poll_delay
+
+    def delay(self, attempt):
+        return self.poll_delay
+
+@factory.register(PollingPolicy, 'backoff')
+class BackoffPollingPolicy(PollingPolicy):
+    """
+    Polls the node with exponentially increasing delays: fast-booting nodes
+    are detected early, while slow nodes are not polled needlessly often.
+
+    :param float initial_delay: The delay after the first poll.
+    :param float multiplier: The delay is multiplied by this after each poll.
+    :param float max_delay: The upper limit of the delay.
+    :param float jitter: The delay is randomized by this ratio (e.g. ``0.1``
+        means +/-10%), so nodes created together are not polled in lockstep.
+    """
+    def __init__(self, initial_delay=1, multiplier=2, max_delay=30,
+                 jitter=0.1):
+        self.initial_delay = initial_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        delay = min(self.max_delay,
+                    self.initial_delay * self.multiplier ** attempt)
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return delay
+
+@factory.register(PollingPolicy, 'history')
+class HistoryPollingPolicy(PollingPolicy):
+    """
+    Polls the node around the time it is expected to become ready, based on
+    the time-to-ready of previous nodes of the same type on the same backend
+    (see :mod:`~occo.infraprocessor.synchronization.history`).
+
+    Before the expected time window (``mean +/- spread * stddev``) the node
+    is not polled at all; within the window, it is polled densely; after the
+    window, the ``fallback`` policy is applied. The ``fallback`` policy is
+    used solely, until there are enough observations. Only nodes that have
+    become ready are observations; timeouts, failures and cancellations are
+    counted as censored.
+
+    :param str history_file: The file storing the statistics.
+    :param int min_samples: The number of observations needed to rely on the
+        statistics.
+    :param float spread: The half-width of the window in standard deviations.
+        The half-width is at least ``min_window`` times the mean.
+    :param float min_window: See ``spread``.
+    :param float dense_delay: The delay between polls within the window.
+    :param fallback: The configuration of the fallback policy.
+    """
+    def __init__(self, history_file=DEFAULT_HISTORY_FILE, min_samples=3,
+                 spread=2, min_window=0.1, dense_delay=1, fallback='backoff'):
+        self.history = get_history(history_file)
+        self.min_samples = min_samples
+        self.spread = spread
+        self.min_window = min_window
+        self.dense_delay = dense_delay
+        self.fallback = PollingPolicy.from_config(fallback)
+        self.key = None
+        self.estimate = None
+        self.late_attempts = 0
+
+    def for_node(self, resolved_node_definition, node_type=None):
+        self.key = history_key(resolved_node_definition, node_type)
+        return self
+
+    def start(self, now=None):
+        super(HistoryPollingPolicy, self).start(now)
+        self.fallback.start(now)
+        estimate = self.history.estimate(self.key)
+        if estimate and estimate[0] >= self.min_samples:
+            self.estimate = estimate
+            log.debug('Node %r is expected to be ready in %.1f seconds',
+                      self.key, estimate[1])
+
+    def ready(self, now=None):
+        self._record(self.history.record, now)
+
+    def abandoned(self, now=None):
+        self._record(self.history.record_censored, now)
+
+    def _record(self, record, now):
+        if self.start_time is None:
+            return
+        now = time.time() if now is None else now
+        elapsed, self.start_time = now - self.start_time, None
+        try:
+            record(self.key, elapsed)
+        except Exception:
+            log.exception('IGNORING error while recording time-to-ready:')
+
+    def poll_time(self, attempt, now):
+        if not self.estimate:
+            return self.fallback.poll_time(attempt, now)
+
+        count, mean, stddev = self.estimate
+        halfwidth = max(self.spread * stddev, self.min_window * mean)
+        window_start = self.start_time + max(0, mean - halfwidth)
+        window_end = self.start_time + mean + halfwidth
+        if now < window_start:
+            return window_start
+        elif now < window_end:
+            return now + self.dense_delay
+        else:
+            self.late_attempts += 1
+            return self.fallback.poll_time(self.late_attempts - 1, now)
+
+def get_polling_policy(resolved_node_definition, default_delay=10,
+                       node_type=None):
+    """
+    Instantiate the polling policy specified for a node.
+
+    The policy is looked up in the ``polling_policy`` of the node definition,
+    then in the ``polling_policy`` parameter of its ``synch_strategy``. If
+    neither is specified, a :class:`FixedPollingPolicy` is used with
+    ``default_delay``; or, for nodes using the ``callback`` synch strategy
+    while this process is listening for notifications, with its
+    ``fallback_poll_delay`` (default: :data:`CALLBACK_FALLBACK_DELAY`).
+
+    :param str node_type: The type of the node (as in the node description).
+    """
+    config = resolved_node_definition.get('polling_policy')
+    synchstrat = resolved_node_definition.get('synch_strategy')
+    if not isinstance(synchstrat, dict):
+        synchstrat = dict(protocol=synchstrat)
+    if not config:
+        config = synchstrat.get('polling_policy')
+    if not config:
+        if synchstrat.get('protocol') == 'callback' and active_listener():
+            # Polling is only a fallback for nodes calling back
+            default_delay = synchstrat.get('fallback_poll_delay',
+                                           CALLBACK_FALLBACK_DELAY)
+        return FixedPollingPolicy(default_delay)
+    log.debug('Polling policy: %r', config)
+    return PollingPolicy.from_config(config).for_node(
+        resolved_node_definition, node_type)
@@ -33,6 +33,12 @@ import occo.util as util
 import occo.infobroker as ib
 from occo.exceptions import ConnectionError, HTTPTimeout, HTTPError
 import occo.constants.status as node_status
+from .concurrency import default_pool, as_completed, TaskTimeout
+from .probe import default_batcher
+from . import httppool
+import time
+import threading
+import collections
 
 log = logging.getLogger('occo.infraprocessor.synchronization')
 
@@ -42,6 +48,24 @@ DUMMY_REPORT = dict(
     DUMMY_REPORT=True,
 )
 
+class _AllReachable(dict):
+    """ Reports any address reachable; the result of dry runs. """
+    def __missing__(self, address):
+        return True
+    def get(self, address, default=None):
+        return True
+
+ALL_REACHABLE = _AllReachable()
+
+#: The number of removed nodes remembered for incremental status reports.
+REMOVED_NODES_KEPT = 1000
+#: Cached node reports not used for this many seconds (e.g. of deleted
+#: infrastructures) are dropped.
+NODE_REPORT_MAX_IDLE = 3600
+
+_report_cache_init_lock = threading.Lock()
+_status_cache_init_lock = threading.Lock()
+
 def format_bool(b):
     return 'READY' if b else 'PENDING'
 
@@ -73,11 +97,81 @@ class status_component(object):
         return fun
 
 class CompositeStatus(object):
-    """Represents a composite status. """
+    """Represents a composite status.
+
+    By default, status components are evaluated one after the other. If
+    :attr:`concurrent_status` is set, all components of a tag are evaluated
+    concurrently (using
+    :func:`~occo.infraprocessor.synchronization.concurrency.default_pool`),
+    so the evaluation takes as long as the slowest component, instead of the
+    sum of them. A component not finishing in
+    :attr:`status_component_timeout` seconds (counted from when it starts
+    running in the pool) is considered to be pending; so is a component not
+    started in :attr:`status_queue_timeout` seconds (by default,
+    :attr:`status_component_timeout`), e.g. because the pool is exhausted by
+    hanging checks.
+
+    Results of components can be reused by subsequent evaluations of the same
+    object (components taking no arguments only):
+
+      - If :attr:`sticky_status` is set, a component that has passed is not
+        evaluated again; or only after :attr:`status_ttl` seconds, if that is
+        set too.
+      - Otherwise, if :attr:`status_ttl` is set, any result is reused for
+        :attr:`status_ttl` seconds.
+    """
+    concurrent_status = False
+    status_component_timeout = None
+    status_queue_timeout = None
+    sticky_status = False
+    status_ttl = None
+
+    def _status_cache(self):
+        # Called concurrently by the threads of the pool
+        with _status_cache_init_lock:
+            if not hasattr(self, '_status_results'):
+                self._status_results = dict()
+        return self._status_results
+
+    def _cached_status(self, item):
+        entry = self._status_cache().get(item)
+        if not entry:
+            return None
+        value, timestamp = entry
+        if self.status_ttl is not None \
+                and time.time() - timestamp >= self.status_ttl:
+            return None
+        if self.sticky_status and not value:
+            return None
+        return value,
+
+    def _evaluate(self, item, args, kwargs):
+        """
+        Evaluate a status component, reusing its cached result if possible.
+        """
+        cacheable = (self.sticky_status or self.status_ttl is not None) \
+            and not args and not kwargs
+        if cacheable:
+            cached = self._cached_status(item)
+            if cached:
+                log.debug('    %s => %s (cached)',
+                          item.desc, format_bool(cached[0]))
+                return cached[0]
+
+        value = item.evaluate(self, *args, **kwargs)
+        if cacheable:
+            self._status_cache()[item] = (value, time.time())
+        return value
+
     def get_composite_status(self, tag, lazy=True, *args, **kwargs):
         log.debug('Evaluating status of %r', tag.name)
 
-        results = (item.evaluate(self, *args, **kwargs) for item in tag.items)
+        if self.concurrent_status:
+            status = self._concurrent_status(tag, lazy, args, kwargs)
+            log.info('Status of %r: %s', tag.name, format_bool(status))
+            return status
+
+        results = (self._evaluate(item, args, kwargs) for item in tag.items)
         if not lazy:
             # list() force-evaluates all items
             results = list(results)
@@ -89,14 +183,75 @@ class CompositeStatus(object):
 
     def get_detailed_status(self, tag, *args, **kwargs):
         log.debug('Evaluating status of %r', tag.name)
-        return list(item.evaluate(self, *args, **kwargs) for item in tag.items)
+        if self.concurrent_status:
+            return self._concurrent_results(tag, args, kwargs)
+        return list(self._evaluate(item, args, kwargs) for item in tag.items)
 
     def get_report(self, tag, *args, **kwargs):
         log.debug('Evaluating status of %r', tag.name)
-        return list((item.desc,
-                     item.evaluate(self, *args, **kwargs))
+        if self.concurrent_status:
+            return zip((item.desc for item in tag.items),
+                       self._concurrent_results(tag, args, kwargs))
+        return list((item.desc, self._evaluate(item, args, kwargs))
                     for item in tag.items)
 
+    def _component_timeouts(self):
+        """
+        :return: ``(timeout, queue_timeout)`` of the components; both
+            :data:`None` if components have no timeout.
+        """
+        timeout = self.status_component_timeout or None
+        if timeout is None:
+            return None, None
+        queue_timeout = self.status_queue_timeout
+        return timeout, timeout if queue_timeout is None else queue_timeout
+
+    def _submit_items(self, tag, args, kwargs):
+        pool = default_pool()
+        return [pool.submit(self._evaluate, item, args, kwargs)
+                for item in tag.items]
+
+    def _concurrent_results(self, tag, args, kwargs):
+        """
+        Evaluate all components concurrently. A timed out component is
+        considered to be pending. If any of the components raises an
+        exception, the first one (in the order of the components) is
+        re-raised.
+        """
+        futures = self._submit_items(tag, args, kwargs)
+        timeout, queue_timeout = self._component_timeouts()
+        queue_deadline = time.time() + queue_timeout if timeout else None
+        results = list()
+        for item, future in zip(tag.items, futures):
+            try:
+                results.append(
+                    future.run_result(
+                        timeout, max(0, queue_deadline - time.time()))
+                    if timeout else future.result())
+            except TaskTimeout:
+                log.warning('    %s => TIMEOUT (%ss)',
+                            item.desc, self.status_component_timeout)
+                results.append(False)
+        return results
+
+    def _concurrent_status(self, tag, lazy, args, kwargs):
+        if not lazy:
+            return all(self._concurrent_results(tag, args, kwargs))
+
+        # Lazy: the status is known to be pending as soon as any of the
+        # components is pending; the rest need not be waited for.
+        futures = self._submit_items(tag, args, kwargs)
+        timeout, queue_timeout = self._component_timeouts()
+        try:
+            for future in as_completed(futures, task_timeout=timeout,
+                                       queue_timeout=queue_timeout):
+                if not future.result():
+                    return False
+        except TaskTimeout as ex:
+            log.warning('    %s', ex)
+            return False
+        return True
+
 @ib.provider
 class SynchronizationProvider(ib.InfoProvider):
     @ib.provides('node.address')
@@ -109,31 +264,71 @@ class SynchronizationProvider(ib.InfoProvider):
     @ib.provides('node.network_reachable')
     @util.wet_method(True)
     def reachable(self, **node_spec):
+        """
+        Probe the node in-process (see :mod:`.probe`). Nodes probed
+        concurrently are probed in a single pass.
+        """
         addr = ib.main_info_broker.get('node.address', **node_spec)
-        try:
-            retval, out, err = \
-                util.basic_run_process(
-                    'ping -c 1 -W 1 {addr}'.format(addr=addr))
-        except Exception:
-            log.exception('Process execution failed:')
-            raise
-        else:
-            log.debug('Process STDOUT:\n%s', out)
-            log.debug('Process STDERR:\n%s', err)
-            log.debug('Process exit code: %d', retval)
-            return (retval == 0)
+        return default_batcher().probe(addr)
+
+    @ib.provides('synch.addresses_reachable')
+    @util.wet_method(ALL_REACHABLE)
+    def addresses_reachable(self, addresses):
+        """
+        Probe multiple addresses in a single pass.
+
+        :return: A dictionary mapping each address to its reachability.
+        """
+        return default_batcher().engine.probe_many(addresses)
 
     @ib.provides('synch.site_available')
     @util.wet_method(True)
     def site_available(self, url, **kwargs):
+        """
+        Check the availability of a site using a HEAD request. Connections
+        are kept alive and shared across checks (see
+        :mod:`~occo.infraprocessor.synchronization.httppool`).
+
+        :param float timeout: The timeout of the request in seconds.
+        """
         try:
             log.debug('Checking site availability: %r', url)
-            response = util.do_request(url, 'head', **kwargs)
+            return httppool.head(url, **kwargs)
         except (ConnectionError, HTTPTimeout, HTTPError) as ex:
             log.warning('Error accessing [%s]: %s', url, ex)
             return False
-        else:
-            return response.success
+
+    @ib.provides('synch.node_attributes')
+    def node_attributes(self, node_id, attributes):
+        """
+        Query multiple attributes of a node.
+
+        If a bulk ``node.attributes`` query is provided (e.g. by the service
+        composer), all attributes are queried in a single call; otherwise,
+        they are queried one by one through ``node.attribute``, stopping at
+        the first unavailable one. The bulk query is expected to return a
+        dictionary of the attributes found, omitting the missing ones.
+
+        :return: A dictionary containing the available attributes (neither
+            missing nor :data:`None`). Without a bulk query, attributes
+            following the first unavailable one are omitted too.
+        """
+        mib = ib.main_info_broker
+        try:
+            values = mib.get('node.attributes', node_id, list(attributes))
+        except KeyError:
+            # No bulk query is available
+            values = dict()
+            for attribute in attributes:
+                try:
+                    value = mib.get('node.attribute', node_id, attribute)
+                except KeyError:
+                    break
+                if value is None:
+                    break
+                values[attribute] = value
+        return dict((k, v) for k, v in values.iteritems()
+                    if k in attributes and v is not None)
 
     @ib.provides('node.state_report')
     @util.wet_method(DUMMY_REPORT)
@@ -146,21 +341,128 @@ class SynchronizationProvider(ib.InfoProvider):
             ready=all(r[1] for r in report),
             details=report)
 
-    def _get_instance_reports(self, instances):
-        return util.dict_map(instances, self.node_state_report)
+    def _report_cache(self):
+        # Called concurrently by the threads of the report pool
+        with _report_cache_init_lock:
+            if not hasattr(self, 'report_lock'):
+                self.report_version = 0
+                self.node_reports = dict()
+                self.removed_nodes = collections.OrderedDict()
+                self.report_lock = threading.Lock()
+        return self.report_lock
+
+    def _cached_node_report(self, instance_data, max_age):
+        """
+        Get the report of a node, reusing the cached one if it is younger
+        than ``max_age`` seconds.
+
+        :return: ``(report, version)``, where ``version`` is the report
+            version in which the report of the node has last changed.
+        """
+        node_id = instance_data['node_id']
+        lock = self._report_cache()
+        with lock:
+            entry = self.node_reports.get(node_id)
+            if entry:
+                entry['used'] = time.time()
+        if entry and max_age is not None \
+                and time.time() - entry['time'] < max_age:
+            return entry['report'], entry['version']
+
+        report = self.node_state_report(instance_data)
+        with lock:
+            entry = self.node_reports.get(node_id)
+            if not entry or entry['report'] != report:
+                self.report_version += 1
+                entry = dict(version=self.report_version)
+            now = time.time()
+            entry.update(report=report, time=now, used=now,
+                         infra_id=instance_data['infra_id'])
+            self.node_reports[node_id] = entry
+        return report, entry['version']
+
+    def _forget_removed_nodes(self, infra_id, node_ids):
+        """
+        Forget the nodes of the infrastructure not in ``node_ids``, and the
+        reports not used for :data:`NODE_REPORT_MAX_IDLE` seconds.
+
+        :return: The version in which the last node of the infrastructure
+            has been removed (0 if none).
+        """
+        with self._report_cache():
+            removed = [node_id
+                       for node_id, entry in self.node_reports.iteritems()
+                       if entry['infra_id'] == infra_id
+                       and node_id not in node_ids]
+            if removed:
+                self.report_version += 1
+            for node_id in removed:
+                del self.node_reports[node_id]
+                self.removed_nodes[node_id] = (infra_id, self.report_version)
+            while len(self.removed_nodes) > REMOVED_NODES_KEPT:
+                self.removed_nodes.popitem(last=False)
+
+            idle_since = time.time() - NODE_REPORT_MAX_IDLE
+            for node_id in [node_id
+                            for node_id, entry in self.node_reports.iteritems()
+                            if entry['used'] < idle_since]:
+                del self.node_reports[node_id]
+
+            return max([v for i, v in self.removed_nodes.itervalues()
+                        if i == infra_id] or [0])
 
     @ib.provides('infrastructure.state_report')
     @util.wet_method(DUMMY_REPORT)
-    def infra_state_report(self, infra_id):
+    def infra_state_report(self, infra_id, since=None, max_age=None):
+        """
+        Generate the status report of all nodes of an infrastructure. The
+        nodes are checked concurrently (in a pool of bounded size).
+
+        :param int since: A ``version`` returned by a previous report. If
+            specified, only the nodes whose report has changed since are
+            included in ``details``; nodes removed since are listed in
+            ``removed``. ``ready`` always reflects the whole infrastructure.
+        :param float max_age: Node reports generated within this many seconds
+            are reused instead of checking the node again.
+        """
         log.debug('Acquiring detailed infrastructure status report')
         dynamic_state = \
             ib.main_info_broker.get('infrastructure.state', infra_id)
 
-        details = util.dict_map(dynamic_state, self._get_instance_reports)
-        ready = all(i['ready']
-                    for j in details.itervalues()
-                    for i in j.itervalues())
-        return dict(details=details, ready=ready)
+        instances = [(node_name, node_id, instance_data)
+                     for node_name, nodes in dynamic_state.iteritems()
+                     for node_id, instance_data in nodes.iteritems()]
+        pool = default_pool('ReportPool')
+        futures = [pool.submit(self._cached_node_report, instance_data,
+                               max_age)
+                   for _, _, instance_data in instances]
+
+        details = dict((node_name, dict()) for node_name in dynamic_state)
+        ready = True
+        # The version of the report is that of the latest change included,
+        # not the global one: changes made meanwhile by concurrent reports
+        # must be included in the next incremental report.
+        versions = [since or 0]
+        for (node_name, node_id, _), future in zip(instances, futures):
+            report, version = future.result()
+            versions.append(version)
+            ready = ready and report['ready']
+            if since is None or version > since:
+                details[node_name][node_id] = report
+
+        versions.append(self._forget_removed_nodes(
+            infra_id, set(node_id for _, node_id, _ in instances)))
+        version = max(versions)
+        result = dict(details=details, ready=ready, version=version)
+        if since is not None:
+            result['details'] = dict((k, v) for k, v in details.iteritems()
+                                     if v)
+            with self._report_cache():
+                result['removed'] = [
+                    node_id
+                    for node_id, (i, v) in self.removed_nodes.iteritems()
+                    if i == infra_id and v > since]
+        return result
 
     @ib.provides('node.service_health_check.state')
     @util.wet_method('READY')
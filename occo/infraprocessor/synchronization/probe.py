@@ -0,0 +1,331 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+""" In-process network reachability probes
+
+Checking the reachability of nodes by running ``ping`` for each of them costs
+a fork/exec per probe. The :class:`ProbeEngine` probes many addresses in a
+single pass, from the current process:
+
+- Using ICMP echo requests, where permitted (a raw socket needs privileges;
+  an unprivileged ICMP socket needs ``net.ipv4.ping_group_range`` to include
+  the group of the process on Linux).
+- Using TCP connection attempts to well-known ports otherwise, and for hosts
+  not responding to ICMP. A refused connection also proves that the host is
+  reachable.
+
+Identical addresses (also different names of the same address) are probed
+only once. The :class:`ProbeBatcher` gathers probes requested concurrently by
+different threads (e.g. nodes being polled at the same time) into a single
+pass of the engine.
+
+Only IPv4 is supported.
+"""
+
+__all__ = ['ProbeEngine', 'ProbeBatcher', 'default_batcher']
+
+import errno
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+log = logging.getLogger('occo.infraprocessor.synchronization.probe')
+
+ICMP_ECHO_REQUEST, ICMP_ECHO_REPLY = 8, 0
+
+def _checksum(data):
+    if len(data) % 2:
+        data += '\0'
+    total = sum(struct.unpack('!{0}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def _echo_request(ident, seq):
+    payload = 'occo-probe'
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = _checksum(header + payload)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq) \
+        + payload
+
+def _icmp_socket():
+    """
+    Open an ICMP socket, if permitted.
+
+    :return: ``(socket, socket_type)``; ``(None, None)`` if ICMP is not
+        permitted.
+    """
+    for socktype in (socket.SOCK_RAW, socket.SOCK_DGRAM):
+        try:
+            return socket.socket(
+                socket.AF_INET, socktype, socket.IPPROTO_ICMP), socktype
+        except socket.error:
+            continue
+    return None, None
+
+def _wait_writable(sockets, timeout):
+    """
+    Wait until any of the sockets become writable (i.e. connected or
+    failed).
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        by_fd = dict()
+        for s in sockets:
+            poller.register(s, select.POLLOUT)
+            by_fd[s.fileno()] = s
+        return [by_fd[fd] for fd, event in poller.poll(timeout * 1000)]
+    else:
+        return select.select([], sockets, [], timeout)[1]
+
+class ProbeEngine(object):
+    """
+    Probes the reachability of many addresses in a single pass.
+
+    :param float timeout: The time (seconds) to wait for responses in each of
+        the ICMP and the TCP passes.
+    :param list tcp_ports: The ports tried by the TCP pass. An empty list
+        disables the TCP pass.
+    :param bool use_icmp: Whether to try ICMP at all.
+    :param int max_connections: The maximum number of TCP connection
+        attempts (i.e. sockets) in progress at a time.
+    """
+    def __init__(self, timeout=1, tcp_ports=(22, 80, 443), use_icmp=True,
+                 max_connections=256):
+        self.timeout = timeout
+        self.tcp_ports = list(tcp_ports)
+        self.use_icmp = use_icmp
+        self.max_connections = max_connections
+
+    def probe(self, address):
+        return self.probe_many([address])[address]
+
+    def probe_many(self, addresses):
+        """
+        Probe the given addresses (host names or IPv4 addresses).
+
+        :return: A dictionary mapping each address to :data:`True` iff it is
+            reachable. Invalid addresses (e.g. :data:`None`) are unreachable.
+        """
+        results = dict.fromkeys(addresses, False)
+        ips = dict()
+        for address in results:
+            try:
+                ip = socket.gethostbyname(address)
+            except (socket.error, TypeError, UnicodeError) as ex:
+                # E.g. a node without an address yet; must not affect the
+                # other addresses
+                log.debug('Cannot resolve %r: %s', address, ex)
+                continue
+            ips.setdefault(ip, list()).append(address)
+
+        log.debug('Probing %d addresses', len(ips))
+        reachable = set()
+        if self.use_icmp:
+            reachable |= self._icmp_probe(list(ips))
+        remaining = [ip for ip in ips if ip not in reachable]
+        if remaining and self.tcp_ports:
+            reachable |= self._tcp_probe(remaining)
+
+        for ip in reachable:
+            for address in ips[ip]:
+                results[address] = True
+        return results
+
+    def _icmp_probe(self, ips):
+        sock, socktype = _icmp_socket()
+        if not sock:
+            log.debug('ICMP is not permitted; skipping.')
+            return set()
+
+        reachable = set()
+        try:
+            ident = os.getpid() & 0xffff
+            for seq, ip in enumerate(ips):
+                try:
+                    sock.sendto(_echo_request(ident, seq & 0xffff), (ip, 0))
+                except socket.error as ex:
+                    log.debug('Cannot send ICMP echo to %r: %s', ip, ex)
+
+            pending = set(ips)
+            deadline = time.time() + self.timeout
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0 or \
+                        not select.select([sock], [], [], remaining)[0]:
+                    break
+                data, (src, _) = sock.recvfrom(2048)
+                if socktype == socket.SOCK_RAW:
+                    # Raw sockets receive the IP header too
+                    data = data[(ord(data[0]) & 0x0f) * 4:]
+                if len(data) < 8:
+                    continue
+                icmp_type, code, checksum, rid, rseq = \
+                    struct.unpack('!BBHHH', data[:8])
+                if icmp_type != ICMP_ECHO_REPLY:
+                    continue
+                # The kernel rewrites the identifier of unprivileged ICMP
+                # sockets, and filters replies for them by itself.
+                if socktype == socket.SOCK_RAW and rid != ident:
+                    continue
+                if src in pending:
+                    pending.discard(src)
+                    reachable.add(src)
+        finally:
+            sock.close()
+        return reachable
+
+    def _tcp_probe(self, ips):
+        """
+        Try to connect to the ports of the hosts; at most
+        ``max_connections`` attempts are in progress at a time, each of them
+        limited to ``timeout`` seconds. An attempt failing locally (e.g. out
+        of file descriptors) fails only that attempt.
+        """
+        reachable = set()
+        connecting = dict()
+        attempts = ((ip, port) for ip in ips for port in self.tcp_ports)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and \
+                        len(connecting) < self.max_connections:
+                    try:
+                        ip, port = next(attempts)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if ip not in reachable:
+                        self._tcp_connect(ip, port, connecting, reachable)
+                if not connecting:
+                    break
+
+                now = time.time()
+                for s, (ip, deadline) in connecting.items():
+                    if deadline <= now or ip in reachable:
+                        # Timed out; or other ports of reachable hosts need
+                        # not be waited for
+                        del connecting[s]
+                        s.close()
+                if not connecting:
+                    continue
+                timeout = min(d for _, d in connecting.itervalues()) - now
+                for s in _wait_writable(list(connecting), max(0, timeout)):
+                    ip, _ = connecting.pop(s)
+                    err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    s.close()
+                    if err in (0, errno.ECONNREFUSED):
+                        reachable.add(ip)
+        finally:
+            for s in connecting:
+                s.close()
+        return reachable
+
+    def _tcp_connect(self, ip, port, connecting, reachable):
+        """
+        Start a connection attempt; register it in ``connecting`` if it is in
+        progress, or in ``reachable`` if it has already succeeded.
+        """
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        except socket.error as ex:
+            log.warning('Cannot probe %s:%d: %s', ip, port, ex)
+            return
+        try:
+            s.setblocking(0)
+            err = s.connect_ex((ip, port))
+        except socket.error as ex:
+            log.warning('Cannot probe %s:%d: %s', ip, port, ex)
+            err = None
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            connecting[s] = (ip, time.time() + self.timeout)
+            return
+        s.close()
+        if err in (0, errno.ECONNREFUSED):
+            reachable.add(ip)
+
+class ProbeBatcher(object):
+    """
+    Gathers probes requested concurrently into batches performed by a single
+    pass of a :class:`ProbeEngine`.
+
+    The first request starts a batch, which is performed after ``window``
+    seconds; requests arriving meanwhile join the batch. Requests waiting for
+    a batch longer than ``wait_timeout`` seconds (e.g. because the thread
+    performing it has been interrupted) give up on it, and probe their address
+    by themselves.
+
+    :param engine: The engine performing the probes.
+    :type engine: :class:`ProbeEngine`
+    :param float window: See above.
+    :param float wait_timeout: See above. Defaults to a generous estimation of
+        the time needed by the engine to perform a batch.
+    """
+    def __init__(self, engine, window=0.05, wait_timeout=None):
+        self.engine = engine
+        self.window = window
+        if wait_timeout is None:
+            wait_timeout = window + 4 * engine.timeout + 1
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.batch = None
+
+    def probe(self, address):
+        with self.lock:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = dict(addresses=set(), results=dict(),
+                                          done=threading.Event())
+            batch['addresses'].add(address)
+
+        if leader:
+            try:
+                time.sleep(self.window)
+                with self.lock:
+                    self.batch = None
+                batch['results'] = self.engine.probe_many(batch['addresses'])
+            except Exception:
+                log.exception('IGNORING exception while probing addresses:')
+            finally:
+                # Also when interrupted (e.g. KeyboardInterrupt); otherwise
+                # all later requests would join this batch, waiting forever.
+                with self.lock:
+                    if self.batch is batch:
+                        self.batch = None
+                batch['done'].set()
+        else:
+            batch['done'].wait(self.wait_timeout)
+            if not batch['done'].is_set():
+                log.warning('Probe batch has not finished in time; '
+                            'probing %r alone', address)
+                return self.engine.probe(address)
+        return batch['results'].get(address, False)
+
+_default_batcher = None
+_default_batcher_lock = threading.Lock()
+
+def default_batcher():
+    """
+    Get the :class:`ProbeBatcher` shared by the whole process.
+    """
+    global _default_batcher
+    with _default_batcher_lock:
+        if _default_batcher is None:
+            _default_batcher = ProbeBatcher(ProbeEngine())
+        return _default_batcher
@@ -0,0 +1,182 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+""" Per-backend throttling of cloud API calls
+
+Cloud backends usually limit the number of API calls a client can make. To
+avoid being throttled by the provider (and the resulting failed node
+creations), calls to a backend can be limited through:
+
+- a *concurrency limit*: the maximum number of calls in progress, and
+- a *rate limit*: a token bucket allowing ``rate`` calls per second on
+  average, with bursts of at most ``burst`` calls.
+
+The limits are configured per ``backend_id``:
+
+.. code:: yaml
+
+    backend_limits:
+        my_ec2_backend:
+            max_concurrency: 10
+            rate: 2
+            burst: 5
+
+Backends not listed are not limited.
+
+The primitives used are process-shared, so the limits are respected by all
+strategies, including the ones performing commands in sub-processes; as long
+as the sub-processes are forked after the :class:`Throttling` object has been
+created.
+"""
+
+__all__ = ['Throttling', 'BackendThrottle', 'TokenBucket']
+
+import contextlib
+import logging
+import multiprocessing
+import time
+
+log = logging.getLogger('occo.infraprocessor.throttling')
+
+def _wait(timeout, cancel_event):
+    """
+    Wait ``timeout`` seconds. Returns :data:`False` iff waiting has been
+    cancelled through ``cancel_event``.
+    """
+    if cancel_event:
+        cancel_event.wait(timeout)
+        return not cancel_event.is_set()
+    time.sleep(timeout)
+    return True
+
+class TokenBucket(object):
+    """
+    Process-shared token bucket.
+
+    :param float rate: The number of tokens added to the bucket per second.
+    :param int burst: The capacity of the bucket. Defaults to ``rate`` (but at
+        least 1).
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.lock = multiprocessing.Lock()
+        self.tokens = multiprocessing.Value('d', self.burst, lock=False)
+        self.stamp = multiprocessing.Value('d', time.time(), lock=False)
+
+    def _try_take(self):
+        """
+        Take a token if available. Otherwise, return the time needed for a
+        token to become available.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens.value = min(
+                self.burst,
+                self.tokens.value + (now - self.stamp.value) * self.rate)
+            self.stamp.value = now
+            if self.tokens.value >= 1:
+                self.tokens.value -= 1
+                return 0
+            return (1 - self.tokens.value) / self.rate
+
+    def acquire(self, cancel_event=None):
+        """
+        Take a token from the bucket, waiting for it if necessary.
+
+        :return: :data:`False` iff waiting has been cancelled through
+            ``cancel_event``.
+        """
+        delay = self._try_take()
+        while delay:
+            if not _wait(delay, cancel_event):
+                return False
+            delay = self._try_take()
+        return True
+
+class BackendThrottle(object):
+    """
+    Concurrency and rate limit of a single backend.
+
+    :param str backend_id: The identifier of the backend (for logging).
+    :param int max_concurrency: The maximum number of calls in progress.
+        :data:`None` means no limit.
+    :param float rate: The average number of calls allowed per second.
+        :data:`None` means no limit.
+    :param int burst: The number of calls allowed at once; see
+        :class:`TokenBucket`.
+    :param float poll_interval: While waiting for a free slot, the cancel event
+        is checked this often (seconds).
+    """
+    def __init__(self, backend_id, max_concurrency=None, rate=None,
+                 burst=None, poll_interval=1):
+        self.backend_id = backend_id
+        self.poll_interval = poll_interval
+        self.semaphore = multiprocessing.BoundedSemaphore(max_concurrency) \
+            if max_concurrency else None
+        self.bucket = TokenBucket(rate, burst) if rate else None
+
+    def _acquire_semaphore(self, cancel_event):
+        if not cancel_event:
+            return self.semaphore.acquire()
+        while not self.semaphore.acquire(True, self.poll_interval):
+            if cancel_event.is_set():
+                return False
+        return True
+
+    @contextlib.contextmanager
+    def slot(self, cancel_event=None):
+        """
+        Context manager waiting until a call to the backend is allowed.
+
+        :raises KeyboardInterrupt: if waiting has been cancelled through
+            ``cancel_event``. (Cancellation is handled uniformly as SIGINT by
+            the commands.)
+        """
+        if self.semaphore:
+            if not self._acquire_semaphore(cancel_event):
+                raise KeyboardInterrupt()
+        try:
+            if self.bucket and not self.bucket.acquire(cancel_event):
+                raise KeyboardInterrupt()
+            yield
+        finally:
+            if self.semaphore:
+                self.semaphore.release()
+
+class Throttling(object):
+    """
+    Registry of :class:`BackendThrottle` objects.
+
+    :param dict backend_limits: The parameters of :class:`BackendThrottle`
+        for each ``backend_id``.
+    """
+    def __init__(self, backend_limits=None):
+        self.throttles = dict(
+            (backend_id, BackendThrottle(backend_id, **limits))
+            for backend_id, limits in (backend_limits or dict()).iteritems())
+
+    @contextlib.contextmanager
+    def slot(self, backend_id, cancel_event=None):
+        """
+        Context manager waiting until a call to the given backend is allowed.
+        See :meth:`BackendThrottle.slot`.
+        """
+        throttle = self.throttles.get(backend_id)
+        if not throttle:
+            yield
+            return
+        log.debug('Waiting for a free slot of backend %r', backend_id)
+        with throttle.slot(cancel_event):
+            yield
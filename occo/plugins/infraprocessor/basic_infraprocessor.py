@@ -24,11 +24,18 @@ import logging
 import occo.util.factory as factory
 import occo.infobroker as ib
 import occo.infobroker.eventlog
-from occo.infraprocessor.node_resolution import resolve_node
+from occo.infraprocessor.node_resolution import \
+    resolve_node, ResolutionBatch, configure_templates, definition_cache
 import sys
 import uuid
 import yaml
-from occo.infraprocessor import InfraProcessor, Command
+from occo.infraprocessor import InfraProcessor, Command, run_phases
+from occo.infraprocessor.coroutine import Blocking, Return
+from occo.infraprocessor.throttling import Throttling
+from occo.infraprocessor.synchronization.poller import \
+    PendingNode, ReadinessPoller
+from occo.infraprocessor.synchronization.polling import get_polling_policy
+from occo.infraprocessor.synchronization.callback import start_listener
 from occo.infraprocessor.strategy import Strategy
 from occo.exceptions.orchestration import *
 
@@ -95,12 +102,122 @@ class CreateNode(Command):
     :param node: The description of the node to be created.
     :type node: :ref:`nodedescription`
 
+    The node may be resolved together with other nodes of the same batch,
+    through a shared :class:`~occo.infraprocessor.node_resolution.ResolutionBatch`
+    (see :meth:`BasicInfraProcessor.prepare_batch`).
     """
     def __init__(self, node_description):
         Command.__init__(self)
         self.node_description = node_description
+        self.resolution_batch = None
+
+    def prerequisites(self, batch):
+        """
+        Besides the explicit dependencies, a node depends on the creation of
+        its infrastructure, and on the nodes it is synchronized with (i.e.
+        nodes it is connected to through a mapping with ``synch: true``).
+        """
+        deps = super(CreateNode, self).prerequisites(batch)
+        infra_id = self.node_description['infra_id']
+        for cmd in batch:
+            if isinstance(cmd, CreateInfrastructure):
+                if cmd.infra_id == infra_id:
+                    deps.append(cmd)
+            elif isinstance(cmd, CreateNode) and cmd is not self:
+                if self._synchronized_with(cmd.node_description):
+                    deps.append(cmd)
+        return deps
+
+    def _synchronized_with(self, other):
+        """
+        Determine whether this node must wait for the ``other`` node to become
+        ready.
+        """
+        node_desc = self.node_description
+        if other['infra_id'] != node_desc['infra_id']:
+            return False
+        outbound = other.get('mappings', dict()).get('outbound', dict())
+        inbound = node_desc.get('mappings', dict()).get('inbound', dict())
+        mappings = outbound.get(node_desc['name'], list()) \
+            + inbound.get(other['name'], list())
+        return any(mapping.get('synch') for mapping in mappings)
 
     def perform(self, infraprocessor):
+        return run_phases(self.perform_phased(infraprocessor))
+
+    def perform_phased(self, infraprocessor):
+        """
+        Node creation is performed in two phases: first the node is
+        provisioned (:meth:`_provision`), then it is waited for to become
+        ready. The latter phase is represented by a
+        :class:`~occo.infraprocessor.synchronization.poller.PendingNode`.
+        """
+        instance_data = self._new_instance_data()
+
+        try:
+            self._provision(infraprocessor, instance_data)
+            resolved_node_def = instance_data['resolved_node_definition']
+            pending = PendingNode(
+                instance_data,
+                resolved_node_def['create_timeout'],
+                self.cancel_event,
+                get_polling_policy(resolved_node_def,
+                                   infraprocessor.poll_delay,
+                                   self.node_description['type']))
+            ready = yield pending
+            if ready is None:
+                # The strategy has not waited on behalf of this command
+                ready = self._wait_for_node(infraprocessor, pending)
+            if not ready:
+                # Cancellation through the cancel event is handled the same
+                # way as receiving SIGINT.
+                raise KeyboardInterrupt()
+            ib.main_eventlog.node_created(instance_data)
+        except KeyboardInterrupt:
+            # A KeyboardInterrupt is considered intentional cancellation
+            log.info('Cancelling node creation (received SIGINT)')
+            # Undo only iff the instance has already been created
+            if 'instance_id' in instance_data:
+                self._undo_create_node(infraprocessor, instance_data)
+            raise
+        except Exception:
+            self._reraise_creation_error(instance_data)
+
+        self._log_node_started(instance_data)
+        raise Return(instance_data)
+
+    def perform_async(self, infraprocessor):
+        """
+        Coroutine version of :meth:`perform`. Blocking steps of the creation
+        are offloaded to worker threads; waiting for the node to become ready
+        is done by :func:`~occo.infraprocessor.synchronization.wait_for_node_async`.
+        """
+        import occo.infraprocessor.synchronization as synch
+
+        instance_data = self._new_instance_data()
+
+        try:
+            yield Blocking(self._provision, infraprocessor, instance_data)
+            yield synch.wait_for_node_async(
+                instance_data,
+                infraprocessor.poll_delay,
+                instance_data['resolved_node_definition']['create_timeout'])
+            yield Blocking(ib.main_eventlog.node_created, instance_data)
+        except KeyboardInterrupt:
+            # The exception must be saved: yielding would clear it
+            exc_info = sys.exc_info()
+            log.info('Cancelling node creation (task cancelled)')
+            if 'instance_id' in instance_data:
+                yield Blocking(self._undo_create_node,
+                               infraprocessor, instance_data)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        except Exception:
+            self._reraise_creation_error(instance_data)
+
+        self._log_node_started(instance_data)
+        raise Return(instance_data)
+
+    def _new_instance_data(self):
         node_description = self.node_description
 
         log.debug('Creating node %r', node_description['name'])
@@ -115,40 +232,40 @@ class CreateNode(Command):
         )
 
         log.info('Creating node %r', instance_data['node_id'])
+        return instance_data
 
-        try:
-            self._perform_create(infraprocessor, instance_data)
-            ib.main_eventlog.node_created(instance_data)
-        except KeyboardInterrupt:
-            # A KeyboardInterrupt is considered intentional cancellation
-            log.info('Cancelling node creation (received SIGINT)')
-            # Undo only iff the instance has already been created
-            if 'instance_id' in instance_data:
-                self._undo_create_node(infraprocessor, instance_data)
-            raise
-        except NodeCreationError as ex:
+    def _reraise_creation_error(self, instance_data):
+        """
+        Transform the exception being handled into a
+        :exc:`~occo.exceptions.orchestration.NodeCreationError` (unless it is
+        already an :exc:`~occo.exceptions.orchestration.InfraProcessorError`)
+        and raise it.
+        """
+        exc_type, ex, tb = sys.exc_info()
+        if isinstance(ex, NodeCreationError):
             # Amend a node creation error iff it couldn't have been initialized
             # properly at the point of raising it.
             if not ex.instance_data:
                 ex.instance_data = instance_data
-            raise
-        except InfraProcessorError:
+            raise exc_type, ex, tb
+        elif isinstance(ex, InfraProcessorError):
             # This is a pre-cooked exception, no need for transformation
-            raise
-        except Exception as ex:
+            raise exc_type, ex, tb
+        else:
             log.exception('Error while creating node %r:',
                           instance_data['node_id'])
-            raise NodeCreationError(instance_data, ex), None, sys.exc_info()[2]
-        else:
-            log.info("Node %s/%s/%s has started",
-                     node_description['infra_id'],
-                     node_description['name'],
-                     instance_data['node_id'])
-            return instance_data
+            raise NodeCreationError(instance_data, ex), None, tb
 
-    def _perform_create(self, infraprocessor, instance_data):
+    def _log_node_started(self, instance_data):
+        node_description = self.node_description
+        log.info("Node %s/%s/%s has started",
+                 node_description['infra_id'],
+                 node_description['name'],
+                 instance_data['node_id'])
+
+    def _provision(self, infraprocessor, instance_data):
         """
-        Core to :meth:`perform`. only to avoid a level of nesting.
+        First phase of node creation: resolve the node and start it.
         """
 
         # Quick-access references
@@ -160,7 +277,8 @@ class CreateNode(Command):
         # the abstract description and the UDS/infobroker
         resolved_node_def = resolve_node(
             ib, node_id, node_description,
-            getattr(infraprocessor, 'default_timeout', None)
+            getattr(infraprocessor, 'default_timeout', None),
+            self.resolution_batch
         )
         datalog.debug("Resolved node description:\n%s",
                       yaml.dump(resolved_node_def, default_flow_style=False))
@@ -169,11 +287,12 @@ class CreateNode(Command):
 
         # Create the node based on the resolved information
         infraprocessor.servicecomposer.register_node(resolved_node_def)
-        instance_id = infraprocessor.cloudhandler.create_node(resolved_node_def)
+        with infraprocessor.throttling.slot(resolved_node_def['backend_id'],
+                                            self.cancel_event):
+            instance_id = \
+                infraprocessor.cloudhandler.create_node(resolved_node_def)
         instance_data['instance_id'] = instance_id
 
-        import occo.infraprocessor.synchronization as synch
-
         log.debug('Registering node instance_data for node %s/%s/%s',
                   node_description['infra_id'],
                   node_description['name'],
@@ -198,12 +317,27 @@ class CreateNode(Command):
             ib.get('node.resource.ip_address', instance_data)
         )
 
-        synch.wait_for_node(instance_data,
-                            infraprocessor.poll_delay,
-                            resolved_node_def['create_timeout'])
-
         return instance_data
 
+    def _wait_for_node(self, infraprocessor, pending):
+        """
+        Second phase of node creation: wait for the node to become ready,
+        using the readiness poller of the infraprocessor if it has one.
+
+        :return: :data:`False` iff waiting has been cancelled.
+        """
+        poller = getattr(infraprocessor, 'poller', None)
+        if poller:
+            return poller.wait(pending)
+
+        import occo.infraprocessor.synchronization as synch
+        return synch.wait_for_node(
+            pending.instance_data,
+            infraprocessor.poll_delay,
+            pending.timeout,
+            pending.cancel_event,
+            pending.policy)
+
     def _undo_create_node(self, infraprocessor, instance_data):
         try:
             log.info('UNDOING node creation: %r', instance_data['node_id'])
@@ -235,10 +369,16 @@ class DropNode(Command):
     def perform(self, infraprocessor):
         try:
             log.debug('Dropping node %r', self.instance_data['node_id'])
-            infraprocessor.cloudhandler.drop_node(self.instance_data)
+            # Dropping is not cancellable: it is used for undoing too.
+            with infraprocessor.throttling.slot(
+                    self.instance_data.get('backend_id')):
+                infraprocessor.cloudhandler.drop_node(self.instance_data)
             infraprocessor.servicecomposer.drop_node(self.instance_data)
             infraprocessor.uds.remove_nodes(self.instance_data['infra_id'],
                                             self.instance_data['node_id'])
+            import occo.infraprocessor.synchronization as synch
+            synch.forget_synch_strategy(self.instance_data['node_id'])
+            synch.default_notifier().forget(self.instance_data['node_id'])
             ib.main_eventlog.node_deleted(self.instance_data)
         except KeyboardInterrupt:
             # A KeyboardInterrupt is considered intentional cancellation
@@ -267,6 +407,17 @@ class DropInfrastructure(Command):
         Command.__init__(self)
         self.infra_id = infra_id
 
+    def prerequisites(self, batch):
+        """
+        Besides the explicit dependencies, an infrastructure can only be
+        dropped after its nodes.
+        """
+        deps = super(DropInfrastructure, self).prerequisites(batch)
+        deps.extend(cmd for cmd in batch
+                    if isinstance(cmd, DropNode)
+                    and cmd.instance_data['infra_id'] == self.infra_id)
+        return deps
+
     def perform(self, infraprocessor):
         try:
             log.debug('Dropping infrastructure %r', self.infra_id)
@@ -308,10 +459,44 @@ class BasicInfraProcessor(InfraProcessor):
         completely operational. This condition has to be polled in
         :meth:`CreateNode.perform`. ``poll_delay`` is the number of seconds to
         wait between polls.
+
+    :param dict backend_limits: Concurrency and rate limits of cloud API calls
+        per ``backend_id``. See :mod:`occo.infraprocessor.throttling`.
+
+    :param dict readiness_poller: If specified, the pending nodes are polled
+        by a single
+        :class:`~occo.infraprocessor.synchronization.poller.ReadinessPoller`,
+        configured with these options (e.g. ``max_queries_per_tick``,
+        ``max_parallel_queries``); otherwise each node is waited for by its
+        own loop.
+
+    :param dict readiness_listener: If specified (``host``, and optionally
+        ``port`` and ``secret``), the listener receiving readiness
+        notifications of nodes using the ``callback`` synch strategy is
+        started. Without a listener, such nodes are polled. See
+        :mod:`occo.infraprocessor.synchronization.callback`.
+
+    :param dict template_options: Configuration of the templates of node
+        resolution (e.g. ``bytecode_cache_dir``); see
+        :func:`occo.infraprocessor.node_resolution.configure_templates`.
+
+    :param dict node_definition_cache: Configuration of the node definition
+        cache (``ttl``, ``max_size``, ``uncached_strategies``); see
+        :class:`occo.infraprocessor.node_resolution.NodeDefinitionCache`.
+
+    :param int batch_resolution_threshold: If a batch contains at least this
+        many nodes to be created, they are resolved together. See
+        :meth:`prepare_batch`.
     """
     def __init__(self,
                  process_strategy='sequential',
-                 poll_delay=10):
+                 poll_delay=10,
+                 backend_limits=None,
+                 readiness_poller=None,
+                 readiness_listener=None,
+                 template_options=None,
+                 node_definition_cache=None,
+                 batch_resolution_threshold=5):
         super(BasicInfraProcessor, self).__init__(
             process_strategy=process_strategy)
         self.ib = ib.main_info_broker
@@ -319,6 +504,40 @@ class BasicInfraProcessor(InfraProcessor):
         self.cloudhandler = ib.main_cloudhandler
         self.servicecomposer = ib.main_servicecomposer
         self.poll_delay = poll_delay
+        self.throttling = Throttling(backend_limits)
+        self.poller = ReadinessPoller(poll_delay, **readiness_poller) \
+            if readiness_poller is not None else None
+        if readiness_listener:
+            start_listener(**readiness_listener)
+        if template_options is not None:
+            configure_templates(**template_options)
+        for key, value in (node_definition_cache or dict()).iteritems():
+            if not hasattr(definition_cache, key):
+                raise ValueError('Unknown node definition cache option', key)
+            setattr(definition_cache, key, value)
+        self.batch_resolution_threshold = batch_resolution_threshold
+
+    def prepare_batch(self, instruction_list):
+        """
+        Make the nodes to be created by the batch be resolved together (see
+        :class:`~occo.infraprocessor.node_resolution.ResolutionBatch`), if
+        there are at least :attr:`batch_resolution_threshold` of them.
+
+        Each node is still resolved when its command is performed, by the
+        strategy performing it, so resolution is not serialized; only the
+        information shared by the nodes is gathered once. (Commands
+        performed in other processes share it only with the commands
+        performed in the same process: i.e. by the same worker of the
+        ``pool`` strategy. The ``parallel`` strategy performs each command in
+        a process of its own, so its commands share nothing.)
+        """
+        commands = [cmd for cmd in instruction_list
+                    if isinstance(cmd, CreateNode)]
+        threshold = self.batch_resolution_threshold
+        batch = ResolutionBatch() \
+            if threshold and len(commands) >= threshold else None
+        for cmd in commands:
+            cmd.resolution_batch = batch
 
     def cri_create_infrastructure(self, infra_id):
         return CreateInfrastructure(infra_id)
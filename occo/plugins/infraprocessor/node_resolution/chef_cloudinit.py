@@ -30,8 +30,8 @@ import occo.exceptions as exceptions
 import occo.util.factory as factory
 import sys
 import yaml
-import jinja2
-from occo.infraprocessor.node_resolution import Resolver
+from occo.infraprocessor.node_resolution import Resolver, compile_template
+from occo.infraprocessor.synchronization.callback import readiness_token
 
 log = logging.getLogger('occo.infraprocessor.node_resolution.chef')
 datalog = logging.getLogger('occo.data.infraprocessor.node_resolution.chef')
@@ -62,8 +62,8 @@ class ChefCloudinitResolver(Resolver):
                    node_definition.pop('context_template', None))
 
             from occo.infobroker import main_info_broker
-            sc_data = main_info_broker.get(
-                'service_composer.aux_data',
+            sc_data = self.shared(
+                main_info_broker.get, 'service_composer.aux_data',
                 node_definition['service_composer_id'])
             yield ('service_composer_default',
                    sc_data.get('context_template', None))
@@ -73,7 +73,7 @@ class ChefCloudinitResolver(Resolver):
         src, template = util.find_effective_setting(context_list())
         datalog.debug('Context template from %s:\n%s', src, template)
 
-        return jinja2.Template(template)
+        return compile_template(template)
 
     def attr_template_resolve(self, attrs, template_data):
         """
@@ -88,7 +88,7 @@ class ChefCloudinitResolver(Resolver):
                 attrs[i] = self.attr_template_resolve(attrs[i], template_data)
             return attrs
         elif isinstance(attrs, basestring):
-            template = jinja2.Template(attrs)
+            template = compile_template(attrs)
             return template.render(**template_data)
         else:
             return attrs
@@ -175,6 +175,7 @@ class ChefCloudinitResolver(Resolver):
         source_data.update(node_definition)
         source_data['ibget'] = main_info_broker.get
         source_data['find_node_id'] = find_node_id
+        source_data['readiness_token'] = readiness_token(self.node_id)
         return source_data
 
     def check_if_cloud_config(self, node_definition):
@@ -232,9 +233,9 @@ class ChefCloudinitResolver(Resolver):
             'node_id'     : node_id,
             'name'        : node_desc['name'],
             'infra_id'    : node_desc['infra_id'],
-            'auth_data'   : ib.get('backends.auth_data',
-                                   node_definition['backend_id'],
-                                   node_desc['user_id']),
+            'auth_data'   : self.shared(ib.get, 'backends.auth_data',
+                                        node_definition['backend_id'],
+                                        node_desc['user_id']),
             'context'     : self.render_template(node_definition,
                                                  template_data),
             'attributes'  : self.resolve_attributes(node_desc,
@@ -27,8 +27,8 @@ import occo.exceptions as exceptions
 import occo.util.factory as factory
 import sys
 import yaml
-import jinja2
-from occo.infraprocessor.node_resolution import Resolver
+from occo.infraprocessor.node_resolution import Resolver, compile_template
+from occo.infraprocessor.synchronization.callback import readiness_token
 
 log = logging.getLogger('occo.infraprocessor.node_resolution.docker')
 
@@ -53,7 +53,7 @@ class DockerResolver(Resolver):
                 attrs[i] = self.attr_template_resolve(attrs[i], template_data)
             return attrs
         elif isinstance(attrs, basestring):
-            template = jinja2.Template(attrs)
+            template = compile_template(attrs)
             return template.render(**template_data)
         else:
             return attrs
@@ -140,6 +140,7 @@ class DockerResolver(Resolver):
         source_data.update(node_definition)
         source_data['ibget'] = main_info_broker.get
         source_data['find_node_id'] = find_node_id
+        source_data['readiness_token'] = readiness_token(self.node_id)
         return source_data
 
     def _resolve_node(self, node_definition):
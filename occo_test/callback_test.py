@@ -0,0 +1,180 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from common import *
+import occo.infobroker as ib
+from occo.infobroker.uds import UDS
+import occo.infobroker.eventlog as el
+import occo.constants.status as node_status
+import occo.infraprocessor.synchronization as synch
+from occo.infraprocessor.synchronization.callback import \
+    ReadinessNotifier, ReadinessListener, default_notifier, \
+    start_listener, stop_listener, active_listener
+from occo.infraprocessor.synchronization.poller import \
+    PendingNode, ReadinessPoller
+import socket
+import threading
+import time
+import urllib2
+
+@ib.provider
+class CallbackIB(DummyInfoBroker):
+    """ Nodes are ready when they have called back. """
+    @ib.provides('node.state')
+    def node_state(self, instance_data):
+        return node_status.READY \
+            if default_notifier().is_notified(instance_data['node_id']) \
+            else node_status.PENDING
+
+def call_back(url, delay=0, data=''):
+    """ Stand-in for the contextualization of a node. """
+    time.sleep(delay)
+    opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+    return opener.open(urllib2.Request(url, data=data)).getcode()
+
+class CheckedCallbackStrategy(synch.CallbackSynchStrategy):
+    def get_node_address(self):
+        return '127.0.0.1'
+
+class NotifierTest(unittest.TestCase):
+    def test_notify(self):
+        notifier = ReadinessNotifier()
+        woken = list()
+        notifier.subscribe('n1', woken.append)
+        notifier.notify('n1')
+        notifier.notify('n2')
+        self.assertEqual(woken, ['n1'])
+        self.assertTrue(notifier.is_notified('n2'))
+        notifier.unsubscribe('n1', woken.append)
+        notifier.notify('n1')
+        self.assertEqual(woken, ['n1'])
+        notifier.forget('n1')
+        self.assertFalse(notifier.is_notified('n1'))
+    def test_token(self):
+        notifier = ReadinessNotifier()
+        token = notifier.token('n1')
+        self.assertTrue(notifier.verify('n1', token))
+        self.assertFalse(notifier.verify('n2', token))
+        self.assertFalse(notifier.verify('n1', None))
+        self.assertFalse(ReadinessNotifier().verify('n1', token))
+        self.assertEqual(ReadinessNotifier(secret='s').token('n1'),
+                         ReadinessNotifier(secret='s').token('n1'))
+    def test_limit(self):
+        notifier = ReadinessNotifier(max_notifications=2)
+        for node_id in ['n1', 'n2', 'n3']:
+            notifier.notify(node_id)
+        self.assertFalse(notifier.is_notified('n1'))
+        self.assertTrue(notifier.is_notified('n3'))
+
+class CallbackTest(unittest.TestCase):
+    def setUp(self):
+        ib.set_all_singletons(
+            CallbackIB(),
+            UDS.instantiate(protocol='dict'),
+            el.EventLog.instantiate(protocol='logging'),
+            DummyCloudHandler(),
+            DummyServiceComposer(),
+        )
+        self.listener = start_listener('127.0.0.1', 0)
+    def tearDown(self):
+        stop_listener()
+    def url(self, node_id):
+        return self.listener.url_for(node_id, '127.0.0.1')
+    def call_back_later(self, node_id, delay=0.2):
+        thread = threading.Thread(target=call_back,
+                                  args=(self.url(node_id), delay))
+        thread.daemon = True
+        thread.start()
+    def test_listener(self):
+        node_id = uid()
+        self.assertEqual(call_back(self.url(node_id)), 200)
+        self.assertTrue(default_notifier().is_notified(node_id))
+        with self.assertRaises(urllib2.HTTPError):
+            call_back('http://127.0.0.1:{0}/other'.format(self.listener.port))
+    def test_authentication(self):
+        node_id = uid()
+        url = 'http://127.0.0.1:{0}/ready/{1}'.format(
+            self.listener.port, node_id)
+        other_token = default_notifier().token(uid())
+        for bad_url in [url, url + '?token=bad', url + '?token=' + other_token]:
+            with self.assertRaises(urllib2.HTTPError) as cm:
+                call_back(bad_url)
+            self.assertEqual(cm.exception.code, 403)
+        # GET is not accepted
+        with self.assertRaises(urllib2.HTTPError):
+            call_back(self.url(node_id), data=None)
+        self.assertFalse(default_notifier().is_notified(node_id))
+    def test_single_listener(self):
+        self.assertIs(start_listener('127.0.0.1', 0), self.listener)
+        self.assertIs(active_listener(), self.listener)
+    def test_port_in_use(self):
+        stop_listener()
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        s.listen(1)
+        try:
+            self.assertIsNone(start_listener('127.0.0.1', s.getsockname()[1]))
+            self.assertIsNone(active_listener())
+        finally:
+            s.close()
+    def test_wait_for_node(self):
+        node_id = uid()
+        self.call_back_later(node_id)
+        start = time.time()
+        self.assertTrue(synch.wait_for_node(
+            dict(node_id=node_id, infra_id='infra'), poll_delay=10,
+            cancel_event=threading.Event()))
+        self.assertLess(time.time() - start, 2)
+    def test_poller(self):
+        node_id = uid()
+        poller = ReadinessPoller(poll_delay=10)
+        self.call_back_later(node_id)
+        start = time.time()
+        self.assertTrue(poller.wait(
+            PendingNode(dict(node_id=node_id, infra_id='infra'))))
+        self.assertLess(time.time() - start, 2)
+    def test_strategy(self):
+        node_id = uid()
+        nodedef = dict(infra_id='infra',
+                       synch_strategy=dict(protocol='callback',
+                                           fallback=False))
+        strategy = synch.NodeSynchStrategy.instantiate(
+            'callback', dict(), nodedef, dict(node_id=node_id))
+        self.assertFalse(strategy.is_ready())
+        call_back(self.url(node_id))
+        self.assertTrue(strategy.is_ready())
+    def test_no_listener(self):
+        stop_listener()
+        nodedef = dict(infra_id='infra',
+                       synch_strategy=dict(protocol='callback',
+                                           fallback=False))
+        strategy = CheckedCallbackStrategy(
+            dict(), nodedef, dict(node_id=uid()))
+        # Basic checks are performed, regardless of fallback
+        self.assertTrue(strategy.is_ready())
+        self.assertEqual(
+            synch.get_polling_policy(nodedef, 10).poll_delay, 10)
+    def test_fallback_policy(self):
+        policy = synch.get_polling_policy(
+            dict(synch_strategy=dict(protocol='callback')), 10)
+        self.assertEqual(policy.poll_delay, 60)
+        policy = synch.get_polling_policy(
+            dict(synch_strategy='callback'), 10)
+        self.assertEqual(policy.poll_delay, 60)
+        policy = synch.get_polling_policy(dict(synch_strategy='basic'), 10)
+        self.assertEqual(policy.poll_delay, 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from common import *
+from occo.infraprocessor.codec import ResultCodec
+from occo.exceptions.orchestration import NodeCreationError
+import sys
+
+def encoded_error(codec, exc):
+    try:
+        raise exc
+    except Exception:
+        return codec.encode_exception(sys.exc_info())
+
+class CodecTest(unittest.TestCase):
+    def setUp(self):
+        self.instance_data = dict(node_id='n1', infra_id='i1',
+                                  resolved_node_definition=dict(x=1))
+    def test_pickle_exception(self):
+        codec = ResultCodec.instantiate('pickle')
+        error = encoded_error(
+            codec, NodeCreationError(self.instance_data, 'reason'))
+        self.assertIs(error['type'], NodeCreationError)
+        self.assertIn('raise exc', error['tbstr'])
+        exc = codec.decode_exception(error)
+        self.assertIsInstance(exc, NodeCreationError)
+        self.assertEqual(exc.instance_data, self.instance_data)
+    def test_yaml_exception(self):
+        codec = ResultCodec.instantiate('yaml')
+        error = encoded_error(codec, KeyError('missing'))
+        self.assertEqual(error['encoding'], 'yaml')
+        exc = codec.decode_exception(error)
+        self.assertIsInstance(exc, KeyError)
+        self.assertEqual(exc.args, ('missing',))
+    def test_pickle_fallback(self):
+        codec = ResultCodec.instantiate('pickle')
+        exc = NodeCreationError(self.instance_data)
+        exc.unpicklable = lambda: None
+        error = encoded_error(codec, exc)
+        self.assertEqual(error['encoding'], 'yaml')
+    def test_result_fields(self):
+        codec = ResultCodec.instantiate(
+            'pickle', result_fields=['node_id', 'infra_id'])
+        result = codec.decode_result(codec.encode_result(self.instance_data))
+        self.assertEqual(result, dict(node_id='n1', infra_id='i1'))
+        self.assertIsNone(codec.encode_result(None))
+    def test_parallel_strategy_codec(self):
+        from occo.infraprocessor.strategy import Strategy
+        s = Strategy.instantiate('parallel', result_codec='pickle',
+                                 result_fields=['node_id'])
+        self.assertEqual(s.codec.encode_result(self.instance_data),
+                         dict(node_id='n1'))
+
+if __name__ == '__main__':
+    unittest.main()
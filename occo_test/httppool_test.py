@@ -0,0 +1,103 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from common import *
+from occo.infraprocessor.synchronization import BasicNodeSynchStrategy
+from occo.infraprocessor.synchronization.primitives import \
+    SynchronizationProvider
+from occo.infraprocessor.synchronization.httppool import http_session
+import BaseHTTPServer
+import SocketServer
+import socket
+import threading
+import time
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+    def do_HEAD(self):
+        if self.path.startswith('/slow'):
+            time.sleep(0.3)
+        self.send_response(404 if self.path == '/missing' else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    do_GET = do_HEAD
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    connections = 0
+    def handle_error(self, request, client_address):
+        # Clients timing out close the connection early
+        pass
+
+class URLSynchStrategy(BasicNodeSynchStrategy):
+    def get_node_address(self):
+        return '127.0.0.1'
+    def check_url(self, url):
+        return SynchronizationProvider().site_available(
+            url, timeout=self.url_timeout)
+
+requires_session = unittest.skipUnless(
+    http_session(), 'requests is not available')
+
+class HTTPPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+    def test_available(self):
+        self.assertTrue(
+            SynchronizationProvider().site_available(self.url + '/'))
+    @requires_session
+    def test_unavailable(self):
+        sp = SynchronizationProvider()
+        self.assertFalse(sp.site_available(self.url + '/missing'))
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        self.assertFalse(
+            sp.site_available('http://127.0.0.1:{0}/'.format(port)))
+    @requires_session
+    def test_timeout(self):
+        sp = SynchronizationProvider()
+        self.assertFalse(sp.site_available(self.url + '/slow', timeout=0.1))
+    @requires_session
+    def test_keepalive(self):
+        sp = SynchronizationProvider()
+        for i in xrange(5):
+            self.assertTrue(sp.site_available(self.url + '/'))
+        self.assertEqual(self.server.connections, 1)
+    def test_urls_concurrent(self):
+        urls = [self.url + '/slow{0}'.format(i) for i in xrange(4)]
+        strategy = URLSynchStrategy(
+            dict(variables=dict()),
+            dict(infra_id='infra', synch_strategy=dict(urls=urls)),
+            dict(node_id='node'))
+        start = time.time()
+        self.assertTrue(strategy.urls_ready())
+        self.assertLess(time.time() - start, 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
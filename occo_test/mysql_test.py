@@ -0,0 +1,158 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from common import *
+from occo.infraprocessor.synchronization.mysql import MysqlServerSynchStragegy
+import socket
+import time
+
+class DatabaseError(Exception):
+    pass
+
+class FakeConnection(object):
+    def __init__(self, server, name):
+        self.server, self.name = server, name
+        self.closed = False
+    def ping(self):
+        self.server.pings.append(self.name)
+        if self.name in self.server.down:
+            raise DatabaseError('Lost connection')
+    def close(self):
+        self.closed = True
+
+class StandInServer(object):
+    """ Listens on a local port, and serves fake connections. """
+    def __init__(self, delay=0):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.delay = delay
+        self.connects, self.pings = list(), list()
+        self.connections = list()
+        self.down = set()
+    def connect(self, db):
+        time.sleep(self.delay)
+        self.connects.append(db['name'])
+        if db['name'] in self.down:
+            raise DatabaseError('Unknown database')
+        conn = FakeConnection(self, db['name'])
+        self.connections.append(conn)
+        return conn
+    def close(self):
+        self.listener.close()
+
+class StandInStrategy(MysqlServerSynchStragegy):
+    server = None
+    address = '127.0.0.1'
+    port_checks = 0
+    def port_open(self, host):
+        self.port_checks += 1
+        return MysqlServerSynchStragegy.port_open(self, host)
+    def get_node_address(self, infra_id, node_id):
+        return self.address
+    def connection_errors(self):
+        return DatabaseError
+    def connect(self, host, db):
+        return self.server.connect(db)
+
+class MysqlSynchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(delay=0.2)
+    def tearDown(self):
+        self.server.close()
+    def strategy(self, port=None, databases=('db1', 'db2', 'db3')):
+        synch_strategy = dict(
+            protocol='mysql_server', port=port or self.server.port,
+            connect_timeout=1,
+            databases=[dict(name=name, user='u', **{'pass': 'p'})
+                       for name in databases])
+        strategy = StandInStrategy(
+            dict(), dict(infra_id='infra', synch_strategy=synch_strategy),
+            dict(node_id='node1'))
+        strategy.server = self.server
+        return strategy
+    def closed_port(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+    def test_port_closed(self):
+        strategy = self.strategy(port=self.closed_port())
+        self.assertFalse(strategy.is_ready())
+        self.assertEqual(self.server.connects, [])
+    def test_parallel(self):
+        strategy = self.strategy()
+        start = time.time()
+        self.assertTrue(strategy.is_ready())
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(sorted(self.server.connects), ['db1', 'db2', 'db3'])
+    def test_reuse(self):
+        self.server.down.add('db2')
+        strategy = self.strategy()
+        self.assertFalse(strategy.is_ready())
+        self.server.down.clear()
+        self.assertTrue(strategy.is_ready())
+        self.assertEqual(sorted(self.server.pings), ['db1', 'db3'])
+        # The port is not checked while connections are kept
+        self.assertEqual(strategy.port_checks, 1)
+    def test_closed_when_ready(self):
+        strategy = self.strategy()
+        self.assertTrue(strategy.is_ready())
+        self.assertTrue(all(c.closed for c in self.server.connections))
+        self.assertEqual(strategy.connections, dict())
+    def test_release(self):
+        self.server.down.add('db2')
+        strategy = self.strategy()
+        self.assertFalse(strategy.is_ready())
+        self.assertFalse(any(c.closed for c in self.server.connections))
+        strategy.release()
+        self.assertTrue(all(c.closed for c in self.server.connections))
+    def test_unavailable(self):
+        self.server.down.add('db2')
+        strategy = self.strategy()
+        self.assertFalse(strategy.is_ready())
+        self.server.down.clear()
+        self.assertTrue(strategy.is_ready())
+        # Only the missing connection is established again
+        self.assertEqual(sorted(self.server.connects),
+                         ['db1', 'db2', 'db2', 'db3'])
+    def test_connection_lost(self):
+        strategy = self.strategy(databases=['db1'])
+        self.assertTrue(strategy.is_ready())
+        self.server.down.add('db1')
+        self.assertFalse(strategy.is_ready())
+        self.assertEqual(self.server.connects, ['db1', 'db1'])
+    def test_no_address_yet(self):
+        strategy = self.strategy()
+        strategy.address = None
+        self.assertFalse(strategy.is_ready())
+        self.assertEqual(strategy.port_checks, 0)
+        self.assertEqual(self.server.connects, [])
+        strategy.address = '127.0.0.1'
+        self.assertTrue(strategy.is_ready())
+    def test_late_connection(self):
+        strategy = self.strategy(databases=['db1'])
+        generation = strategy.generation
+        # E.g. the address of the node has changed meanwhile
+        strategy.close_connections()
+        self.assertFalse(strategy.probe_database(
+            '127.0.0.1', dict(name='db1'), generation))
+        self.assertEqual(strategy.connections, dict())
+        self.assertTrue(all(c.closed for c in self.server.connections))
+
+if __name__ == '__main__':
+    unittest.main()
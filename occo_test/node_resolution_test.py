@@ -0,0 +1,326 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from common import *
+import occo.infraprocessor as ip
+import occo.infraprocessor.node_resolution as nr
+import occo.plugins.infraprocessor.basic_infraprocessor
+import occo.plugins.infraprocessor.node_resolution.chef_cloudinit
+import occo.infobroker as ib
+from occo.infobroker.uds import UDS
+import occo.infobroker.eventlog as el
+from occo.plugins.infraprocessor.node_resolution.dockerp import DockerResolver
+import copy
+import pickle
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+class TemplateCacheTest(unittest.TestCase):
+    def test_hits(self):
+        cache = nr.TemplateCache()
+        template = cache.get('{{a}}')
+        self.assertIs(cache.get('{{a}}'), template)
+        self.assertEqual(template.render(a=1), '1')
+        self.assertEqual(cache.stats(),
+                         dict(hits=1, misses=1, evictions=0, size=1))
+    def test_eviction(self):
+        cache = nr.TemplateCache(max_size=2)
+        first = cache.get('{{a}}')
+        cache.get('{{b}}')
+        cache.get('{{a}}')
+        cache.get('{{c}}')
+        # The least recently used one is evicted
+        self.assertIs(cache.get('{{a}}'), first)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.templates.keys(), ['{{c}}', '{{a}}'])
+    def test_resolver(self):
+        resolver = DockerResolver(None, 'node1', dict())
+        before = nr.template_cache.stats()
+        for i in xrange(3):
+            attrs = dict(x='{{ node_id }}-shared', y=['{{ i }}-shared'])
+            resolver.attr_template_resolve(attrs, dict(node_id='n', i=i))
+        self.assertEqual(attrs, dict(x='n-shared', y=['2-shared']))
+        after = nr.template_cache.stats()
+        self.assertEqual(after['misses'] - before['misses'], 2)
+        self.assertEqual(after['hits'] - before['hits'], 4)
+
+class BytecodeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+    def tearDown(self):
+        nr.configure_templates(None)
+        shutil.rmtree(self.cachedir)
+    def compile_count(self, source):
+        environment = nr.configure_templates(self.cachedir)
+        compiled = list()
+        compile = environment.compile
+        def counting_compile(*args, **kwargs):
+            compiled.append(args[0])
+            return compile(*args, **kwargs)
+        environment.compile = counting_compile
+        template = nr.compile_template(source)
+        self.assertEqual(template.render(a='x'), 'x-bytecode')
+        return len(compiled)
+    def test_opt_in(self):
+        self.assertIsNone(nr.configure_templates().bytecode_cache)
+    def test_private_dir(self):
+        path = os.path.join(self.cachedir, 'cache')
+        nr.configure_templates(path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+    def test_bytecode_cache(self):
+        source = '{{ a }}-bytecode'
+        self.assertEqual(self.compile_count(source), 1)
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+        # As if after a restart: the bytecode is loaded from the disk
+        self.assertEqual(self.compile_count(source), 0)
+    def test_corrupt_cache(self):
+        source = '{{ a }}-bytecode'
+        self.compile_count(source)
+        for name in os.listdir(self.cachedir):
+            with open(os.path.join(self.cachedir, name), 'w') as f:
+                f.write('garbage')
+        self.assertEqual(self.compile_count(source), 1)
+    def test_unusable_dir(self):
+        path = os.path.join(self.cachedir, 'file')
+        open(path, 'w').close()
+        environment = nr.configure_templates(path)
+        self.assertIsNone(environment.bytecode_cache)
+        self.assertEqual(nr.compile_template('{{ a }}').render(a=1), '1')
+
+class DefinitionIB(object):
+    def __init__(self):
+        self.queries = list()
+        self.definition = dict(implementation_type='cooked',
+                               attributes=dict(a=[1, 2]))
+    def get(self, key, node_type, preselected_backend_ids, strategy):
+        self.queries.append((node_type, preselected_backend_ids, strategy))
+        return copy.deepcopy(self.definition)
+
+class ListingDefinitionIB(DefinitionIB):
+    """ Can also list all the definitions of a node type. """
+    def __init__(self):
+        DefinitionIB.__init__(self)
+        self.definitions = [dict(self.definition, backend_id=backend_id)
+                            for backend_id in ['b1', 'b2', 'b3']]
+    def get(self, key, node_type, **kwargs):
+        if key == 'node.definition.all':
+            self.queries.append((node_type, 'all'))
+            return copy.deepcopy(self.definitions)
+        return DefinitionIB.get(self, key, node_type, **kwargs)
+
+class NodeDefinitionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = DefinitionIB()
+        self.cache = nr.NodeDefinitionCache(ttl=10)
+    def test_cached(self):
+        for i in xrange(5):
+            self.cache.get(self.ib, 't', None, 'all')
+        self.assertEqual(len(self.ib.queries), 1)
+        self.cache.get(self.ib, 't', ['b1', 'b2'], 'all')
+        self.assertEqual(len(self.ib.queries), 2)
+    def test_copies(self):
+        first = self.cache.get(self.ib, 't', None, 'all')
+        first['attributes']['a'].append(3)
+        first.pop('implementation_type')
+        second = self.cache.get(self.ib, 't', None, 'all')
+        self.assertEqual(second, self.ib.definition)
+        second['attributes']['a'].append(4)
+        self.assertEqual(self.cache.get(self.ib, 't', None, 'all'),
+                         self.ib.definition)
+    def test_random(self):
+        self.cache.get(self.ib, 't', None, 'random')
+        self.cache.get(self.ib, 't', None, 'random')
+        self.cache.get(self.ib, 't', ['b1', 'b2'], 'random')
+        self.cache.get(self.ib, 't', ['b1', 'b2'], 'random')
+        self.assertEqual(len(self.ib.queries), 4)
+        # A single preselected backend leaves nothing to select
+        self.cache.get(self.ib, 't', 'b1', 'random')
+        self.cache.get(self.ib, 't', ['b1'], 'random')
+        self.assertEqual(len(self.ib.queries), 5)
+    def test_random_selection(self):
+        self.ib = ListingDefinitionIB()
+        selected = [self.cache.get(self.ib, 't', None, 'random')['backend_id']
+                    for i in xrange(100)]
+        # The definitions are listed once, the selection is made per node
+        self.assertEqual(self.ib.queries, [('t', 'all')])
+        self.assertEqual(set(selected), set(['b1', 'b2', 'b3']))
+        selected = [
+            self.cache.get(self.ib, 't', ['b1', 'b3'], 'random')['backend_id']
+            for i in xrange(100)]
+        self.assertEqual(set(selected), set(['b1', 'b3']))
+        self.assertEqual(len(self.ib.queries), 1)
+        # Each node gets its own copy
+        first = self.cache.get(self.ib, 't', None, 'random')
+        first['attributes']['a'].append(3)
+        self.assertEqual(self.cache.get(self.ib, 't', None, 'random')
+                         ['attributes'], self.ib.definition['attributes'])
+    def test_other_uncached_strategy(self):
+        self.ib = ListingDefinitionIB()
+        self.cache.uncached_strategies = ('random', 'cheapest')
+        self.cache.get(self.ib, 't', None, 'cheapest')
+        self.cache.get(self.ib, 't', None, 'cheapest')
+        # Selected by the info broker for each node, not randomly here
+        self.assertEqual(self.ib.queries, [('t', None, 'cheapest')] * 2)
+        self.assertRaises(ValueError, self.cache.select,
+                          self.ib.definitions, 'cheapest')
+    def test_ttl(self):
+        self.cache.ttl = 0.1
+        self.cache.get(self.ib, 't', None, 'all')
+        time.sleep(0.2)
+        self.cache.get(self.ib, 't', None, 'all')
+        self.assertEqual(len(self.ib.queries), 2)
+        self.cache.ttl = 0
+        self.cache.get(self.ib, 't', None, 'all')
+        self.assertEqual(len(self.ib.queries), 3)
+    def test_invalidate(self):
+        self.cache.get(self.ib, 't', None, 'all')
+        self.cache.get(self.ib, 'u', None, 'all')
+        self.cache.invalidate('t')
+        self.cache.get(self.ib, 't', None, 'all')
+        self.cache.get(self.ib, 'u', None, 'all')
+        self.assertEqual([q[0] for q in self.ib.queries], ['t', 'u', 't'])
+        self.cache.invalidate()
+        self.cache.get(self.ib, 'u', None, 'all')
+        self.assertEqual(len(self.ib.queries), 4)
+
+@ib.provider
+class CountingIB(DummyInfoBroker):
+    """ Counts the queries of shared information. """
+    def __init__(self, delay=0):
+        DummyInfoBroker.__init__(self)
+        self.queries = list()
+        self.delay = delay
+        self.resolving_threads = set()
+    def get(self, key, *args, **kwargs):
+        if key in ['backends.auth_data', 'service_composer.aux_data']:
+            self.queries.append(key)
+        return DummyInfoBroker.get(self, key, *args, **kwargs)
+    @ib.provides('node.definition')
+    def nodedef(self, node_type, preselected_backend_ids, strategy, **kwargs):
+        self.resolving_threads.add(threading.current_thread().name)
+        time.sleep(self.delay)
+        # As a real info broker, a new definition is returned every time
+        return copy.deepcopy(dummydata['nodedefs'][node_type])
+
+class BatchResolutionTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = CountingIB()
+        ib.set_all_singletons(
+            self.ib,
+            UDS.instantiate(protocol='dict'),
+            el.EventLog.instantiate(protocol='logging'),
+            DummyCloudHandler(),
+            DummyServiceComposer(),
+        )
+    def nodes(self, count, **kwargs):
+        return [DummyNode('infra', **kwargs) for i in xrange(count)]
+    def test_resolve_nodes(self):
+        nodes = [(uid(), node) for node in self.nodes(4)]
+        resolved = nr.resolve_nodes(self.ib, nodes)
+        self.assertEqual([r['node_id'] for r in resolved],
+                         [node_id for node_id, _ in nodes])
+        self.assertEqual(sorted(self.ib.queries),
+                         ['backends.auth_data', 'service_composer.aux_data'])
+        resolved[0]['auth_data']['changed'] = True
+        self.assertEqual(resolved[1]['auth_data'], dict())
+    def test_groups(self):
+        nodes = self.nodes(2) + self.nodes(2, node_type='synch1')
+        nodes[1]['user_id'] = 1
+        nr.resolve_nodes(self.ib, [(uid(), node) for node in nodes])
+        self.assertEqual(self.ib.queries.count('backends.auth_data'), 3)
+    def test_resolve_node(self):
+        for i in xrange(2):
+            nr.resolve_node(self.ib, uid(), DummyNode('infra'))
+        self.assertEqual(len(self.ib.queries), 4)
+    def test_prepare_batch(self):
+        infrap = ip.InfraProcessor.instantiate(
+            'basic', batch_resolution_threshold=3)
+        few = [infrap.cri_create_node(node) for node in self.nodes(2)]
+        infrap.prepare_batch(few)
+        self.assertEqual([cmd.resolution_batch for cmd in few], [None, None])
+        infrap.push_instructions(infrap.cri_create_infrastructure('infra'))
+        del self.ib.queries[:]
+        commands = [infrap.cri_create_node(node) for node in self.nodes(3)]
+        instances = infrap.push_instructions(commands)
+        self.assertEqual(len(set(i['node_id'] for i in instances)), 3)
+        self.assertIsNotNone(commands[0].resolution_batch)
+        self.assertEqual(len(set(cmd.resolution_batch for cmd in commands)), 1)
+        self.assertEqual(sorted(self.ib.queries),
+                         ['backends.auth_data', 'service_composer.aux_data'])
+    def test_concurrent_strategy(self):
+        self.ib.delay = 0.2
+        infrap = ip.InfraProcessor.instantiate(
+            'basic', process_strategy=dict(protocol='threaded',
+                                           max_threads=5),
+            batch_resolution_threshold=2)
+        infrap.push_instructions(infrap.cri_create_infrastructure('infra'))
+        del self.ib.queries[:]
+        self.ib.resolving_threads.clear()
+        start = time.time()
+        infrap.push_instructions(
+            [infrap.cri_create_node(node) for node in self.nodes(5)])
+        # Nodes are resolved by the workers, concurrently
+        self.assertLess(time.time() - start, 0.7)
+        self.assertNotIn('MainThread', self.ib.resolving_threads)
+        self.assertGreater(len(self.ib.resolving_threads), 1)
+        # Shared information is still gathered once
+        self.assertEqual(sorted(self.ib.queries),
+                         ['backends.auth_data', 'service_composer.aux_data'])
+    def test_pickle(self):
+        batch = nr.ResolutionBatch()
+        nr.resolve_node(self.ib, uid(), DummyNode('infra'), batch=batch)
+        self.assertEqual(len(batch.groups), 1)
+        copied = pickle.loads(pickle.dumps(batch))
+        self.assertEqual(copied.groups, dict())
+        # Nodes passed to the same process share the copy of the batch
+        self.assertIs(pickle.loads(pickle.dumps(batch)), copied)
+        self.assertIsNot(pickle.loads(pickle.dumps(nr.ResolutionBatch())),
+                         copied)
+    def test_concurrent_groups(self):
+        group = nr.ResolutionGroup()
+        calls = list()
+        def slow(key):
+            calls.append(key)
+            time.sleep(0.3)
+            return key
+        threads = [threading.Thread(target=group.shared, args=(slow, key))
+                   for key in ['a', 'b', 'a', 'b']]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Different keys are computed concurrently; each of them only once
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(sorted(calls), ['a', 'b'])
+    def test_failed_shared(self):
+        group = nr.ResolutionGroup()
+        attempts = list()
+        def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ValueError()
+            return 'info'
+        self.assertRaises(ValueError, group.shared, flaky)
+        # Failures are not cached
+        self.assertEqual(group.shared(flaky), 'info')
+        self.assertEqual(group.shared(flaky), 'info')
+        self.assertEqual(len(attempts), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from common import *
+import occo.infobroker as ib
+from occo.infobroker.uds import UDS
+import occo.infobroker.eventlog as el
+import occo.constants.status as node_status
+from occo.infraprocessor.synchronization.poller import \
+    PendingNode, ReadinessPoller
+from occo.infraprocessor.synchronization.polling import FixedPollingPolicy
+from occo.exceptions.orchestration import \
+    NodeFailedError, NodeCreationTimeOutError
+import threading
+import time
+
+@ib.provider
+class NodeStateIB(DummyInfoBroker):
+    def __init__(self):
+        DummyInfoBroker.__init__(self)
+        self.states = dict()
+        self.queries = list()
+        self.delay = 0
+
+    @ib.provides('node.state')
+    def node_state(self, instance_data):
+        node_id = instance_data['node_id']
+        self.queries.append((time.time(), node_id))
+        time.sleep(self.delay)
+        return self.states.get(node_id, node_status.PENDING)
+
+class RecordingPolicy(FixedPollingPolicy):
+    def __init__(self, *args, **kwargs):
+        FixedPollingPolicy.__init__(self, *args, **kwargs)
+        self.outcomes = list()
+    def ready(self, now=None):
+        self.outcomes.append('ready')
+    def abandoned(self, now=None):
+        self.outcomes.append('abandoned')
+
+class PollerTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = NodeStateIB()
+        ib.set_all_singletons(
+            self.ib,
+            UDS.instantiate(protocol='dict'),
+            el.EventLog.instantiate(protocol='logging'),
+            DummyCloudHandler(),
+            DummyServiceComposer(),
+        )
+        self.poller = ReadinessPoller(poll_delay=0.05,
+                                      cancel_check_interval=0.05)
+    def pending(self, state=None, timeout=None, cancel_event=None):
+        node_id = uid()
+        if state:
+            self.ib.states[node_id] = state
+        return PendingNode(dict(node_id=node_id, infra_id='infra'),
+                           timeout, cancel_event)
+    def test_outcomes(self):
+        outcomes = dict()
+        done = threading.Event()
+        def callback(pending, exc_info):
+            outcomes[pending.node_id] = \
+                exc_info[0] if exc_info else pending.ready
+            if len(outcomes) == 3:
+                done.set()
+        ready = self.pending(node_status.READY)
+        failed = self.pending(node_status.FAIL)
+        late = self.pending(timeout=0.2)
+        for p in [ready, failed, late]:
+            self.poller.watch(p, callback)
+        done.wait(5)
+        self.assertEqual(outcomes, {ready.node_id: True,
+                                    failed.node_id: NodeFailedError,
+                                    late.node_id: NodeCreationTimeOutError})
+        self.assertEqual(self.poller.pending, dict())
+    def test_wait(self):
+        p = self.pending()
+        threading.Timer(
+            0.2, self.ib.states.__setitem__,
+            (p.node_id, node_status.READY)).start()
+        self.assertTrue(self.poller.wait(p))
+        self.assertGreater(len(self.ib.queries), 1)
+    def test_wait_timeout(self):
+        self.assertRaises(NodeCreationTimeOutError,
+                          self.poller.wait, self.pending(timeout=0.1))
+    def test_wait_cancelled(self):
+        cancel_event = threading.Event()
+        threading.Timer(0.1, cancel_event.set).start()
+        p = self.pending(cancel_event=cancel_event)
+        self.assertFalse(self.poller.wait(p))
+        self.assertEqual(self.poller.pending, dict())
+    def test_wait_cancelled_is_recorded(self):
+        cancel_event = threading.Event()
+        threading.Timer(0.1, cancel_event.set).start()
+        p = self.pending(cancel_event=cancel_event)
+        p.policy = RecordingPolicy(0.01)
+        self.assertFalse(self.poller.wait(p))
+        time.sleep(0.1)
+        # Once, even if the poller has noticed the cancellation too
+        self.assertEqual(p.policy.outcomes, ['abandoned'])
+    def test_max_queries_per_tick(self):
+        self.poller.max_queries_per_tick = 2
+        self.poller.tick_interval = 0.2
+        nodes = [self.pending(node_status.READY) for i in xrange(5)]
+        finished = list()
+        done = threading.Event()
+        def callback(pending, exc_info):
+            finished.append(pending.node_id)
+            if len(finished) == 5:
+                done.set()
+        for p in nodes:
+            self.poller.watch(p, callback)
+        done.wait(5)
+        self.assertEqual(len(finished), 5)
+        # Three ticks are needed: 2 + 2 + 1 queries
+        times = [t for t, node_id in self.ib.queries]
+        self.assertGreaterEqual(times[-1] - times[0], 0.35)
+    def test_parallel_queries(self):
+        self.ib.delay = 0.3
+        nodes = [self.pending(node_status.READY) for i in xrange(5)]
+        finished = list()
+        done = threading.Event()
+        def callback(pending, exc_info):
+            finished.append(pending.node_id)
+            if len(finished) == 5:
+                done.set()
+        start = time.time()
+        for p in nodes:
+            self.poller.watch(p, callback)
+        done.wait(5)
+        self.assertEqual(len(finished), 5)
+        self.assertLess(time.time() - start, 1)
+    def test_single_query_per_node(self):
+        self.ib.delay = 0.2
+        p = self.pending()
+        threading.Timer(
+            0.5, self.ib.states.__setitem__,
+            (p.node_id, node_status.READY)).start()
+        self.assertTrue(self.poller.wait(p))
+        # Polled again only after the previous query has finished
+        times = [t for t, node_id in self.ib.queries]
+        for first, second in zip(times, times[1:]):
+            self.assertGreaterEqual(second - first, 0.2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from common import *
+from poller_test import NodeStateIB
+import occo.infobroker as ib
+from occo.infobroker.uds import UDS
+import occo.infobroker.eventlog as el
+import occo.infraprocessor.synchronization as synch
+from occo.infraprocessor.synchronization.polling import \
+    PollingPolicy, FixedPollingPolicy, BackoffPollingPolicy, get_polling_policy
+from occo.infraprocessor.synchronization.history import ReadinessHistory
+from occo.exceptions.orchestration import NodeCreationTimeOutError
+import os
+import shutil
+import tempfile
+import time
+
+class PollingPolicyTest(unittest.TestCase):
+    def test_backoff(self):
+        policy = PollingPolicy.instantiate(
+            'backoff', initial_delay=1, multiplier=2, max_delay=5, jitter=0)
+        self.assertEqual([policy.delay(i) for i in xrange(5)],
+                         [1, 2, 4, 5, 5])
+    def test_jitter(self):
+        policy = BackoffPollingPolicy(initial_delay=10, jitter=0.1)
+        for i in xrange(20):
+            self.assertTrue(9 <= policy.delay(0) <= 11)
+    def test_deadline_alignment(self):
+        policy = FixedPollingPolicy(10)
+        self.assertEqual(policy.next_poll(0, now=100), 110)
+        self.assertEqual(policy.next_poll(0, finish_time=105, now=100), 105)
+        self.assertEqual(policy.next_poll(0, finish_time=95, now=100), 100)
+    def test_selection(self):
+        self.assertIsInstance(get_polling_policy(dict(), 3),
+                              FixedPollingPolicy)
+        self.assertEqual(get_polling_policy(dict(), 3).poll_delay, 3)
+        nodedef = dict(polling_policy='backoff')
+        self.assertIsInstance(get_polling_policy(nodedef),
+                              BackoffPollingPolicy)
+        nodedef = dict(synch_strategy=dict(
+            protocol='basic',
+            polling_policy=dict(protocol='backoff', initial_delay=0.5)))
+        self.assertEqual(get_polling_policy(nodedef).initial_delay, 0.5)
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sub', 'history.yaml')
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_statistics(self):
+        history = ReadinessHistory(self.path)
+        self.assertIsNone(history.estimate('t/b'))
+        for x in [10, 12, 14]:
+            history.record('t/b', x)
+        count, mean, stddev = history.estimate('t/b')
+        self.assertEqual(count, 3)
+        self.assertAlmostEqual(mean, 12)
+        self.assertAlmostEqual(stddev, 2)
+        # Persisted, and shared with other instances
+        ReadinessHistory(self.path).record('t/b', 12)
+        self.assertEqual(history.estimate('t/b')[0], 4)
+    def policy(self):
+        return get_polling_policy(
+            dict(backend_id='b', polling_policy=dict(
+                protocol='history', history_file=self.path,
+                spread=2, min_window=0, dense_delay=0.5,
+                fallback=dict(protocol='fixed', poll_delay=5))),
+            node_type='t')
+    def test_schedule(self):
+        policy = self.policy()
+        policy.start(now=0)
+        # Not enough samples
+        self.assertEqual(policy.next_poll(0, now=0), 5)
+        history = ReadinessHistory(self.path)
+        for x in [9, 10, 11]:
+            history.record('t/b', x)
+        policy = self.policy()
+        policy.start(now=0)
+        # Window: 10 +/- 2
+        self.assertEqual(policy.next_poll(0, now=0), 8)
+        self.assertEqual(policy.next_poll(1, now=9), 9.5)
+        self.assertEqual(policy.next_poll(2, now=12.5), 17.5)
+        # Deadline alignment
+        self.assertEqual(policy.next_poll(0, finish_time=6, now=0), 6)
+    def test_learning(self):
+        policy = self.policy()
+        policy.start(now=100)
+        policy.ready(now=130)
+        self.assertEqual(ReadinessHistory(self.path).estimate('t/b'),
+                         (1, 30, 0))
+        # Recorded only once
+        policy.abandoned(now=200)
+        self.assertEqual(ReadinessHistory(self.path).censored('t/b'), 0)
+    def test_censored(self):
+        history = ReadinessHistory(self.path)
+        history.record_censored('t/b', 600)
+        self.assertIsNone(history.estimate('t/b'))
+        for x in [10, 12, 14]:
+            history.record('t/b', x)
+        policy = self.policy()
+        policy.start(now=100)
+        policy.abandoned(now=700)
+        count, mean, stddev = history.estimate('t/b')
+        self.assertEqual(count, 3)
+        self.assertAlmostEqual(mean, 12)
+        self.assertAlmostEqual(stddev, 2)
+        self.assertEqual(history.censored('t/b'), 2)
+
+class WaitForNodeTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = NodeStateIB()
+        ib.set_all_singletons(
+            self.ib,
+            UDS.instantiate(protocol='dict'),
+            el.EventLog.instantiate(protocol='logging'),
+            DummyCloudHandler(),
+            DummyServiceComposer(),
+        )
+        self.instance_data = dict(node_id=uid(), infra_id='infra')
+    def test_timeout_does_not_overshoot(self):
+        start = time.time()
+        self.assertRaises(NodeCreationTimeOutError,
+                          synch.wait_for_node, self.instance_data,
+                          poll_delay=10, timeout=0.2)
+        self.assertLess(time.time() - start, 1)
+    def test_policy_from_node_definition(self):
+        self.instance_data['resolved_node_definition'] = dict(
+            polling_policy=dict(protocol='backoff', initial_delay=0.01,
+                                multiplier=2, jitter=0))
+        self.assertRaises(NodeCreationTimeOutError,
+                          synch.wait_for_node, self.instance_data,
+                          poll_delay=10, timeout=0.3)
+        # Delays: 0.01, 0.02, 0.04, 0.08, 0.16 (capped by the deadline)
+        self.assertLessEqual(len(self.ib.queries), 6)
+        self.assertGreaterEqual(len(self.ib.queries), 4)
+    def test_timeout_is_censored(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'history.yaml')
+            self.instance_data['resolved_node_definition'] = dict(
+                backend_id='b', polling_policy=dict(
+                    protocol='history', history_file=path,
+                    fallback=dict(protocol='fixed', poll_delay=0.05)))
+            self.instance_data['node_description'] = dict(type='t')
+            self.assertRaises(NodeCreationTimeOutError,
+                              synch.wait_for_node, self.instance_data,
+                              timeout=0.1)
+            history = ReadinessHistory(path)
+            self.assertIsNone(history.estimate('t/b'))
+            self.assertEqual(history.censored('t/b'), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from common import *
+from occo.infraprocessor.synchronization.probe import \
+    ProbeEngine, ProbeBatcher, _icmp_socket
+import errno
+import socket
+import threading
+
+class RecordingEngine(ProbeEngine):
+    def __init__(self, *args, **kwargs):
+        ProbeEngine.__init__(self, *args, **kwargs)
+        self.passes = list()
+        self.in_progress = list()
+    def probe_many(self, addresses):
+        self.passes.append(sorted(addresses))
+        return ProbeEngine.probe_many(self, addresses)
+    def _tcp_probe(self, ips):
+        self.passes.append(('tcp', sorted(ips)))
+        return ProbeEngine._tcp_probe(self, ips)
+    def _tcp_connect(self, ip, port, connecting, reachable):
+        self.in_progress.append(len(connecting))
+        return ProbeEngine._tcp_connect(self, ip, port, connecting, reachable)
+
+class ProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+    def tearDown(self):
+        self.listener.close()
+    def closed_port(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+    def test_tcp_listening(self):
+        engine = ProbeEngine(tcp_ports=[self.port], use_icmp=False)
+        self.assertTrue(engine.probe('127.0.0.1'))
+    def test_tcp_refused(self):
+        # A refused connection means the host is reachable
+        engine = ProbeEngine(tcp_ports=[self.closed_port()], use_icmp=False)
+        self.assertTrue(engine.probe('127.0.0.1'))
+    def test_unresolvable(self):
+        engine = ProbeEngine(timeout=0.2, tcp_ports=[self.port],
+                             use_icmp=False)
+        self.assertFalse(engine.probe('nonexistent.invalid'))
+    def test_invalid_address(self):
+        engine = ProbeEngine(timeout=0.2, tcp_ports=[self.port],
+                             use_icmp=False)
+        self.assertEqual(
+            engine.probe_many([None, u'\u00e9.invalid', '127.0.0.1']),
+            {None: False, u'\u00e9.invalid': False, '127.0.0.1': True})
+        batcher = ProbeBatcher(engine, window=0.01)
+        self.assertFalse(batcher.probe(None))
+    def test_deduplication(self):
+        engine = RecordingEngine(tcp_ports=[self.port], use_icmp=False)
+        results = engine.probe_many(['127.0.0.1', 'localhost'])
+        self.assertEqual(results, {'127.0.0.1': True, 'localhost': True})
+        self.assertEqual(engine.passes[-1], ('tcp', ['127.0.0.1']))
+    def test_max_connections(self):
+        engine = RecordingEngine(tcp_ports=[self.closed_port(), self.port],
+                                 use_icmp=False, max_connections=2)
+        ips = ['127.0.0.{0}'.format(i) for i in xrange(1, 7)]
+        self.assertEqual(engine._tcp_probe(ips), set(ips))
+        self.assertGreaterEqual(len(engine.in_progress), len(ips))
+        self.assertLess(max(engine.in_progress), 2)
+    def test_socket_error(self):
+        engine = ProbeEngine(tcp_ports=[self.port], use_icmp=False)
+        real_socket, calls = socket.socket, list()
+        def failing_socket(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise socket.error(errno.EMFILE, 'Too many open files')
+            return real_socket(*args)
+        socket.socket = failing_socket
+        try:
+            reachable = engine._tcp_probe(['127.0.0.1', '127.0.0.2',
+                                           '127.0.0.3'])
+        finally:
+            socket.socket = real_socket
+        # Only the failed attempt is affected
+        self.assertEqual(reachable, set(['127.0.0.1', '127.0.0.3']))
+    def test_icmp(self):
+        sock, socktype = _icmp_socket()
+        if not sock:
+            self.skipTest('ICMP is not permitted')
+        sock.close()
+        engine = ProbeEngine(tcp_ports=[])
+        self.assertTrue(engine.probe('127.0.0.1'))
+    def test_batching(self):
+        engine = RecordingEngine(tcp_ports=[self.port], use_icmp=False)
+        batcher = ProbeBatcher(engine, window=0.2)
+        results = dict()
+        def probe(addr):
+            results[addr] = batcher.probe(addr)
+        threads = [threading.Thread(target=probe, args=(addr,))
+                   for addr in ['127.0.0.1', 'localhost',
+                                'nonexistent.invalid']]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, {'127.0.0.1': True, 'localhost': True,
+                                   'nonexistent.invalid': False})
+        self.assertEqual(engine.passes[0],
+                         ['127.0.0.1', 'localhost', 'nonexistent.invalid'])
+    def test_interrupted_batch(self):
+        class InterruptedEngine(RecordingEngine):
+            def probe_many(self, addresses):
+                if not self.passes:
+                    self.passes.append(sorted(addresses))
+                    raise KeyboardInterrupt()
+                return RecordingEngine.probe_many(self, addresses)
+        engine = InterruptedEngine(tcp_ports=[self.port], use_icmp=False)
+        batcher = ProbeBatcher(engine, window=0.01)
+        with self.assertRaises(KeyboardInterrupt):
+            batcher.probe('127.0.0.1')
+        # Later probes must not join the abandoned batch
+        self.assertIsNone(batcher.batch)
+        self.assertTrue(batcher.probe('127.0.0.1'))
+    def test_abandoned_batch(self):
+        engine = RecordingEngine(tcp_ports=[self.port], use_icmp=False)
+        batcher = ProbeBatcher(engine, wait_timeout=0.1)
+        # A batch whose leader never finishes
+        batcher.batch = dict(addresses=set(), results=dict(),
+                             done=threading.Event())
+        self.assertTrue(batcher.probe('127.0.0.1'))
+        self.assertEqual(engine.passes[0], ['127.0.0.1'])
+
+if __name__ == '__main__':
+    unittest.main()
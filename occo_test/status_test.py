@@ -0,0 +1,457 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from common import *
+from occo.infraprocessor.synchronization.primitives import \
+    CompositeStatus, StatusTag, status_component
+from occo.infraprocessor.synchronization.concurrency import \
+    TaskPool, TaskTimeout, as_completed, default_pool
+import occo.infraprocessor.synchronization as synch
+import occo.infobroker as ib
+import occo.util.factory as factory
+import occo.infraprocessor.synchronization.primitives as sp
+from occo.infobroker.uds import UDS
+import occo.infobroker.eventlog as el
+import threading
+import time
+
+slow_status = StatusTag('Slow status')
+failing_status = StatusTag('Failing status')
+
+class SlowStatus(CompositeStatus):
+    def __init__(self, values, delay=0.2):
+        self.values, self.delay = values, delay
+        self.evaluated = list()
+    def check(self, i):
+        time.sleep(self.delay[i] if isinstance(self.delay, list)
+                   else self.delay)
+        self.evaluated.append(i)
+        return self.values[i]
+    @status_component('First', slow_status)
+    def first(self):
+        return self.check(0)
+    @status_component('Second', slow_status)
+    def second(self):
+        return self.check(1)
+    @status_component('Third', slow_status)
+    def third(self):
+        return self.check(2)
+    @status_component('Failing', failing_status)
+    def failing(self):
+        raise ValueError('failing')
+
+class CompositeStatusTest(unittest.TestCase):
+    def test_serial_lazy(self):
+        status = SlowStatus([True, False, True], delay=0)
+        self.assertFalse(status.get_composite_status(slow_status))
+        self.assertEqual(status.evaluated, [0, 1])
+    def test_concurrent(self):
+        status = SlowStatus([True, True, True])
+        status.concurrent_status = True
+        start = time.time()
+        self.assertTrue(status.get_composite_status(slow_status))
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(status.get_report(slow_status),
+                         [('First', True), ('Second', True), ('Third', True)])
+    def test_concurrent_lazy(self):
+        status = SlowStatus([True, False, True], delay=[0.6, 0, 0.6])
+        status.concurrent_status = True
+        start = time.time()
+        self.assertFalse(status.get_composite_status(slow_status))
+        self.assertLess(time.time() - start, 0.5)
+    def test_component_timeout(self):
+        status = SlowStatus([True, True, True], delay=[0, 0, 0.6])
+        status.concurrent_status = True
+        status.status_component_timeout = 0.2
+        self.assertEqual(status.get_detailed_status(slow_status),
+                         [True, True, False])
+        self.assertFalse(status.get_composite_status(slow_status))
+    def test_saturated_pool(self):
+        # Hanging checks of other nodes occupy all threads of the pool
+        release = threading.Event()
+        pool = default_pool()
+        blockers = pool.map(release.wait, [5] * pool.max_workers)
+        try:
+            status = SlowStatus([True, True, True], delay=0)
+            status.concurrent_status = True
+            status.status_component_timeout = 0.2
+            start = time.time()
+            self.assertFalse(status.get_composite_status(slow_status))
+            self.assertEqual(status.get_detailed_status(slow_status),
+                             [False, False, False])
+            self.assertLess(time.time() - start, 1)
+        finally:
+            release.set()
+            for future in blockers:
+                future.result()
+    def test_exception(self):
+        status = SlowStatus([])
+        status.concurrent_status = True
+        self.assertRaises(ValueError,
+                          status.get_composite_status, failing_status)
+
+class TaskPoolTest(unittest.TestCase):
+    def test_bounded(self):
+        pool = TaskPool(max_workers=2)
+        lock = threading.Lock()
+        state = dict(current=0, peak=0)
+        def task(i):
+            with lock:
+                state['current'] += 1
+                state['peak'] = max(state['peak'], state['current'])
+            time.sleep(0.05)
+            with lock:
+                state['current'] -= 1
+            return i * 2
+        futures = pool.map(task, range(6))
+        self.assertEqual([f.result() for f in futures], range(0, 12, 2))
+        self.assertEqual(state['peak'], 2)
+    def test_as_completed(self):
+        pool = TaskPool()
+        futures = pool.map(time.sleep, [0.2, 0])
+        self.assertIs(next(as_completed(futures)), futures[1])
+    def test_timeout(self):
+        future = TaskPool().submit(time.sleep, 0.5)
+        self.assertRaises(TaskTimeout, future.result, 0.05)
+    def test_as_completed_deadline(self):
+        futures = TaskPool().map(time.sleep, [0.15, 0.3, 0.45])
+        start = time.time()
+        with self.assertRaises(TaskTimeout):
+            list(as_completed(futures, 0.2))
+        # A single deadline, not one for each future
+        self.assertLess(time.time() - start, 0.3)
+    def test_task_timeout_from_start(self):
+        pool = TaskPool(max_workers=1)
+        futures = pool.map(time.sleep, [0.2, 0.2])
+        # The second task waits for the first one, which is not counted
+        self.assertEqual(len(list(as_completed(futures, task_timeout=0.3))),
+                         2)
+        self.assertIsNone(pool.submit(time.sleep, 0.2).run_result(0.3))
+        future = pool.submit(time.sleep, 0.3)
+        with self.assertRaises(TaskTimeout):
+            list(as_completed([future], task_timeout=0.1))
+        self.assertRaises(TaskTimeout, future.run_result, 0.1)
+    def test_saturated_pool(self):
+        pool = TaskPool(max_workers=1)
+        release = threading.Event()
+        pool.submit(release.wait, 5)
+        try:
+            future = pool.submit(time.sleep, 0)
+            start = time.time()
+            self.assertRaises(TaskTimeout, future.run_result, 0.2, 0.2)
+            with self.assertRaises(TaskTimeout):
+                list(as_completed([future], task_timeout=0.2,
+                                  queue_timeout=0.2))
+            self.assertLess(time.time() - start, 1)
+        finally:
+            release.set()
+        self.assertIsNone(future.run_result(0.2, 1))
+
+class StatusCacheTest(unittest.TestCase):
+    def test_no_cache(self):
+        status = SlowStatus([True, True, True], delay=0)
+        status.get_composite_status(slow_status)
+        status.get_composite_status(slow_status)
+        self.assertEqual(status.evaluated, [0, 1, 2, 0, 1, 2])
+    def test_sticky(self):
+        status = SlowStatus([True, False, True], delay=0)
+        status.sticky_status = True
+        self.assertFalse(status.get_composite_status(slow_status, lazy=False))
+        status.values[1] = True
+        self.assertTrue(status.get_composite_status(slow_status))
+        self.assertTrue(status.get_composite_status(slow_status))
+        # Passed components are not evaluated again
+        self.assertEqual(status.evaluated, [0, 1, 2, 1])
+    def test_sticky_ttl(self):
+        status = SlowStatus([True, True, True], delay=0)
+        status.sticky_status, status.status_ttl = True, 0.2
+        status.get_composite_status(slow_status)
+        status.get_composite_status(slow_status)
+        self.assertEqual(status.evaluated, [0, 1, 2])
+        time.sleep(0.3)
+        status.get_composite_status(slow_status)
+        self.assertEqual(status.evaluated, [0, 1, 2, 0, 1, 2])
+    def test_ttl(self):
+        status = SlowStatus([False, True, True], delay=0)
+        status.status_ttl = 10
+        self.assertFalse(status.get_composite_status(slow_status))
+        status.values[0] = True
+        # Failures are reused too, within the TTL
+        self.assertFalse(status.get_composite_status(slow_status))
+        self.assertEqual(status.evaluated, [0])
+    def test_concurrent_sticky(self):
+        status = SlowStatus([True, True, True], delay=0)
+        status.concurrent_status = status.sticky_status = True
+        self.assertTrue(status.get_composite_status(slow_status))
+        self.assertTrue(status.get_composite_status(slow_status))
+        self.assertEqual(sorted(status.evaluated), [0, 1, 2])
+
+released = list()
+
+@factory.register(synch.NodeSynchStrategy, 'test_release')
+class ReleasedStrategy(synch.NodeSynchStrategy):
+    def release(self):
+        released.append(self)
+
+class SynchStrategyCacheTest(unittest.TestCase):
+    def instance_data(self, node_id='node1', **kwargs):
+        nodedef = dict(infra_id='infra', synch_strategy='basic')
+        nodedef.update(kwargs)
+        return dict(node_id=node_id, node_description=dict(type='t'),
+                    resolved_node_definition=nodedef)
+    def test_reuse(self):
+        strategy = synch.get_synch_strategy(self.instance_data())
+        data = self.instance_data()
+        self.assertIs(synch.get_synch_strategy(data), strategy)
+        self.assertIs(strategy.instance_data, data)
+        self.assertIsNot(
+            synch.get_synch_strategy(self.instance_data('node2')), strategy)
+    def test_changed(self):
+        strategy = synch.get_synch_strategy(self.instance_data())
+        self.assertIsNot(
+            synch.get_synch_strategy(self.instance_data(synch_attrs=['a'])),
+            strategy)
+    def test_forget(self):
+        strategy = synch.get_synch_strategy(self.instance_data())
+        synch.forget_synch_strategy('node1')
+        self.assertIsNot(
+            synch.get_synch_strategy(self.instance_data()), strategy)
+    def test_release(self):
+        del released[:]
+        first = synch.get_synch_strategy(
+            self.instance_data(synch_strategy='test_release'))
+        second = synch.get_synch_strategy(
+            self.instance_data(synch_strategy='test_release', a=1))
+        synch.forget_synch_strategy('node1')
+        self.assertEqual(released, [first, second])
+        size = synch.STRATEGY_CACHE_SIZE
+        synch.STRATEGY_CACHE_SIZE = 1
+        try:
+            evicted = synch.get_synch_strategy(
+                self.instance_data('node2', synch_strategy='test_release'))
+            synch.get_synch_strategy(self.instance_data('node3'))
+        finally:
+            synch.STRATEGY_CACHE_SIZE = size
+        self.assertIs(released[-1], evicted)
+
+class AddressedStrategy(synch.BasicNodeSynchStrategy):
+    addr = '10.0.0.1'
+    queries = 0
+    def get_node_address(self):
+        self.queries += 1
+        return self.addr
+
+class URLResolutionTest(unittest.TestCase):
+    def strategy(self):
+        urls = ['http://{{addr}}:{{variables.port}}/',
+                'http://{{addr}}/{{node_id}}']
+        return AddressedStrategy(
+            dict(variables=dict(port=8080)),
+            dict(infra_id='infra', synch_strategy=dict(urls=urls)),
+            dict(node_id='node1'))
+    def test_resolve(self):
+        strategy = self.strategy()
+        self.assertEqual(strategy.resolve_urls(),
+                         ['http://10.0.0.1:8080/', 'http://10.0.0.1/node1'])
+        self.assertEqual(strategy.queries, 1)
+    def test_address_change(self):
+        strategy = self.strategy()
+        urls = strategy.resolve_urls()
+        self.assertIs(strategy.resolve_urls(), urls)
+        strategy.addr = '10.0.0.2'
+        self.assertEqual(strategy.resolve_urls(),
+                         ['http://10.0.0.2:8080/', 'http://10.0.0.2/node1'])
+
+@ib.provider
+class AttributeIB(DummyInfoBroker):
+    def __init__(self):
+        DummyInfoBroker.__init__(self)
+        self.attributes = dict(a=1, b=None)
+        self.queries = list()
+    @ib.provides('node.attribute')
+    def node_attribute(self, node_id, attribute):
+        self.queries.append(attribute)
+        return self.attributes[attribute]
+
+@ib.provider
+class BulkAttributeIB(AttributeIB):
+    @ib.provides('node.attributes')
+    def node_attributes(self, node_id, attributes):
+        self.queries.append(sorted(attributes))
+        return dict((k, v) for k, v in self.attributes.iteritems()
+                    if k in attributes)
+
+class AttributesReadyTest(unittest.TestCase):
+    def strategy(self, infobroker, **synch_strategy):
+        ib.set_all_singletons(
+            infobroker,
+            UDS.instantiate(protocol='dict'),
+            el.EventLog.instantiate(protocol='logging'),
+            DummyCloudHandler(),
+            DummyServiceComposer(),
+        )
+        return synch.BasicNodeSynchStrategy(
+            dict(variables=dict()),
+            dict(infra_id='infra', synch_attrs=['a', 'b', 'c'],
+                 synch_strategy=synch_strategy),
+            dict(node_id='node1'))
+    def test_single(self):
+        infobroker = AttributeIB()
+        strategy = self.strategy(infobroker)
+        strategy.created = True
+        self.assertFalse(strategy.attributes_ready())
+        # Querying stops at the first unavailable attribute
+        self.assertEqual(infobroker.queries, ['a', 'b'])
+        infobroker.attributes.update(b=2, c=3)
+        self.assertTrue(strategy.attributes_ready())
+        self.assertEqual(infobroker.queries[2:], ['a', 'b', 'c'])
+    def test_waiting_for_creation(self):
+        infobroker = AttributeIB()
+        strategy = self.strategy(infobroker)
+        self.assertFalse(strategy.attributes_ready())
+        infobroker.attributes.update(b=2, c=3)
+        self.assertTrue(strategy.attributes_ready())
+        # Available attributes are not queried again by default while the
+        # node is being created
+        self.assertEqual(infobroker.queries[2:], ['b', 'c'])
+    def test_sticky(self):
+        infobroker = AttributeIB()
+        strategy = self.strategy(infobroker, sticky=True)
+        self.assertFalse(strategy.attributes_ready())
+        infobroker.attributes.update(b=2, c=3)
+        self.assertTrue(strategy.attributes_ready())
+        # Available attributes are not queried again
+        self.assertEqual(infobroker.queries[2:], ['b', 'c'])
+    def test_bulk(self):
+        infobroker = BulkAttributeIB()
+        strategy = self.strategy(infobroker, sticky=True)
+        self.assertFalse(strategy.attributes_ready())
+        infobroker.attributes.update(b=2)
+        self.assertFalse(strategy.attributes_ready())
+        infobroker.attributes.update(c=3)
+        self.assertTrue(strategy.attributes_ready())
+        self.assertEqual(infobroker.queries,
+                         [['a', 'b', 'c'], ['b', 'c'], ['c']])
+    def test_not_sticky(self):
+        infobroker = BulkAttributeIB()
+        infobroker.attributes.update(b=2, c=3)
+        strategy = self.strategy(infobroker)
+        strategy.created = True
+        self.assertTrue(strategy.attributes_ready())
+        # E.g. health checks: attributes that have disappeared are noticed
+        infobroker.attributes.update(b=None)
+        self.assertFalse(strategy.attributes_ready())
+        self.assertEqual(infobroker.queries, [['a', 'b', 'c']] * 2)
+    def test_sticky_ttl(self):
+        infobroker = BulkAttributeIB()
+        infobroker.attributes.update(b=2)
+        strategy = self.strategy(infobroker, sticky=True, status_ttl=0.1)
+        self.assertFalse(strategy.attributes_ready())
+        time.sleep(0.2)
+        self.assertFalse(strategy.attributes_ready())
+        self.assertEqual(infobroker.queries, [['a', 'b', 'c']] * 2)
+
+@ib.provider
+class InfraStateIB(DummyInfoBroker):
+    def __init__(self, state):
+        DummyInfoBroker.__init__(self)
+        self.state = state
+    @ib.provides('infrastructure.state')
+    def infra_state(self, infra_id):
+        return self.state
+
+class ReportingProvider(sp.SynchronizationProvider):
+    def __init__(self, delay=0):
+        sp.SynchronizationProvider.__init__(self)
+        self.delay = delay
+        self.readiness = dict()
+        self.checked = list()
+    def node_state_report(self, instance_data):
+        time.sleep(self.delay)
+        node_id = instance_data['node_id']
+        self.checked.append(node_id)
+        ready = self.readiness.get(node_id, False)
+        return dict(ready=ready, details=[('Node', ready)])
+
+class InfraStateReportTest(unittest.TestCase):
+    def setUp(self):
+        self.state = dict(
+            web=dict((n, dict(node_id=n, infra_id='infra'))
+                     for n in ['w1', 'w2', 'w3']),
+            db=dict(d1=dict(node_id='d1', infra_id='infra')))
+        ib.set_all_singletons(
+            InfraStateIB(self.state),
+            UDS.instantiate(protocol='dict'),
+            el.EventLog.instantiate(protocol='logging'),
+            DummyCloudHandler(),
+            DummyServiceComposer(),
+        )
+    def test_parallel(self):
+        provider = ReportingProvider(delay=0.2)
+        provider.readiness.update(w1=True, w2=True, w3=True, d1=True)
+        start = time.time()
+        report = provider.infra_state_report('infra')
+        self.assertLess(time.time() - start, 0.6)
+        self.assertTrue(report['ready'])
+        self.assertEqual(sorted(report['details']['web']),
+                         ['w1', 'w2', 'w3'])
+    def test_max_age(self):
+        provider = ReportingProvider()
+        provider.infra_state_report('infra', max_age=10)
+        provider.infra_state_report('infra', max_age=10)
+        self.assertEqual(len(provider.checked), 4)
+        provider.infra_state_report('infra')
+        self.assertEqual(len(provider.checked), 8)
+    def test_incremental(self):
+        provider = ReportingProvider()
+        report = provider.infra_state_report('infra')
+        self.assertFalse(report['ready'])
+        version = report['version']
+
+        report = provider.infra_state_report('infra', since=version)
+        self.assertEqual(report['details'], dict())
+        self.assertEqual(report['removed'], [])
+
+        provider.readiness['w2'] = True
+        del self.state['db']
+        report = provider.infra_state_report('infra', since=version)
+        self.assertEqual(report['details'].keys(), ['web'])
+        self.assertEqual(report['details']['web'].keys(), ['w2'])
+        self.assertEqual(report['removed'], ['d1'])
+        self.assertGreater(report['version'], version)
+        self.assertFalse(report['ready'])
+    def test_version_of_included_changes(self):
+        provider = ReportingProvider()
+        version = provider.infra_state_report('infra')['version']
+        # A change reported for another infrastructure
+        provider._cached_node_report(dict(node_id='x', infra_id='other'),
+                                     None)
+        report = provider.infra_state_report('infra', since=version)
+        self.assertEqual(report['details'], dict())
+        self.assertEqual(report['version'], version)
+        provider.readiness['w2'] = True
+        report = provider.infra_state_report('infra', since=version)
+        self.assertEqual(report['details']['web'].keys(), ['w2'])
+    def test_idle_reports_dropped(self):
+        provider = ReportingProvider()
+        provider._cached_node_report(dict(node_id='x', infra_id='deleted'),
+                                     None)
+        provider.node_reports['x']['used'] -= sp.NODE_REPORT_MAX_IDLE + 1
+        provider.infra_state_report('infra')
+        self.assertEqual(sorted(provider.node_reports),
+                         ['d1', 'w1', 'w2', 'w3'])
+
+if __name__ == '__main__':
+    unittest.main()
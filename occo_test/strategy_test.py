@@ -0,0 +1,395 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from common import *
+import occo.infraprocessor as ip
+import occo.plugins.infraprocessor.basic_infraprocessor
+import occo.plugins.infraprocessor.node_resolution.chef_cloudinit
+from occo.infobroker.uds import UDS
+import occo.infobroker as ib
+import occo.infobroker.eventlog as el
+from occo.infraprocessor.coroutine import EventLoop, Sleep, Blocking, Return
+from occo.exceptions.orchestration import MinorInfraProcessorError
+from occo.infraprocessor.forkserver import ForkServer
+from occo.infraprocessor.strategy import DependencyStrategy, PoolWorkerProcess
+import occo.infraprocessor.strategy as strategy_module
+import multiprocessing
+import os
+import threading
+import time
+
+def setup_singletons(servicecomposer_class=DummyServiceComposer):
+    ib.set_all_singletons(
+        DummyInfoBroker(),
+        UDS.instantiate(protocol='dict'),
+        el.EventLog.instantiate(protocol='logging'),
+        DummyCloudHandler(),
+        servicecomposer_class(),
+    )
+    return ib.real_main_info_broker
+
+class RecordingServiceComposer(DummyServiceComposer):
+    def __init__(self):
+        DummyServiceComposer.__init__(self)
+        self.registered = list()
+    def register_node(self, node):
+        self.registered.append(node['name'])
+        DummyServiceComposer.register_node(self, node)
+
+class SleepingCommand(ip.Command):
+    def perform(self, infraprocessor):
+        time.sleep(5)
+        return 'finished'
+
+class DyingWorkerProcess(PoolWorkerProcess):
+    """ Dies right after taking a command, before reporting it. """
+    def perform_one(self, procid, instruction):
+        os._exit(1)
+
+class PoolStrategyTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = setup_singletons()
+        self.infrap = ip.InfraProcessor.instantiate(
+            'basic', process_strategy=dict(protocol='pool',
+                                           max_workers=2,
+                                           max_commands_per_worker=2))
+        self.eid = uid()
+        # Workers are forked lazily, so they inherit this infrastructure
+        DummyServiceComposer().create_infrastructure(self.eid)
+    def tearDown(self):
+        self.infrap.strategy.shutdown()
+    def test_create_multiple_nodes(self):
+        nodes = list(DummyNode(self.eid) for i in xrange(5))
+        cmd_crns = (self.infrap.cri_create_node(node) for node in nodes)
+        results = self.infrap.push_instructions(cmd_crns)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set(r['node_id'] for r in results)), 5)
+        self.assertLessEqual(len(self.infrap.strategy.workers), 2)
+    def test_multiple_batches(self):
+        for i in xrange(3):
+            cmd = self.infrap.cri_create_node(DummyNode(self.eid))
+            result = self.infrap.push_instructions(cmd)
+            self.assertEqual(len(result), 1)
+            self.assertIsNotNone(result[0])
+    def test_cancel_unreported_command(self):
+        strategy = self.infrap.strategy
+        strategy._ensure_pool(self.infrap)
+        procid = strategy._submit(SleepingCommand())
+        strategy._grow_pool()
+        # The worker is performing the command, but its 'started' message
+        # has not been processed yet
+        time.sleep(0.5)
+        self.assertEqual(strategy.running, dict())
+        start = time.time()
+        strategy.cancel_pending()
+        self.assertLess(time.time() - start, 3)
+        self.assertIsNone(strategy.results[procid])
+    def test_cancel_before_sigint_enabled(self):
+        strategy = self.infrap.strategy
+        strategy._ensure_pool(self.infrap)
+        result_queue = multiprocessing.Queue()
+        worker = PoolWorkerProcess(
+            1, self.infrap, None, result_queue, strategy.codec,
+            cancelled=multiprocessing.Value('i', 1))
+        worker.perform_one(0, SleepingCommand())
+        self.assertEqual(result_queue.get(timeout=1)[0], 'started')
+        kind, worker_id, procid, result, error = result_queue.get(timeout=1)
+        self.assertEqual((kind, procid, error), ('done', 0, None))
+        self.assertIsNone(strategy.codec.decode_result(result))
+    def test_worker_dies_before_reporting(self):
+        strategy = self.infrap.strategy
+        strategy.liveness_check_interval = 0.2
+        real_worker_class = strategy_module.PoolWorkerProcess
+        strategy_module.PoolWorkerProcess = DyingWorkerProcess
+        try:
+            cmd = self.infrap.cri_create_node(DummyNode(self.eid))
+            results = list(strategy.perform_iter(self.infrap, [cmd]))
+        finally:
+            strategy_module.PoolWorkerProcess = real_worker_class
+        self.assertEqual(results, [(0, None)])
+    def test_reaped_worker_exits(self):
+        strategy = self.infrap.strategy
+        strategy._ensure_pool(self.infrap)
+        # E.g. a recycled worker reaped before its 'exited' message
+        strategy._retire_worker(42)
+        self.assertEqual(strategy.workers, dict())
+
+class ForkServerStrategyTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = setup_singletons()
+        self.infrap = ip.InfraProcessor.instantiate(
+            'basic', process_strategy=dict(protocol='parallel',
+                                           forkserver=True,
+                                           preload=[]))
+        self.eid = uid()
+        # The template process is forked lazily, so it inherits this
+        # infrastructure
+        DummyServiceComposer().create_infrastructure(self.eid)
+    def tearDown(self):
+        self.infrap.strategy.shutdown()
+    def test_create_multiple_nodes(self):
+        for i in xrange(2):
+            nodes = list(DummyNode(self.eid) for i in xrange(3))
+            cmd_crns = (self.infrap.cri_create_node(node) for node in nodes)
+            results = self.infrap.push_instructions(cmd_crns)
+            self.assertEqual(len(results), 3)
+            self.assertEqual(len(set(r['node_id'] for r in results)), 3)
+        # The template process is reused between batches
+        self.assertTrue(self.infrap.strategy.forkserver.is_alive())
+    def test_forked_from_template(self):
+        result_queue = multiprocessing.Queue()
+        def target(tag):
+            result_queue.put((tag, os.getppid()))
+            result_queue.close()
+            result_queue.join_thread()
+        server = ForkServer(target, preload=['json'])
+        server.start()
+        try:
+            pid = server.spawn('x')
+            self.assertNotEqual(pid, os.getpid())
+            self.assertEqual(result_queue.get(timeout=10),
+                             ('x', server.process.pid))
+        finally:
+            server.shutdown()
+        self.assertFalse(server.is_alive())
+
+class ThreadedStrategyTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = setup_singletons()
+        self.infrap = ip.InfraProcessor.instantiate(
+            'basic', process_strategy=dict(protocol='threaded',
+                                           max_threads=3))
+        self.eid = uid()
+        self.infrap.push_instructions(
+            self.infrap.cri_create_infrastructure(self.eid))
+    def test_create_multiple_nodes(self):
+        nodes = list(DummyNode(self.eid) for i in xrange(5))
+        cmd_crns = (self.infrap.cri_create_node(node) for node in nodes)
+        results = self.infrap.push_instructions(cmd_crns)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(self.ib.environments[self.eid]), 5)
+    def test_cancel_event(self):
+        dummydata['node.state'] = 'pending'
+        try:
+            cmd = self.infrap.cri_create_node(DummyNode(self.eid))
+            cmd.cancel_event = threading.Event()
+            cmd.cancel_event.set()
+            self.assertRaises(KeyboardInterrupt, cmd.perform, self.infrap)
+            # The partially created node must have been undone
+            self.assertEqual(repr(self.ib), '{0}:[]'.format(self.eid))
+        finally:
+            dummydata['node.state'] = 'ready'
+
+class PipelinedStrategyTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = setup_singletons(RecordingServiceComposer)
+        self.infrap = ip.InfraProcessor.instantiate(
+            'basic', process_strategy=dict(protocol='pipelined',
+                                           max_threads=1),
+            poll_delay=0.05, readiness_poller=dict())
+        self.eid = uid()
+        self.infrap.push_instructions(
+            self.infrap.cri_create_infrastructure(self.eid))
+    def test_waiting_does_not_occupy_worker(self):
+        sc = self.infrap.servicecomposer
+        provisioned = list()
+        def release():
+            # All nodes must be provisioned by the single worker while the
+            # previous ones are waiting
+            for i in xrange(100):
+                if len(sc.registered) == 3:
+                    provisioned.append(True)
+                    break
+                time.sleep(0.05)
+            dummydata['node.state'] = 'ready'
+        dummydata['node.state'] = 'pending'
+        releaser = threading.Thread(target=release)
+        try:
+            releaser.start()
+            nodes = list(DummyNode(self.eid) for i in xrange(3))
+            cmd_crns = (self.infrap.cri_create_node(node) for node in nodes)
+            results = self.infrap.push_instructions(cmd_crns)
+        finally:
+            releaser.join()
+            dummydata['node.state'] = 'ready'
+        self.assertEqual(provisioned, [True])
+        self.assertEqual(len(set(r['node_id'] for r in results)), 3)
+    def test_single_phase_command(self):
+        result = self.infrap.push_instructions(
+            self.infrap.cri_drop_infrastructure(self.eid))
+        self.assertEqual(len(result), 1)
+    def test_default_poller(self):
+        infrap = ip.InfraProcessor.instantiate(
+            'basic', process_strategy=dict(protocol='pipelined',
+                                           max_threads=1),
+            poll_delay=0.05)
+        self.assertIsNone(infrap.poller)
+        nodes = list(DummyNode(self.eid) for i in xrange(3))
+        results = infrap.push_instructions(
+            infrap.cri_create_node(node) for node in nodes)
+        self.assertEqual(len(set(r['node_id'] for r in results)), 3)
+        # Nodes have been waited for by the poller of the strategy, not by a
+        # thread each
+        self.assertIsNotNone(infrap.strategy.default_poller)
+
+class CoroutineStrategyTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = setup_singletons()
+        self.infrap = ip.InfraProcessor.instantiate(
+            'basic', process_strategy=dict(protocol='coroutine',
+                                           max_threads=2))
+        self.eid = uid()
+        self.infrap.push_instructions(
+            self.infrap.cri_create_infrastructure(self.eid))
+    def test_create_multiple_nodes(self):
+        nodes = list(DummyNode(self.eid) for i in xrange(5))
+        cmd_crns = (self.infrap.cri_create_node(node) for node in nodes)
+        results = self.infrap.push_instructions(cmd_crns)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(self.ib.environments[self.eid]), 5)
+    def test_cancel_waiting_node(self):
+        dummydata['node.state'] = 'pending'
+        try:
+            loop = EventLoop()
+            cmd = self.infrap.cri_create_node(DummyNode(self.eid))
+            task = loop.spawn(cmd.perform_async(self.infrap))
+            while task.waiting != 'sleep':
+                loop._run_once()
+            task.cancel()
+            tag, result, exc_info = loop.next_finished()
+            loop.close()
+            self.assertIs(exc_info[0], KeyboardInterrupt)
+            # The partially created node must have been undone
+            self.assertEqual(repr(self.ib), '{0}:[]'.format(self.eid))
+        finally:
+            dummydata['node.state'] = 'ready'
+
+class EventLoopTest(unittest.TestCase):
+    def test_subcoroutines(self):
+        def inner(x):
+            yield Sleep(0.01)
+            value = yield Blocking(lambda: x * 2)
+            raise Return(value)
+        def outer():
+            a = yield inner(1)
+            b = yield inner(a)
+            raise Return(a + b)
+        loop = EventLoop()
+        loop.spawn(outer(), 'outer')
+        self.assertEqual(loop.next_finished(), ('outer', 6, None))
+        loop.close()
+    def test_exception(self):
+        def failing():
+            yield Blocking(int, 'x')
+        loop = EventLoop()
+        loop.spawn(failing())
+        tag, result, exc_info = loop.next_finished()
+        self.assertIs(exc_info[0], ValueError)
+        loop.close()
+
+class DependencyStrategyTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = setup_singletons(RecordingServiceComposer)
+        self.infrap = ip.InfraProcessor.instantiate(
+            'basic', process_strategy='dag')
+        self.eid = uid()
+    def test_whole_deployment(self):
+        node_a = DummyNode(self.eid, node_name='a')
+        node_a['mappings'] = dict(outbound=dict(
+            b=[dict(attributes=['attr1', 'attr1'], synch=True)]))
+        node_b = DummyNode(self.eid, node_name='b')
+        cmds = [self.infrap.cri_create_node(node_b),
+                self.infrap.cri_create_node(node_a),
+                self.infrap.cri_create_infrastructure(self.eid)]
+        results = self.infrap.push_instructions(cmds)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(self.infrap.servicecomposer.registered, ['a', 'b'])
+        self.assertEqual(results[0]['node_description']['name'], 'b')
+    def test_explicit_dependencies(self):
+        create_infra = self.infrap.cri_create_infrastructure(self.eid)
+        drop_infra = self.infrap.cri_drop_infrastructure(self.eid)
+        drop_infra.depends_on = [create_infra]
+        self.infrap.push_instructions([drop_infra, create_infra])
+        self.assertEqual(repr(self.ib), '')
+    def test_cyclic_dependencies(self):
+        cmd_1 = self.infrap.cri_create_infrastructure(self.eid)
+        cmd_2 = self.infrap.cri_create_infrastructure(self.eid)
+        cmd_1.depends_on, cmd_2.depends_on = [cmd_2], [cmd_1]
+        self.assertRaises(ValueError,
+                          self.infrap.push_instructions, [cmd_1, cmd_2])
+
+class LingeringWorkers(object):
+    """ Worker threads stay alive for a while after finding no work. """
+    def _worker(self):
+        super(LingeringWorkers, self)._worker()
+        time.sleep(0.5)
+
+class LingeringDependencyStrategy(LingeringWorkers, DependencyStrategy):
+    pass
+
+class ExitingWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = setup_singletons()
+        self.infrap = ip.InfraProcessor.instantiate('basic')
+        self.infrap.strategy = LingeringDependencyStrategy()
+        self.eid = uid()
+    def test_chain(self):
+        # Each command is submitted when its only worker is just exiting
+        cmds = [self.infrap.cri_create_infrastructure(self.eid)]
+        for i in xrange(3):
+            cmds.append(self.infrap.cri_create_node(DummyNode(self.eid)))
+            cmds[-1].depends_on = [cmds[-2]]
+        results = list()
+        thread = threading.Thread(
+            target=lambda: results.extend(
+                self.infrap.push_instructions(cmds)))
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), 'The batch has hung')
+        self.assertEqual(len(results), 4)
+
+class StreamingTest(unittest.TestCase):
+    def setUp(self):
+        self.ib = setup_singletons()
+    def _check_streaming(self, strategy):
+        infrap = ip.InfraProcessor.instantiate(
+            'basic', process_strategy=strategy)
+        eid = uid()
+        DummyServiceComposer().create_infrastructure(eid)
+        cmds = [infrap.cri_create_node(DummyNode(eid)) for i in xrange(3)]
+        # Dropping a non-existent infrastructure is a minor error
+        cmds.append(infrap.cri_drop_infrastructure(uid()))
+        results = dict(infrap.push_instructions_iter(cmds))
+        self.assertEqual(sorted(results.keys()), [0, 1, 2, 3])
+        self.assertIsInstance(results[3], MinorInfraProcessorError)
+        for i in xrange(3):
+            self.assertIn('node_id', results[i])
+        if hasattr(infrap.strategy, 'shutdown'):
+            infrap.strategy.shutdown()
+    def test_sequential(self):
+        self._check_streaming('sequential')
+    def test_parallel(self):
+        self._check_streaming('parallel')
+    def test_pool(self):
+        self._check_streaming('pool')
+    def test_threaded(self):
+        self._check_streaming('threaded')
+    def test_pipelined(self):
+        self._check_streaming('pipelined')
+    def test_coroutine(self):
+        self._check_streaming('coroutine')
+    def test_dag(self):
+        self._check_streaming('dag')
@@ -0,0 +1,63 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from common import *
+from occo.infraprocessor.throttling import Throttling
+import threading
+import time
+
+class ThrottlingTest(unittest.TestCase):
+    def test_concurrency_limit(self):
+        throttling = Throttling(dict(be1=dict(max_concurrency=2)))
+        lock = threading.Lock()
+        state = dict(current=0, peak=0)
+        def call():
+            with throttling.slot('be1'):
+                with lock:
+                    state['current'] += 1
+                    state['peak'] = max(state['peak'], state['current'])
+                time.sleep(0.05)
+                with lock:
+                    state['current'] -= 1
+        threads = [threading.Thread(target=call) for i in xrange(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(state['peak'], 2)
+    def test_rate_limit(self):
+        throttling = Throttling(dict(be1=dict(rate=20, burst=1)))
+        start = time.time()
+        for i in xrange(5):
+            with throttling.slot('be1'):
+                pass
+        self.assertGreaterEqual(time.time() - start, 0.15)
+    def test_unlimited_backend(self):
+        throttling = Throttling(dict(be1=dict(rate=0.001, burst=1)))
+        start = time.time()
+        for i in xrange(5):
+            with throttling.slot('be2'):
+                pass
+        self.assertLess(time.time() - start, 0.1)
+    def test_cancel(self):
+        throttling = Throttling(dict(be1=dict(rate=0.001, burst=1)))
+        cancel_event = threading.Event()
+        cancel_event.set()
+        with throttling.slot('be1', cancel_event):
+            pass
+        def second_call():
+            with throttling.slot('be1', cancel_event):
+                pass
+        self.assertRaises(KeyboardInterrupt, second_call)
@@ -32,8 +32,12 @@ setuptools.setup(
         'occo.infraprocessor.synchronization',
     ],
     py_modules=[
+        'occo.infraprocessor.codec',
+        'occo.infraprocessor.coroutine',
+        'occo.infraprocessor.forkserver',
         'occo.infraprocessor.node_resolution',
         'occo.infraprocessor.strategy',
+        'occo.infraprocessor.throttling',
         'occo.infraprocessor.synchronization.primitives',
         'occo.plugins.infraprocessor.basic_infraprocessor',
         'occo.plugins.infraprocessor.node_resolution.chef_cloudinit',